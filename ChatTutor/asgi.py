@@ -0,0 +1,154 @@
+"""
+ASGI entry point: the async /ask route next to the Flask app.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+POST /ask is served on the event loop (`Tutor.astream_response_generator`): the
+LLM stream is awaited instead of holding a thread, so one process keeps hundreds
+of answers open. Every other request, including the CORS preflight of /ask, goes
+to the Flask app (`main.app`) through asgiref's WSGI adapter, each in its own
+thread. The gunicorn entry point (`main:app`) is unchanged, so routes can move
+over one at a time.
+"""
+
+import asyncio
+import json
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from main import app as flask_app
+from core.blueprints.bp_ask.ask import prepare_ask
+from core.tracing import span, start_trace
+
+ASYNC_ROUTES = {("POST", "/ask"), ("POST", "/ask/")}
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+def cors_headers(scope):
+    """Same CORS answer as flask_cors with its defaults (the origin is echoed back)"""
+    origin = dict(scope.get("headers", [])).get(b"origin")
+    if origin is None:
+        return []
+    return [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+
+
+async def read_body(receive):
+    """Request body, or None if the client left before sending it"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(scope, send, data, status=200):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")] + cors_headers(scope),
+        }
+    )
+    await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+
+async def ask(scope, receive, send):
+    """Async version of the /ask route of `core.blueprints.bp_ask.ask`, same body and stream"""
+    body = await read_body(receive)
+    if body is None:
+        return
+    # the trace covers the request until the end of the stream
+    root = start_trace("ask", server="asgi")
+    try:
+        with root.activate():
+            with span("ask.parse"):
+                data = json.loads(body)
+            # access key check and tutor construction hit the SQL db, keep them off the loop
+            # (there is no Flask login here, chat summaries are kept for access key users)
+            prepared = await asyncio.to_thread(prepare_ask, data)
+    except ValueError as e:
+        root.end(error=repr(e))
+        return await send_json(scope, send, {"message": "invalid json"}, status=400)
+    except Exception as e:
+        root.end(error=repr(e))
+        raise
+    if prepared is None:
+        root.end(unauthorised=True)
+        return await send_json(scope, send, {"message": "notloggedin"})
+    _chattutor, conversation, pulling_from, selected_model = prepared
+    generate = _chattutor.astream_response_generator(
+        conversation, pulling_from, selected_model, pipeline="openai"
+    )
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+            ]
+            + cors_headers(scope),
+        }
+    )
+
+    async def stream():
+        try:
+            async for frame in generate():
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": frame.encode(),
+                        "more_body": True,
+                    }
+                )
+            await send({"type": "http.response.body", "body": b""})
+        except asyncio.CancelledError:
+            root.set(disconnected=True)
+            raise
+        finally:
+            root.end()
+
+    async def disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    # stop generating (and paying for) the answer when the student closes the page
+    with root.activate():
+        # the task copies the current context, its spans go under the root
+        streaming = asyncio.ensure_future(stream())
+    disconnected = asyncio.ensure_future(disconnect())
+    done, pending = await asyncio.wait(
+        {streaming, disconnected}, return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    if streaming in done:
+        streaming.result()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    if (scope["method"], scope["path"]) in ASYNC_ROUTES:
+        return await ask(scope, receive, send)
+    # a thread per request for the Flask routes (asgiref would run them all on one otherwise)
+    async with ThreadSensitiveContext():
+        await wsgi_app(scope, receive, send)
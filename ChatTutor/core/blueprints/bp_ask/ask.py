@@ -1,6 +1,9 @@
 from core.extensions import db
+import flask_login
 from flask import Blueprint, Response, request, stream_with_context, jsonify
 from core.tutor.tutorfactory import TutorFactory, TutorTypes
+from core.tracing import annotate, span, start_trace, traced_stream
+from core.tutor.memory import conversation_memory
 from core.data import DataBase
 from core.tutor.tutorfactory import CourseTutorType, NSFTutorType
 from core.tutor.systemmsg import (
@@ -13,6 +16,86 @@ tutorfactory = TutorFactory(db)
 ask_bp = Blueprint("bp_ask", __name__)
 
 
+def logged_in_user_id():
+    """user_id of the flask_login user of the current request, None if anonymous"""
+    user = flask_login.current_user
+    if user is None or not user.is_authenticated:
+        return None
+    return user.user_id
+
+
+def prepare_ask(data, logged_in_user=None):
+    """Checks the access key and builds the tutor of an /ask request, shared by the
+    Flask route and the async route of `asgi.py`.
+
+    Args:
+        data (dict): request body, see `ask`
+        logged_in_user (str, optional): user_id of the logged in user, if any
+
+    Returns:
+        (tutor, conversation, pulling_from, selected_model), or None if the access key is invalid
+    """
+    # get credentials
+    credential_user = data.get("credential_token")
+    multiple = data.get("multiple")
+
+    key = data.get("key")
+    ver = data.get("chattutor_version", "donotaskforkey")
+    user_id = data.get("user_id")
+    # the user the chat summaries are read and written for, None if anonymous
+    owner_id = logged_in_user
+    if ver != "donotaskforkey":
+        with span("ask.access_check"):
+            acc, _ = DataBase().get_acces_code(code=key, uid=user_id)
+        if acc is None:
+            print("unauthorised")
+            return None
+        # the access code belongs to user_id
+        owner_id = owner_id or user_id
+
+    print("Asked: ", key, ver)
+
+    conversation = data["conversation"]
+    with span("ask.memory"):
+        conversation = conversation_memory.compact(
+            data.get("chat_k"), conversation, owner_id
+        )
+    collection_name = data.get("collection")
+    collection_desc = data.get("description")
+    response_type = data.get("response_type", "COURSE_RESTRICTED")
+    from_doc = data.get("from_doc")
+
+    with span("ask.section_lookup"):
+        sections, session = DataBase().get_one_section_by_id(from_doc)
+    pulling_from_section = sections
+
+    selected_model = data.get("selectedModel", "gpt-3.5-turbo-16k")
+
+    tutor_type = TutorTypes.from_string(response_type)
+
+    # Logging whether the request is specific to a document or can be from any document
+    # todo: get bot type from token
+    print("FROM_DOC: ", from_doc)
+
+    pulling_from = [from_doc]
+    if pulling_from_section != None and tutor_type != NSFTutorType.NSF_CQN:
+        pulling_from: list[str] = pulling_from_section.pulling_from.split("$")
+    if from_doc == None:
+        pulling_from = None
+    print("SELECTED MODEL: ", selected_model, "Pulling from: ", pulling_from)
+    print(collection_name)
+    annotate(tutor_type=tutor_type.name, model=selected_model)
+    with span("ask.build_tutor"):
+        if collection_name != None and collection_name != []:
+            _chattutor = tutorfactory.build(
+                tutor_type, collection_name, collection_desc
+            )
+        else:
+            _chattutor = tutorfactory.build_empty(tutor_type)
+
+    return _chattutor, conversation, pulling_from, selected_model
+
+
 @ask_bp.route("", methods=["POST", "GET"])
 def ask():
     """Route that facilitates the asking of questions. The response is generated
@@ -35,6 +118,8 @@ def ask():
             # if restricted, it will only inform itself from the current section (page), if focused, it will focus on the current
             # page but would also have access to other sections (pages)
             "selectedModel": str # selected model
+            "chat_k": Optional[str] # chat id, the older messages of the chat are replaced by
+            # a running summary (see core.tutor.memory) for logged in or access key users
         }
         ```
     Returns:
@@ -49,66 +134,39 @@ def ask():
         {
             "content" : str, # chunk content (part of the response)
             "valid_docs" : Oprional[list], # documents the query used to gain information
-            # yielded only once at the begining
+            # yielded once, first, before the answer
             "elapsed_time" : seconds, # time taken to generate the first response chunk
             "processing_prompt_time" : seconds # time taken to process prompt (gain context/use knowledge base etc.)
         }
         ```
     """
-    data = request.json
-
-    # get credentials
-    credential_user = data.get("credential_token")
-    multiple = data.get("multiple")
-
-    key = data.get("key")
-    ver = data.get("chattutor_version", "donotaskforkey")
-    user_id = data.get("user_id")
-    if ver != "donotaskforkey":
-        acc, _ = DataBase().get_acces_code(code=key, uid=user_id)
-        if acc is None:
-            # MARK: do not change this
-            print("unauthorised")
-            return jsonify({"message": "notloggedin"})
-
-    print("Asked: ", key, ver)
-
-    conversation = data["conversation"]
-    collection_name = data.get("collection")
-    collection_desc = data.get("description")
-    response_type = data.get("response_type", "COURSE_RESTRICTED")
-    from_doc = data.get("from_doc")
-
-    sections, session = DataBase().get_one_section_by_id(from_doc)
-    pulling_from_section = sections
-
-    selected_model = data.get("selectedModel", "gpt-3.5-turbo-16k")
-
-    tutor_type = TutorTypes.from_string(response_type)
-
-    # Logging whether the request is specific to a document or can be from any document
-    # todo: get bot type from token
-    print("FROM_DOC: ", from_doc)
-
-    pulling_from = [from_doc]
-    if pulling_from_section != None and tutor_type != NSFTutorType.NSF_CQN:
-        pulling_from: list[str] = pulling_from_section.pulling_from.split("$")
-    if from_doc == None:
-        pulling_from = None
-    print("SELECTED MODEL: ", selected_model, "Pulling from: ", pulling_from)
-    print(collection_name)
-    _chattutor = tutorfactory.build_empty(tutor_type)
-    if collection_name != None and collection_name != []:
-        _chattutor = tutorfactory.build(tutor_type, collection_name, collection_desc)
+    # the trace covers the request until the end of the stream
+    root = start_trace("ask", server="wsgi")
+    try:
+        with root.activate():
+            with span("ask.parse"):
+                data = request.json
+            prepared = prepare_ask(data, logged_in_user_id())
+    except Exception as e:
+        root.end(error=repr(e))
+        raise
+    if prepared is None:
+        root.end(unauthorised=True)
+        # MARK: do not change this
+        return jsonify({"message": "notloggedin"})
+    _chattutor, conversation, pulling_from, selected_model = prepared
 
     # TO change from openai to gemini,
-    # 1. change pipeline to 'gemini' here,
+    # 1. change pipeline to 'gemini' here (and in asgi.py),
     # 2. and in tutorfactory.py (core/tutor/), line 94, change gemini to True
     #    in SQLQueryTutor's constructor instance
     generate = _chattutor.stream_response_generator(
         conversation, pulling_from, selected_model, pipeline="openai"
     )
-    return Response(stream_with_context(generate()), content_type="text/event-stream")
+    return Response(
+        stream_with_context(traced_stream(generate(), root)),
+        content_type="text/event-stream",
+    )
 
 
 # TODO: see what's going on here with the interpreter
@@ -153,9 +153,13 @@ def getchromapapers():
     req_js = request.json
     prompt = req_js.get("prompt", None)
     variant = req_js.get("variant", None)
-    db.load_datasource_papers("cqn_openaicol_ttv")
     docs, met, dist, text, ceva = db.query_papers_m(
-        prompt=prompt, n_results=10, from_doc=None, variant=variant, metadatas=True
+        prompt=prompt,
+        n_results=10,
+        from_doc=None,
+        variant=variant,
+        metadatas=True,
+        collection_name="cqn_openaicol_ttv",
     )
     ids = ceva["ids"]
     docs = ceva["documents"]
@@ -493,10 +497,8 @@ def delete_doc():
     if DataBase().validate_course_owner(
         collectionname=collection_name, user_email=flask_login.current_user.email
     ):
-        collection = db.client.get_collection(name=collection_name)
-        print(collection)
-        collection.delete(where={"from_doc": doc_name})
-        print("deleted")
+        deleted_ids = db.delete_doc(collection_name, doc_name)
+        print(f"deleted {len(deleted_ids)} chunks")
         return jsonify({"deleted": doc_name, "from_collection": collection_name})
     return jsonify({"error": "Unauthorized operation."})
 
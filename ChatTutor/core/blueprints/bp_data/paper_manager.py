@@ -3,12 +3,15 @@ from typing import List
 
 from core.blueprints.bp_data.cqn import CQNPublications, CQNPublicationsGetTextsFromResourceUrl
 from core.data import DataBase
+from core.data.paperindex import paper_index
 from core.data.models.Author import Author
 from core.data.models.Citations import Citations
 from core.data.models.Publication import Publication
 from core.reader import parse_pdf, Text, Doc
 from core.extensions import db
 
+CQN_COLLECTION = "cqn_openaicol_ttv"
+
 
 class PaperManager:
     @staticmethod
@@ -51,6 +54,7 @@ class PaperManager:
             print(f"::Model({model.result_id}, {model.title})")
 
             DataBase().insert_paper(model=model, citations=citations, authors=authors)
+        paper_index.invalidate()
 
 
     @staticmethod
@@ -103,6 +107,7 @@ class PaperManager:
                 )
             
             DataBase().insert_paper(model=model, citations=[], authors=authors)
+        paper_index.invalidate()
 
 
     @staticmethod
@@ -150,6 +155,7 @@ class PaperManager:
             DataBase().insert_paper(model=model, citations=citations, authors=authors)
             # print('add bokiki')
             # return
+        paper_index.invalidate()
 
     @staticmethod
     def add_to_chroma_static(dt: List):
@@ -212,7 +218,6 @@ class PaperManager:
                 )
                 citations.append(citation_model)
 
-            db.load_datasource_papers("cqn_openaicol_ttv")
             print(f"Bookiki: {book}")
             resource = book['resources'][0]
             
@@ -221,15 +226,17 @@ class PaperManager:
                 if content_texts != []:
                     print(f"Adding to chr {len(content_texts)}")
                     try:
-                        db.add_texts_papers(content_texts)
+                        db.add_texts_papers(content_texts, collection_name=CQN_COLLECTION)
                         print("Added to chr")
                     except Exception:
                         print("An error occurred")
-            db.add_texts_papers([authors_text_all], "authors")
+            db.add_texts_papers([authors_text_all], "authors", CQN_COLLECTION)
             db.add_texts_papers(
-                [titles_text_all, titles_text_reverse_all, titles_text_reverse_just], "titles"
+                [titles_text_all, titles_text_reverse_all, titles_text_reverse_just],
+                "titles",
+                CQN_COLLECTION,
             )
-            db.add_texts_papers([citations_text_all], "citations")
+            db.add_texts_papers([citations_text_all], "citations", CQN_COLLECTION)
             # print("Added one bookiki")
             # return
 
@@ -292,13 +299,14 @@ class PaperManager:
                 )
                 citations.append(citation_model)
 
-            db.load_datasource_papers("cqn_openaicol_ttv")
 
             content_texts: List[Text] = book.pdf_contents
 
-            db.add_texts_papers(content_texts)
-            db.add_texts_papers([authors_text_all], "authors")
+            db.add_texts_papers(content_texts, collection_name=CQN_COLLECTION)
+            db.add_texts_papers([authors_text_all], "authors", CQN_COLLECTION)
             db.add_texts_papers(
-                [titles_text_all, titles_text_reverse_all, titles_text_reverse_just], "titles"
+                [titles_text_all, titles_text_reverse_all, titles_text_reverse_just],
+                "titles",
+                CQN_COLLECTION,
             )
-            db.add_texts_papers([citations_text_all], "citations")
+            db.add_texts_papers([citations_text_all], "citations", CQN_COLLECTION)
@@ -51,8 +51,7 @@ def upload_data_to_process():
         # date formatted with punctuation replaced
         collection_name = generate_unique_name(desc)
 
-        db.load_datasource(collection_name)
-        db.add_texts(texts)
+        db.add_texts(texts, collection_name=collection_name)
         resp["collection_name"] = collection_name
 
     return jsonify(resp)
@@ -101,8 +100,7 @@ def upload_data_from_drop():
             # Generating the collection name based on the name provided by user, a random string and the current
             # date formatted with punctuation replaced
             print(cname)
-            db.load_datasource(cname)
-            db.add_texts(texts)
+            db.add_texts(texts, collection_name=cname)
 
         return jsonify(resp)
     except Exception as e:
@@ -145,8 +143,7 @@ def upload_site_url():
             ss = URLSpider.parse_url(surl)
             site_text = f"{ss.encode('utf-8', errors='replace')}"
             navn = re.sub(r"[^A-Za-z0-9\-_]", "_", surl)
-            db.load_datasource(collection_name)
-            docs = db.get_chroma(from_doc=navn, n_results=1)
+            docs = db.get_chroma(from_doc=navn, n_results=1, collection_name=collection_name)
             if docs == None:
                 continue
             if len(docs) > 0:
@@ -158,8 +155,7 @@ def upload_site_url():
 
             doc = Doc(docname=f_f[1], citation="", dockey=f_f[1])
             texts = parse_plaintext_file_read(f_f[0], doc=doc, chunk_chars=2000, overlap=100)
-            db.load_datasource(collection_name)
-            db.add_texts(texts)
+            db.add_texts(texts, collection_name=collection_name)
             resp["docs"] = resp["docs"] + [navn]
         return jsonify(resp)
     except Exception as e:
@@ -7,6 +7,7 @@ from sqlalchemy import text
 
 from sqlalchemy import delete
 import json
+from datetime import datetime
 from sqlalchemy.orm import joinedload
 from sqlalchemy import or_
 from core.data.models import Singleton, Connection, User
@@ -31,6 +32,7 @@ from core.data.models.Publication import Publication
 from core.data.models.Citations import Citations
 from core.data.models.PublicationCitationLink import PublicationCitationLink
 from core.data.models.ResetCode import ResetCodeModel
+from core.data.models.ChatSummary import ChatSummary
 from core.utils import build_model_from_params
 from core.natlang import to_sql_match
 from sqlalchemy.exc import IntegrityError
@@ -46,6 +48,37 @@ def extract_sql_text(text):
         return None
 
 
+def like_escape(value):
+    """`value` with the LIKE wildcards escaped (to use with escape="\\")"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def contains(column, value):
+    """Case insensitive `value in column`, `value` taken literally"""
+    return column.ilike(f"%{like_escape(value)}%", escape="\\")
+
+
+def contains_word(column, word):
+    """Case insensitive match of `word` as a whole word of `column` ("lukin" matches
+    "M. D. Lukin", not "Lukinov")"""
+    word = like_escape(word)
+    return or_(
+        *(
+            column.ilike(pattern, escape="\\")
+            for pattern in (
+                word,
+                f"{word} %",
+                f"% {word}",
+                f"% {word} %",
+                f"%.{word}",
+                f"%.{word} %",
+                f"{word},%",
+                f"% {word},%",
+            )
+        )
+    )
+
+
 def message_from_joined(message, user, uuser, c, feeds):
     print("U S E R")
     print(user)
@@ -118,6 +151,20 @@ class DataBase(metaclass=Singleton):
 
     def __init__(self) -> None:
         print("Initializing DataBase")
+        self.write_listeners = []
+
+    def on_write(self, listener):
+        """
+        Registers `listener(table_name)`, called after rows of a table were written
+        (e.g. to drop caches built from that table)
+        """
+        if listener not in self.write_listeners:
+            self.write_listeners.append(listener)
+
+    def tables_changed(self, *table_names):
+        for table_name in table_names:
+            for listener in self.write_listeners:
+                listener(table_name)
 
     def safe_exec(self, query):
         if (
@@ -143,6 +190,63 @@ class DataBase(metaclass=Singleton):
         else:
             return {"error": "Unsafe query!"}, False
 
+    def cqn_template_query(self, name, limit=50, **params) -> tuple[list[dict], Session]:
+        """Parameterized query for a common CQN question (see `core.tutor.sqlintents`)
+
+        Args:
+            name (str): "papers_by_author" (author), "authors_of_paper" (title),
+                "papers_about" (topic), "count_papers_about" (topic) or "count_papers"
+            limit (int, optional): maximum number of rows. Defaults to 50.
+            **params: the values of the query
+
+        Returns:
+            tuple[list[dict], Session]: the rows
+        """
+        by_topic = lambda topic: or_(
+            contains(Publication.title, topic), contains(Publication.snippet, topic)
+        )
+        if name == "papers_by_author":
+            statement = (
+                select(
+                    Publication.result_id,
+                    Publication.title,
+                    Publication.link,
+                    Publication.snippet,
+                    Author.name.label("author"),
+                )
+                .join(
+                    PublicationAuthorLink,
+                    PublicationAuthorLink.publication_id == Publication.result_id,
+                )
+                .join(Author, Author.author_id == PublicationAuthorLink.author_id)
+                .where(contains_word(Author.name, params["author"]))
+            )
+        elif name == "authors_of_paper":
+            statement = (
+                select(Author.author_id, Author.name, Author.link, Publication.title.label("paper"))
+                .join(PublicationAuthorLink, PublicationAuthorLink.author_id == Author.author_id)
+                .join(Publication, Publication.result_id == PublicationAuthorLink.publication_id)
+                .where(
+                    or_(
+                        contains(Publication.title, params["title"]),
+                        Publication.result_id == params["title"],
+                    )
+                )
+            )
+        elif name == "papers_about":
+            statement = select(
+                Publication.result_id, Publication.title, Publication.link, Publication.snippet
+            ).where(by_topic(params["topic"]))
+        elif name == "count_papers_about":
+            statement = select(func.count().label("papers")).where(by_topic(params["topic"]))
+        elif name == "count_papers":
+            statement = select(func.count().label("papers")).select_from(Publication)
+        else:
+            raise ValueError(f"unknown CQN query {name}")
+        with Connection().session() as session:
+            rows = session.execute(statement.limit(limit)).mappings().all()
+            return [dict(row) for row in rows], session
+
     def insert_user(self, user: UserModel):
         """Insert User
 
@@ -210,6 +314,12 @@ class DataBase(metaclass=Singleton):
                     session.add(link)
             session.commit()
 
+        self.tables_changed(
+            Publication.__tablename__,
+            Author.__tablename__,
+            PublicationAuthorLink.__tablename__,
+        )
+
     def get_author_by_name_like(self, name_like):
         with Connection().session() as session:
             res = session.exec(
@@ -515,6 +625,20 @@ class DataBase(metaclass=Singleton):
                 crr.append(brr[k])
             return brr, session
 
+    def get_papers_with_authors(self):
+        """Every publication, and every (publication author link, author) pair,
+        in two queries (see `core.data.paperindex`)"""
+        with Connection().session() as session:
+            papers = [paper.jsonserialize() for paper in session.exec(select(Publication)).all()]
+            statement = select(PublicationAuthorLink, Author).join(
+                Author, Author.author_id == PublicationAuthorLink.author_id
+            )
+            links = [
+                (link.jsonserialize(), author.jsonserialize())
+                for link, author in session.exec(statement).all()
+            ]
+            return (papers, links), session
+
     def insert_message(
         self, message: MessageModel | dict, course_collname=None, user_id=None
     ) -> tuple[dict, Session, List]:
@@ -1088,6 +1212,56 @@ class DataBase(metaclass=Singleton):
             session.expunge_all()
             return results, session
 
+    def get_chat_summary(self, owner_id, chat_id) -> tuple[dict | None, Session]:
+        """Running summary of a chat (see `core.tutor.memory`)
+
+        Args:
+            owner_id (str): user the summary belongs to
+            chat_id (str): chat id
+
+        Returns:
+            tuple[dict | None, Session]: the serialized `ChatSummary`, None if the chat has none
+        """
+        with Connection().session() as session:
+            statement = select(ChatSummary).where(
+                ChatSummary.owner_id == owner_id, ChatSummary.chat_id == chat_id
+            )
+            summary = session.exec(statement).first()
+            if summary is None:
+                return None, session
+            return summary.jsonserialize(), session
+
+    def upsert_chat_summary(
+        self, owner_id, chat_id, summary, covered, prefix_hash
+    ) -> tuple[dict, Session]:
+        """Writes the running summary of a chat, creating it if needed
+
+        Args:
+            owner_id (str): user the summary belongs to
+            chat_id (str): chat id
+            summary (str): summary of the first `covered` messages
+            covered (int): number of messages folded into the summary
+            prefix_hash (str): hash of these messages
+
+        Returns:
+            tuple[dict, Session]: the serialized `ChatSummary`
+        """
+        with Connection().session() as session:
+            statement = select(ChatSummary).where(
+                ChatSummary.owner_id == owner_id, ChatSummary.chat_id == chat_id
+            )
+            row = session.exec(statement).first()
+            if row is None:
+                row = ChatSummary(owner_id=owner_id, chat_id=chat_id)
+            row.summary = summary
+            row.covered = covered
+            row.prefix_hash = prefix_hash
+            row.time_updated = datetime.now()
+            session.add(row)
+            session.commit()
+            session.refresh(row)
+            return row.jsonserialize(), session
+
     def update_profile_pic(self, user_id, picture):
         """Insert User
 
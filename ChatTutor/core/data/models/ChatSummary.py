@@ -0,0 +1,44 @@
+from datetime import datetime
+from sqlalchemy import Column
+from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlmodel import Field, SQLModel
+from dataclasses import dataclass
+
+
+@dataclass
+class ChatSummary(SQLModel, table=True):
+    """### Chat Summary Model
+
+    Created by `create_all` at startup like the other tables; it is new, so no existing
+    table changes. To create it by hand (MySQL):
+
+        CREATE TABLE chatsummary (
+            owner_id VARCHAR(255) NOT NULL, chat_id VARCHAR(255) NOT NULL,
+            summary LONGTEXT, covered INTEGER NOT NULL, prefix_hash VARCHAR(255) NOT NULL,
+            time_updated DATETIME NOT NULL, PRIMARY KEY (owner_id, chat_id)
+        );
+
+    Columns:
+        - owner_id (str) : primary_key - user the summary belongs to
+        - chat_id (str) : primary_key - id of the chat (the `chat_k` of the messages)
+        - summary (str) : running summary of the older messages of the chat
+        - covered (int) : number of messages, from the start, folded into the summary
+        - prefix_hash (str) : hash of these messages, to notice a cleared or edited chat
+        - time_updated (datetime) : last time the summary was written
+
+    Args:
+        SQLModel (SQLModel): SQLModel
+        table (bool, optional): Defaults to True.
+    """
+
+    owner_id: str = Field(primary_key=True, nullable=False)
+    chat_id: str = Field(primary_key=True, nullable=False)
+    summary: str = Field(sa_column=Column(LONGTEXT))
+    covered: int = 0
+    prefix_hash: str
+    time_updated: datetime = Field(default_factory=datetime.now)
+
+    def jsonserialize(self):
+        d = self.__dict__
+        d["_sa_instance_state"] = None
+        return d
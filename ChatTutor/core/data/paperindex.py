@@ -0,0 +1,135 @@
+"""
+In-memory index of the CQN papers, for the enrichment of the documents retrieved by
+`SQLQueryTutor`.
+
+Every document used to cost two SQL round trips (`DataBase.get_paper_by_name`, an
+ILIKE scan of publication, and `DataBase.get_authors_of_paper`). The index loads
+all papers and their authors once (two queries), then serves lookups by result id
+or exact title from dictionaries. Ids it does not know fall back to the SQL
+lookups, and are remembered, found or not. The lookups run outside the lock, so
+concurrent requests missing the same id may each run them once before it is
+remembered.
+
+The index is dropped by `PaperManager` after papers are added, and reloaded at
+most every PAPER_INDEX_TTL seconds to pick up changes made elsewhere.
+"""
+
+import logging
+import os
+import time
+from threading import Lock
+
+from core.data import DataBase
+
+PAPER_INDEX_TTL = float(os.getenv("PAPER_INDEX_TTL", 3600))
+
+logger = logging.getLogger(__name__)
+
+
+class PaperIndex:
+    """
+    result_id -> paper metadata and authors
+
+    The returned dicts are shared between requests and must not be modified.
+
+    Attributes
+    ----------
+    papers : dict[str, dict]
+        result id -> serialized `Publication`
+    authors : dict[str, dict]
+        result id -> authors, in the shape `DataBase.get_authors_of_paper` returns
+    titles : dict[str, str]
+        lower case title -> result id
+    missing : set[str]
+        lower case ids the SQL lookup did not find either
+    """
+
+    def __init__(self, ttl=PAPER_INDEX_TTL):
+        self.ttl = ttl
+        self.papers = {}
+        self.authors = {}
+        self.titles = {}
+        self.missing = set()
+        self.loaded_at = None
+        self._lock = Lock()
+
+    def load(self):
+        (papers, links), _ = DataBase().get_papers_with_authors()
+        by_id = {paper["result_id"]: paper for paper in papers}
+        authors = {}
+        for link, author in links:
+            paper = by_id.get(link["publication_id"])
+            if paper is None:
+                continue
+            entry = authors.setdefault(
+                paper["result_id"],
+                {
+                    paper["result_id"]: {
+                        "paper": paper,
+                        "author": [],
+                        "publication_author_link": [],
+                    }
+                },
+            )[paper["result_id"]]
+            entry["author"].append(author)
+            entry["publication_author_link"].append(link)
+        titles = {
+            paper["title"].lower(): result_id
+            for result_id, paper in by_id.items()
+            if paper["title"] is not None
+        }
+        self.papers, self.authors, self.titles = by_id, authors, titles
+        self.missing = set()
+        self.loaded_at = time.time()
+        logger.info("paper index: %d papers, %d authorships", len(by_id), len(links))
+
+    def ensure_loaded(self):
+        with self._lock:
+            if self.loaded_at is None or time.time() - self.loaded_at > self.ttl:
+                self.load()
+
+    def invalidate(self):
+        """Reloads on the next lookup (call it after adding papers)"""
+        with self._lock:
+            self.loaded_at = None
+
+    def resolve(self, id):
+        """Result id of a paper given its result id or exact title, or None"""
+        if id in self.papers:
+            return id
+        return self.titles.get(str(id).lower())
+
+    def fetch(self, id):
+        """SQL lookup of an id the index does not know, remembered under that id"""
+        papers, _ = DataBase().get_paper_by_name(id)
+        if not papers:
+            with self._lock:
+                self.missing.add(str(id).lower())
+            return None
+        paper = papers[0]
+        authors, _ = DataBase().get_authors_of_paper(paper["result_id"])
+        with self._lock:
+            self.papers.setdefault(paper["result_id"], paper)
+            self.authors.setdefault(paper["result_id"], authors)
+            self.titles[str(id).lower()] = paper["result_id"]
+        return paper["result_id"]
+
+    def lookup(self, ids):
+        """
+        Papers and authors of several ids (result ids or titles)
+
+        Returns:
+            dict[str, tuple[dict, dict]]: id -> (paper, authors), without the unknown ids
+        """
+        self.ensure_loaded()
+        found = {}
+        for id in ids:
+            result_id = self.resolve(id)
+            if result_id is None and str(id).lower() not in self.missing:
+                result_id = self.fetch(id)
+            if result_id is not None:
+                found[id] = (self.papers[result_id], self.authors.get(result_id, {}))
+        return found
+
+
+paper_index = PaperIndex()
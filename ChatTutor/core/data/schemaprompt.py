@@ -0,0 +1,147 @@
+"""
+Compact description of the CQN tables, for the text-to-SQL prompt of `SQLQueryTutor`.
+
+The tables are described from `SQLModel.metadata` (columns, types, primary and
+foreign keys), one line per table, instead of pasting the model sources into
+every prompt. The description is compiled once, when this module is imported, and
+served from memory afterwards; `SchemaPromptCompiler.refresh` rebuilds it if the
+fingerprint of the tables changed (e.g. after models were registered later).
+"""
+
+import hashlib
+from threading import Lock
+
+from sqlmodel import SQLModel
+
+# the imports register the tables in SQLModel.metadata
+from core.data.models.Author import Author
+from core.data.models.Citations import Citations
+from core.data.models.Publication import Publication
+from core.data.models.PublicationAuthorLink import PublicationAuthorLink
+from core.data.models.PublicationCitationLink import PublicationCitationLink
+
+CQN_TABLES = (
+    "author",
+    "publication",
+    "citations",
+    "publicationauthorlink",
+    "publicationcitationlink",
+)
+
+# what the model can not guess from the columns
+TABLE_NOTES = {
+    "author": "paper authors, also use it for questions about scientists",
+    "publication": "CQN papers, result_id is the paper id",
+    "citations": "papers citing CQN papers",
+    "publicationauthorlink": "paper <-> author",
+    "publicationcitationlink": "paper <-> citation",
+}
+
+
+def column_type(column):
+    """Python type name of a column ("str", "int", ...), looking through type decorators"""
+    kind = column.type
+    kind = getattr(kind, "impl_instance", kind)
+    try:
+        return kind.python_type.__name__
+    except NotImplementedError:
+        return type(kind).__name__.lower()
+
+
+def column_signature(column):
+    """(name, type, primary key, foreign keys) of a column"""
+    foreign_keys = sorted(fk.target_fullname for fk in column.foreign_keys)
+    return (column.name, column_type(column), bool(column.primary_key), foreign_keys)
+
+
+class SchemaPromptCompiler:
+    """
+    Compiles and caches the description of some tables of a metadata.
+
+    Attributes
+    ----------
+    metadata : sqlalchemy.MetaData
+        metadata holding the tables
+    tables : tuple[str]
+        names of the tables to describe, in this order
+    notes : dict[str, str]
+        free text appended to the line of a table
+    """
+
+    def __init__(
+        self, metadata=SQLModel.metadata, tables=CQN_TABLES, notes=TABLE_NOTES
+    ):
+        self.metadata = metadata
+        self.tables = tables
+        self.notes = notes
+        self.compiled = None  # (fingerprint, prompt)
+        self._lock = Lock()
+
+    def signatures(self):
+        return [
+            (
+                name,
+                [
+                    column_signature(column)
+                    for column in self.metadata.tables[name].columns
+                ],
+            )
+            for name in self.tables
+        ]
+
+    def fingerprint(self, signatures=None):
+        """Hash of the described tables (and notes), changes whenever a model does"""
+        signatures = self.signatures() if signatures is None else signatures
+        return hashlib.sha256(
+            repr((signatures, self.notes)).encode("utf-8")
+        ).hexdigest()
+
+    def describe(self, signatures):
+        lines = []
+        for name, columns in signatures:
+            described = []
+            for column, kind, primary_key, foreign_keys in columns:
+                text = f"{column} {kind}"
+                if primary_key:
+                    text += " PK"
+                for target in foreign_keys:
+                    text += f" -> {target}"
+                described.append(text)
+            line = f"{name}({', '.join(described)})"
+            if name in self.notes:
+                line += f"  # {self.notes[name]}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def compile(self):
+        """Describes the tables, returns the description"""
+        signatures = self.signatures()
+        compiled = (self.fingerprint(signatures), self.describe(signatures))
+        with self._lock:
+            self.compiled = compiled
+        return compiled[1]
+
+    def refresh(self):
+        """Compiles the description again if the tables changed since it was compiled"""
+        signatures = self.signatures()
+        fingerprint = self.fingerprint(signatures)
+        with self._lock:
+            if self.compiled is None or self.compiled[0] != fingerprint:
+                self.compiled = (fingerprint, self.describe(signatures))
+            return self.compiled[1]
+
+    def prompt(self):
+        """The compiled description (compiled on the first call if it was not yet)"""
+        compiled = self.compiled
+        if compiled is None:
+            return self.compile()
+        return compiled[1]
+
+
+cqn_schema = SchemaPromptCompiler()
+cqn_schema.compile()
+
+
+def cqn_schema_prompt():
+    """One line per CQN table: `table(column type [PK] [-> table.column], ...)  # note`"""
+    return cqn_schema.prompt()
@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Optional
 from pydantic import BaseModel
 
 DocKey = Any
@@ -29,6 +29,7 @@ class Text(BaseModel):
     Attributes:
         text (str): text
         doc (Doc): document
+        chunk (int, optional): position of the text inside its document
 
     Args:
         BaseModel
@@ -36,3 +37,4 @@ class Text(BaseModel):
 
     text: str
     doc: Doc
+    chunk: Optional[int] = None
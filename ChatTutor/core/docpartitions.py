@@ -0,0 +1,284 @@
+"""
+Doc-partitioned retrieval, used by `VectorDatabase` for queries restricted to a list of docs.
+
+A section's `pulling_from` can list many docs; filtering on `{"doc": {"$in": docs}}`
+makes Chroma evaluate the metadata filter over the whole course collection.
+Instead, the chunks of each doc (ids, contents, metadatas and embeddings) are
+kept in memory by (collection, doc) and searched with numpy when the section is
+small enough, so a restricted query costs time proportional to the section.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+class DocBlock:
+    """
+    Every chunk of one doc of a collection
+
+    Attributes
+    ----------
+    ids : list[str]
+        chunk ids
+    documents : list[str]
+        chunk contents
+    metadatas : list[dict]
+        chunk metadatas
+    embeddings : np.ndarray
+        (n_chunks, dim) float32 matrix of the chunk embeddings
+    """
+
+    def __init__(self, ids, documents, metadatas, embeddings):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.embeddings = embeddings
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class DocPartitions:
+    """
+    Per-(collection, doc) chunk ids, plus an LRU of loaded `DocBlock`s.
+
+    Partitions are discovered lazily: the first query that names a doc looks up its
+    chunk ids with one `get` for all the unknown docs of the query, so nothing is
+    read for docs no section asks for. Docs without chunks are not remembered.
+    Written chunks are appended to the known partitions and invalidate the loaded
+    blocks of their doc.
+
+    Other processes write to the same collections, so partitions and blocks expire
+    after `ttl` seconds, and the chunk count of a collection is checked at most every
+    `check_interval` seconds: when it changed without a write of this process, every
+    partition and block of the collection is dropped.
+
+    Attributes
+    ----------
+    brute_force_limit : int
+        largest number of candidate chunks searched locally; larger sections fall
+        back to the Chroma `$in` filter
+    max_chunks : int
+        maximum number of chunks held in loaded blocks
+    ttl : float
+        seconds a partition or block is used before it is read again
+    check_interval : float
+        seconds between two checks of the chunk count of a collection
+    """
+
+    def __init__(
+        self,
+        brute_force_limit=int(os.getenv("PARTITION_BRUTE_FORCE_LIMIT", 2000)),
+        max_chunks=int(os.getenv("PARTITION_CACHE_MAX_CHUNKS", 10000)),
+        ttl=float(os.getenv("PARTITION_TTL", 600)),
+        check_interval=float(os.getenv("PARTITION_CHECK_SECONDS", 30)),
+    ):
+        self.brute_force_limit = brute_force_limit
+        self.max_chunks = max_chunks
+        self.ttl = ttl
+        self.check_interval = check_interval
+        # (collection, doc) -> (read at, list of chunk ids, set of the same ids)
+        self.partitions = {}
+        self.blocks = OrderedDict()  # (collection, doc) -> DocBlock
+        # collection -> (checked at, chunk count or None after a write)
+        self.counts = {}
+        self.block_chunks = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def group_by_doc(ids, metadatas, *columns):
+        """Splits the parallel lists of a `get` result by the "doc" metadata"""
+        groups = {}
+        for i, (id, metadata) in enumerate(zip(ids, metadatas)):
+            doc = (metadata or {}).get("doc")
+            group = groups.setdefault(doc, [[] for _ in range(len(columns) + 2)])
+            group[0].append(id)
+            group[1].append(metadata)
+            for column, values in zip(group[2:], columns):
+                column.append(values[i])
+        return groups
+
+    def check_count(self, datasource):
+        """Drops the collection's partitions if its chunk count changed behind our back"""
+        now = time.time()
+        with self._lock:
+            checked = self.counts.get(datasource.name)
+        if checked is not None and now - checked[0] < self.check_interval:
+            return
+        count = datasource.count()
+        with self._lock:
+            if checked is not None and checked[1] is not None and checked[1] != count:
+                self.drop_collection_unlocked(datasource.name)
+            self.counts[datasource.name] = (now, count)
+
+    def chunk_ids(self, datasource, docs):
+        """
+        Args:
+            datasource: collection handle
+            docs (list[str]): docs to get the chunks of
+
+        Returns:
+            dict[str, list[str]]: chunk ids of every doc
+        """
+        self.check_count(datasource)
+        now = time.time()
+        with self._lock:
+            known = {}
+            for doc in docs:
+                partition = self.partitions.get((datasource.name, doc))
+                if partition is not None and now - partition[0] < self.ttl:
+                    known[doc] = partition[1]
+        unknown = [doc for doc in docs if doc not in known]
+        if unknown:
+            page = datasource.get(
+                where={"doc": {"$in": unknown}}, include=["metadatas"]
+            )
+            groups = self.group_by_doc(page["ids"], page["metadatas"])
+            with self._lock:
+                for doc in unknown:
+                    ids = groups.get(doc, [[]])[0]
+                    known[doc] = ids
+                    # the chunks read may differ from the ones of the loaded block
+                    self.drop_block((datasource.name, doc))
+                    # a doc without chunks may not be ingested yet, ask again next time
+                    if ids:
+                        self.partitions[(datasource.name, doc)] = (now, ids, set(ids))
+                    else:
+                        self.partitions.pop((datasource.name, doc), None)
+        return known
+
+    def load_blocks(self, datasource, docs):
+        """Loaded blocks of the given docs, reading the missing ones with a single `get`"""
+        with self._lock:
+            blocks = {}
+            for doc in docs:
+                block = self.blocks.get((datasource.name, doc))
+                if block is not None and time.time() - block.loaded_at >= self.ttl:
+                    self.drop_block((datasource.name, doc))
+                    block = None
+                if block is not None:
+                    self.blocks.move_to_end((datasource.name, doc))
+                    blocks[doc] = block
+        missing = [doc for doc in docs if doc not in blocks]
+        if missing:
+            page = datasource.get(
+                where={"doc": {"$in": missing}},
+                include=["documents", "metadatas", "embeddings"],
+            )
+            groups = self.group_by_doc(
+                page["ids"], page["metadatas"], page["documents"], page["embeddings"]
+            )
+            for doc in missing:
+                ids, metadatas, documents, embeddings = groups.get(
+                    doc, [[], [], [], []]
+                )
+                blocks[doc] = DocBlock(
+                    ids, documents, metadatas, np.asarray(embeddings, dtype=np.float32)
+                )
+            with self._lock:
+                for doc in missing:
+                    self.store_block((datasource.name, doc), blocks[doc])
+        return [blocks[doc] for doc in docs]
+
+    def store_block(self, key, block):
+        old = self.blocks.pop(key, None)
+        if old is not None:
+            self.block_chunks -= len(old)
+        if len(block) > self.max_chunks:
+            return
+        self.blocks[key] = block
+        self.block_chunks += len(block)
+        while self.block_chunks > self.max_chunks:
+            _, evicted = self.blocks.popitem(last=False)
+            self.block_chunks -= len(evicted)
+
+    def search(self, datasource, docs, query_embedding, n_results, include):
+        """
+        Nearest chunks of the given docs, computed locally.
+
+        Returns:
+            query result in the chroma format (squared l2 distances, like chroma's
+            default space), or None if the docs hold more than `brute_force_limit`
+            chunks and the query should go to the database instead
+        """
+        partitions = self.chunk_ids(datasource, docs)
+        docs = [doc for doc in docs if partitions.get(doc)]
+        candidates = sum(len(partitions[doc]) for doc in docs)
+        if candidates > self.brute_force_limit:
+            return None
+
+        result = {key: [[]] for key in ["ids"] + list(include)}
+        if candidates == 0:
+            return result
+        blocks = [
+            block for block in self.load_blocks(datasource, docs) if len(block) > 0
+        ]
+        if not blocks:
+            return result
+        embeddings = np.concatenate([block.embeddings for block in blocks])
+        query = np.asarray(query_embedding, dtype=np.float32)
+        distances = ((embeddings - query) ** 2).sum(axis=1)
+        k = min(n_results, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top], kind="stable")]
+
+        # position of every candidate chunk: (block, row)
+        rows = [(block, i) for block in blocks for i in range(len(block))]
+        for position in top:
+            block, i = rows[position]
+            result["ids"][0].append(block.ids[i])
+            if "documents" in include:
+                result["documents"][0].append(block.documents[i])
+            if "metadatas" in include:
+                # a copy, the block keeps serving later queries
+                metadata = block.metadatas[i]
+                result["metadatas"][0].append(
+                    None if metadata is None else dict(metadata)
+                )
+            if "distances" in include:
+                result["distances"][0].append(float(distances[position]))
+            if "embeddings" in include:
+                result["embeddings"][0].append(block.embeddings[i].tolist())
+        return result
+
+    def drop_block(self, key):
+        block = self.blocks.pop(key, None)
+        if block is not None:
+            self.block_chunks -= len(block)
+
+    def written(self, collection_name, ids, docs):
+        """Records chunks written to a collection (keeps partitions and blocks current)"""
+        with self._lock:
+            for id, doc in zip(ids, docs):
+                partition = self.partitions.get((collection_name, doc))
+                if partition is not None and id not in partition[2]:
+                    partition[1].append(id)
+                    partition[2].add(id)
+                self.drop_block((collection_name, doc))
+            # the count changed because of this write, record the new one on the next check
+            if collection_name in self.counts:
+                self.counts[collection_name] = (self.counts[collection_name][0], None)
+
+    def drop_doc(self, collection_name, doc):
+        """Forgets the partition and block of a doc (after it was deleted)"""
+        with self._lock:
+            self.partitions.pop((collection_name, doc), None)
+            self.drop_block((collection_name, doc))
+            if collection_name in self.counts:
+                self.counts[collection_name] = (self.counts[collection_name][0], None)
+
+    def drop_collection(self, collection_name):
+        with self._lock:
+            self.drop_collection_unlocked(collection_name)
+            self.counts.pop(collection_name, None)
+
+    def drop_collection_unlocked(self, collection_name):
+        for key in [key for key in self.partitions if key[0] == collection_name]:
+            del self.partitions[key]
+        for key in [key for key in self.blocks if key[0] == collection_name]:
+            self.drop_block(key)
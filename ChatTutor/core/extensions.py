@@ -1,5 +1,6 @@
 """
-    Defines which database is used. One can choose between chroma and deeplake
+    Defines which database is used. One can choose between chroma and the local index
+    (set VECTOR_DB_PROVIDER=local)
 """
 
 from core.vectordatabase import VectorDatabase
@@ -8,8 +9,17 @@ from core.openai_tools import load_env
 
 load_env()
 
-db = VectorDatabase(os.getenv("VECTOR_DB_HOST"), "chroma", hosted=True)
-user_db = VectorDatabase(os.getenv("VECTOR_DB_HOST"), "chroma", hosted=True)
+if os.getenv("VECTOR_DB_PROVIDER", "chroma") == "local":
+    # in-process index stored in VECTOR_DB_PATH, no chroma server needed
+    db = VectorDatabase(
+        os.getenv("VECTOR_DB_PATH", "./local_index"), "local", hosted=False
+    )
+    user_db = VectorDatabase(
+        os.getenv("VECTOR_DB_PATH", "./local_index"), "local", hosted=False
+    )
+else:
+    db = VectorDatabase(os.getenv("VECTOR_DB_HOST"), "chroma", hosted=True)
+    user_db = VectorDatabase(os.getenv("VECTOR_DB_HOST"), "chroma", hosted=True)
 
 import random
 import string
@@ -49,5 +59,7 @@ def stream_text(text, chunk_size=4, asdict=True):
                 else:
                     yield d
                 d = ""
+        if d:
+            yield {"content": d} if asdict else d
 
     return generate()
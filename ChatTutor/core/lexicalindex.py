@@ -0,0 +1,194 @@
+"""
+Lexical (BM25) index of a collection, used by `VectorDatabase` for hybrid retrieval.
+
+Embedding distance is weak on exact terms (paper ids, equation names, author
+surnames); an inverted index over the same chunks catches those, and the two
+rankings are merged with reciprocal rank fusion.
+
+An index can be saved to a JSON file (the term counts of every chunk) and loaded
+back without reading or tokenizing the collection again.
+"""
+
+import json
+import math
+import os
+import re
+from collections import Counter
+from threading import Lock
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = frozenset(
+    """a an and are as at be by can do does for from has have how i in is it its me my
+    of on or that the their there these this to was what when where which who why will
+    with you your about paper papers""".split()
+)
+
+
+def tokenize(text):
+    """Lowercased word tokens of a text, without stopwords"""
+    return [
+        token for token in TOKEN_RE.findall(str(text).lower()) if token not in STOPWORDS
+    ]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Merges several rankings of ids into one.
+
+    Args:
+        rankings (list[list[str]]): ids, best first, one list per retriever
+        k (int): damping constant, 60 as in the original RRF paper
+
+    Returns:
+        list[tuple[str, float]]: (id, fused score), best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index of the chunks of one collection.
+
+    Attributes
+    ----------
+    k1 : float
+        term frequency saturation
+    b : float
+        document length normalization
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # term -> {id: term frequency}
+        self.lengths = {}  # id -> number of tokens
+        self.terms = {}  # id -> set of distinct terms
+        self.docs = {}  # id -> value of the "doc" metadata
+        self.total_length = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, ids, documents, docs=None):
+        """
+        Indexes (or re-indexes) chunks
+
+        Args:
+            ids (list[str]): chunk ids
+            documents (list[str]): chunk contents
+            docs (list[str], optional): "doc" metadata of the chunks, used by `from_doc` filters
+        """
+        docs = docs or [None] * len(ids)
+        with self._lock:
+            for id, document, doc in zip(ids, documents, docs):
+                self.add_counts(id, Counter(tokenize(document)), doc)
+
+    def add_counts(self, id, counts, doc):
+        """Indexes a chunk given its term counts (under the lock, or before the index is shared)"""
+        self.remove_unlocked(id)
+        for term, tf in counts.items():
+            self.postings.setdefault(term, {})[id] = tf
+        length = sum(counts.values())
+        self.lengths[id] = length
+        self.terms[id] = set(counts)
+        self.docs[id] = doc
+        self.total_length += length
+
+    def save(self, path):
+        """Atomically writes the index to `path`"""
+        with self._lock:
+            chunks = {id: {} for id in self.lengths}
+            for term, postings in self.postings.items():
+                for id, tf in postings.items():
+                    chunks[id][term] = tf
+            data = {
+                "k1": self.k1,
+                "b": self.b,
+                "chunks": [
+                    [id, self.docs.get(id), counts] for id, counts in chunks.items()
+                ],
+            }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Index saved by `save`, or None if there is no (readable) file at `path`"""
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        index = cls(k1=data["k1"], b=data["b"])
+        for id, doc, counts in data["chunks"]:
+            index.add_counts(id, counts, doc)
+        return index
+
+    def remove(self, ids):
+        with self._lock:
+            for id in ids:
+                self.remove_unlocked(id)
+
+    def remove_unlocked(self, id):
+        if id not in self.lengths:
+            return
+        for term in self.terms.pop(id):
+            postings = self.postings[term]
+            postings.pop(id, None)
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(id)
+        self.docs.pop(id, None)
+
+    def search(self, query, n_results, from_doc=None):
+        """
+        Args:
+            query (str): query text
+            n_results (int): number of results
+            from_doc (str | list[str], optional): only return chunks of these docs
+
+        Returns:
+            list[tuple[str, float]]: (id, BM25 score), best first
+        """
+        if from_doc is not None and isinstance(from_doc, str):
+            from_doc = [from_doc]
+        allowed = set(from_doc) if from_doc else None
+        query_terms = set(tokenize(query))
+        scores = {}
+        with self._lock:
+            n = len(self.lengths)
+            if n == 0:
+                return []
+            average_length = self.total_length / n
+            for term in query_terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for id, tf in postings.items():
+                    if allowed is not None and self.docs.get(id) not in allowed:
+                        continue
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self.lengths[id] / average_length
+                    )
+                    scores[id] = scores.get(id, 0.0) + idf * tf * (self.k1 + 1) / (
+                        tf + norm
+                    )
+        return sorted(scores.items(), key=lambda item: -item[1])[:n_results]
+
+    def coverage(self, id, query):
+        """Share of the distinct terms of a chunk that also appear in the query"""
+        with self._lock:
+            terms = self.terms.get(id)
+        if not terms:
+            return 0.0
+        return len(terms & set(tokenize(query))) / len(terms)
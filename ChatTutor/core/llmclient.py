@@ -0,0 +1,653 @@
+"""
+LLM client shared by the tutors: every chat completion (OpenAI or Gemini) goes through `llm`.
+
+A call is given a list of models, tried in order, followed by the fallback models
+(LLM_FALLBACK_MODELS) if it asks for them with `fallback=True` - a caller that pins
+a model gets that model or an error. On top of the plain fallback:
+
+- deadline: the whole call (retries included) has `deadline` seconds, every provider
+  request gets the time that is left as its timeout
+- hedging: when the current model has not answered (or, for streams, sent its first
+  token) after the LLM_HEDGE_PERCENTILE of its recent latencies, the next model is
+  started as well and the first answer wins; a model with too few recorded
+  latencies is not hedged. The losing requests are cancelled: a queued one never
+  starts, a stream is closed as soon as its thread gets control back (a blocking
+  completion can not be interrupted, its answer is discarded)
+- circuit breaker: a provider that failed BREAKER_FAILURES times in a row is skipped
+  for BREAKER_RESET_SECONDS, then one probe request decides whether it is back
+- retry: when every model failed on transient errors (rate limits, timeouts,
+  unavailable), the round is retried after an exponential backoff with jitter
+
+So one slow or failing provider costs a hedge delay instead of stalling every answer.
+"""
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from threading import Event, Lock
+
+import google.generativeai as genai
+import numpy as np
+import openai
+from google.api_core import exceptions as google_exceptions
+
+from core.openai_tools import OPENAI_DEFAULT_MODEL
+from core.tracing import annotate, in_context, span
+
+GEMINI_DEFAULT_MODEL = "gemini-pro"
+
+# seconds a completion may take, and a stream may take to send its first token
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", 60))
+LLM_FIRST_TOKEN_DEADLINE = float(os.getenv("LLM_FIRST_TOKEN_DEADLINE", 30))
+# latency percentile of a model after which the next model is started
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 95))
+# models tried after the requested ones, by the calls made with fallback=True
+LLM_FALLBACK_MODELS = os.getenv(
+    "LLM_FALLBACK_MODELS", f"{GEMINI_DEFAULT_MODEL},{OPENAI_DEFAULT_MODEL}"
+).split(",")
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", 30))
+
+# failures of the provider (not of the request), worth a retry and counted by the breakers
+TRANSIENT_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    TimeoutError,
+    asyncio.TimeoutError,
+)
+
+
+class LLMUnavailable(Exception):
+    """Every model failed, was skipped by its breaker, or the deadline passed"""
+
+    def __init__(self, errors):
+        self.errors = errors  # list of (model, exception)
+        super().__init__(
+            "no model answered: "
+            + (
+                ", ".join(f"{model}: {e!r}" for model, e in errors)
+                or "every circuit is open"
+            )
+        )
+
+    @property
+    def transient(self):
+        return bool(self.errors) and all(
+            isinstance(e, TRANSIENT_ERRORS) for _, e in self.errors
+        )
+
+
+class HedgeLost(Exception):
+    """The round a request belongs to was decided (or timed out) before it finished"""
+
+
+class CircuitBreaker:
+    """
+    Consecutive failures of one provider
+
+    Attributes
+    ----------
+    failures : int
+        consecutive failures that open the breaker
+    reset_after : float
+        seconds the breaker stays open before a probe request is let through
+    """
+
+    def __init__(self, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET_SECONDS):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.failed = 0
+        self.opened_at = None
+        self.probing = False
+        self._lock = Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.time() - self.opened_at < self.reset_after:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """Whether a request may be sent (in half-open state, only the probe)"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.reset_after:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failed = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failed += 1
+            if self.probing or self.failed >= self.failures:
+                self.opened_at = time.time()
+            self.probing = False
+
+    def release(self):
+        """The request let through was cancelled before it said anything about the provider"""
+        with self._lock:
+            self.probing = False
+
+
+class LatencyTracker:
+    """Recent latencies per (model, kind of call), for the hedge delays"""
+
+    def __init__(self, window=200, min_samples=20, min_delay=0.5):
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.samples = {}
+        self._lock = Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def hedge_delay(self, key, percentile=LLM_HEDGE_PERCENTILE):
+        """
+        Seconds to wait for `key` before starting the next model, None (do not hedge)
+        until `min_samples` latencies were recorded
+        """
+        with self._lock:
+            samples = list(self.samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return max(self.min_delay, float(np.percentile(samples, percentile)))
+
+
+@lru_cache(maxsize=None)
+def get_genai_model(model_name=GEMINI_DEFAULT_MODEL):
+    """Gemini client shared by every call (it holds no conversation state)"""
+    return genai.GenerativeModel(model_name)
+
+
+class OpenAIProvider:
+    name = "openai"
+
+    @staticmethod
+    def arguments(model, messages, temperature, timeout, params):
+        arguments = dict(
+            model=model, messages=messages, request_timeout=timeout, **params
+        )
+        if temperature is not None:
+            arguments["temperature"] = temperature
+        return arguments
+
+    def complete(self, model, messages, temperature, timeout, parts=None, **params):
+        response = openai.ChatCompletion.create(
+            **self.arguments(model, messages, temperature, timeout, params)
+        )
+        return response.choices[0].message.content
+
+    def stream(self, model, messages, temperature, timeout, parts=None, **params):
+        response = openai.ChatCompletion.create(
+            stream=True, **self.arguments(model, messages, temperature, timeout, params)
+        )
+        for chunk in response:
+            yield chunk["choices"][0]["delta"]
+
+    async def astream(
+        self, model, messages, temperature, timeout, parts=None, **params
+    ):
+        response = await openai.ChatCompletion.acreate(
+            stream=True, **self.arguments(model, messages, temperature, timeout, params)
+        )
+        async for chunk in response:
+            yield chunk["choices"][0]["delta"]
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    @staticmethod
+    def arguments(messages, temperature, timeout, parts):
+        arguments = dict(
+            contents=parts or [message["content"] for message in messages],
+            request_options={"timeout": timeout},
+        )
+        if temperature is not None:
+            arguments["generation_config"] = {"temperature": temperature}
+        return arguments
+
+    @staticmethod
+    def delta(chunk):
+        try:
+            return {"content": chunk.text}
+        except:
+            return {"content": "~"}
+
+    def complete(self, model, messages, temperature, timeout, parts=None, **params):
+        response = get_genai_model(model).generate_content(
+            **self.arguments(messages, temperature, timeout, parts)
+        )
+        response.resolve()
+        return response.text
+
+    def stream(self, model, messages, temperature, timeout, parts=None, **params):
+        # same deltas as the OpenAI stream: role, content, then {} as end of message
+        response = get_genai_model(model).generate_content(
+            stream=True, **self.arguments(messages, temperature, timeout, parts)
+        )
+        yield {"role": "assistant", "content": ""}
+        for chunk in response:
+            yield self.delta(chunk)
+        yield {}
+
+    async def astream(
+        self, model, messages, temperature, timeout, parts=None, **params
+    ):
+        response = await get_genai_model(model).generate_content_async(
+            stream=True, **self.arguments(messages, temperature, timeout, parts)
+        )
+        yield {"role": "assistant", "content": ""}
+        async for chunk in response:
+            yield self.delta(chunk)
+        yield {}
+
+
+def first_token(deltas, lost=None):
+    """
+    Pulls deltas up to the first one with content, returns (pulled deltas, rest).
+    Closes the stream and raises `HedgeLost` if `lost` gets set meanwhile.
+    """
+    pulled = []
+    for delta in deltas:
+        if lost is not None and lost.is_set():
+            deltas.close()
+            raise HedgeLost()
+        pulled.append(delta)
+        if delta.get("content") or not delta:
+            break
+    return pulled, deltas
+
+
+async def afirst_token(deltas):
+    pulled = []
+    async for delta in deltas:
+        pulled.append(delta)
+        if delta.get("content") or not delta:
+            break
+    return pulled, deltas
+
+
+def close_stream(future):
+    """Done callback of a stream that lost the race"""
+    if not future.cancelled() and future.exception() is None:
+        future.result()[1].close()
+
+
+class LLMClient:
+    """
+    Chat completions over several models and providers, with deadlines, hedging,
+    circuit breakers and retries (see the module docstring).
+
+    Attributes
+    ----------
+    providers : dict[str, provider]
+        "openai" and "gemini"
+    breakers : dict[str, CircuitBreaker]
+        one per provider
+    latencies : LatencyTracker
+        latencies the hedge delays come from
+    fallback_models : list[str]
+        models tried after the requested ones, by the calls made with fallback=True
+    """
+
+    def __init__(
+        self,
+        fallback_models=LLM_FALLBACK_MODELS,
+        max_retries=LLM_MAX_RETRIES,
+        base_delay=0.5,
+        max_delay=8.0,
+        max_workers=int(os.getenv("LLM_WORKERS", 32)),
+    ):
+        self.providers = {"openai": OpenAIProvider(), "gemini": GeminiProvider()}
+        self.breakers = {name: CircuitBreaker() for name in self.providers}
+        self.latencies = LatencyTracker()
+        self.fallback_models = [model for model in fallback_models if model]
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # the requests are blocking, hedged ones run side by side in this pool
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="llm_client"
+        )
+
+    def provider(self, model):
+        return self.providers["gemini" if model.startswith("gemini") else "openai"]
+
+    def candidates(self, models, fallback=False):
+        candidates = []
+        for model in list(models) + (self.fallback_models if fallback else []):
+            if model not in candidates:
+                candidates.append(model)
+        return candidates
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def failed(self, provider, error):
+        if isinstance(error, TRANSIENT_ERRORS):
+            self.breakers[provider.name].failure()
+        else:
+            # the provider answered, the request was wrong (e.g. too long for the model)
+            self.breakers[provider.name].success()
+
+    def attempt(self, model, call, end, kind, lost):
+        """
+        Runs `call(provider, model, timeout, lost)`, feeding the breaker and the
+        latencies; `lost` is set once the round is decided without this request
+        """
+        provider = self.provider(model)
+        start = time.time()
+        try:
+            if lost.is_set():
+                raise HedgeLost()
+            with span("llm.attempt", model=model, kind=kind):
+                result = call(provider, model, max(end - start, 0.1), lost)
+        except HedgeLost:
+            self.breakers[provider.name].release()
+            raise
+        except Exception as e:
+            self.failed(provider, e)
+            raise
+        self.breakers[provider.name].success()
+        self.latencies.record((model, kind), time.time() - start)
+        return result
+
+    def hedged(self, models, call, end, kind, on_lost=None):
+        """
+        One round over the candidate models: starts the first allowed one, then the
+        next one when it fails or outlives its hedge delay.
+
+        Returns:
+            (result, model) of the first model that answered
+        """
+        queue = list(models)
+        pending = {}
+        errors = []
+        hedge_at = None
+        lost = Event()
+
+        def launch():
+            nonlocal hedge_at
+            while queue:
+                model = queue.pop(0)
+                if not self.breakers[self.provider(model).name].allow():
+                    print(f"llm: {model} skipped, circuit open")
+                    continue
+                future = self.pool.submit(
+                    in_context(self.attempt), model, call, end, kind, lost
+                )
+                pending[future] = model
+                delay = self.latencies.hedge_delay((model, kind))
+                hedge_at = None if delay is None else time.time() + delay
+                return
+
+        def cancel_losers():
+            lost.set()
+            for loser, model in pending.items():
+                if loser.cancel():
+                    # never started, the breaker may have let it through as its probe
+                    self.breakers[self.provider(model).name].release()
+                elif on_lost is not None:
+                    loser.add_done_callback(on_lost)
+
+        launch()
+        while pending and time.time() < end:
+            timeout = end - time.time()
+            if queue and hedge_at is not None:
+                timeout = min(timeout, max(hedge_at - time.time(), 0))
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if queue and hedge_at is not None and time.time() >= hedge_at:
+                    print(f"llm: {pending[next(iter(pending))]} is slow, hedging")
+                    launch()
+                continue
+            for future in done:
+                model = pending.pop(future)
+                if future.exception() is not None:
+                    print(f"llm: {model} failed: {future.exception()!r}")
+                    errors.append((model, future.exception()))
+                    continue
+                annotate(model=model, hedged=len(errors) + len(pending) > 0)
+                cancel_losers()
+                return future.result(), model
+            if not pending:
+                launch()
+        if pending:
+            errors.append(
+                (pending[next(iter(pending))], TimeoutError("deadline exceeded"))
+            )
+            cancel_losers()
+        raise LLMUnavailable(errors)
+
+    def call(self, models, call, deadline, kind, on_lost=None, fallback=False):
+        """`hedged` rounds until one succeeds, retried on transient failures within the deadline"""
+        end = time.time() + deadline
+        models = self.candidates(models, fallback)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.hedged(models, call, end, kind, on_lost)
+            except LLMUnavailable as e:
+                delay = self.backoff(attempt)
+                if (
+                    attempt == self.max_retries
+                    or not e.transient
+                    or time.time() + delay >= end
+                ):
+                    raise
+                print(f"llm: every model failed, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def complete(
+        self,
+        messages,
+        models=(OPENAI_DEFAULT_MODEL,),
+        temperature=None,
+        deadline=LLM_DEADLINE,
+        parts=None,
+        fallback=False,
+        **params,
+    ):
+        """
+        Args:
+            messages (list[dict]): OpenAI style messages
+            models (Sequence[str]): models to try first, in order
+            temperature (float, optional): provider default if None
+            deadline (float): seconds for the whole call
+            parts (list[str], optional): what Gemini is sent instead of the message contents
+            fallback (bool): also try the fallback models after `models`
+            **params: other OpenAI parameters (frequency_penalty, ...)
+
+        Returns:
+            str: the answer
+        """
+
+        def call(provider, model, timeout, lost):
+            return provider.complete(
+                model, messages, temperature, timeout, parts, **params
+            )
+
+        answer, _ = self.call(models, call, deadline, "complete", fallback=fallback)
+        return answer
+
+    def stream(
+        self,
+        messages,
+        models=(OPENAI_DEFAULT_MODEL,),
+        temperature=None,
+        deadline=LLM_FIRST_TOKEN_DEADLINE,
+        parts=None,
+        fallback=False,
+        **params,
+    ):
+        """
+        Starts a streamed answer, returns once its first token arrived (the deadline
+        and the hedging apply up to there). Arguments as in `complete`.
+
+        Returns:
+            Iterator[dict]: OpenAI style deltas, ending with the empty delta
+        """
+
+        def call(provider, model, timeout, lost):
+            return first_token(
+                provider.stream(model, messages, temperature, timeout, parts, **params),
+                lost,
+            )
+
+        (pulled, deltas), model = self.call(
+            models, call, deadline, "stream", close_stream, fallback
+        )
+        return self.deltas(pulled, deltas, model)
+
+    def deltas(self, pulled, deltas, model):
+        yield from pulled
+        try:
+            yield from deltas
+        except Exception as e:
+            self.failed(self.provider(model), e)
+            raise
+
+    async def aattempt(self, model, call, end, kind):
+        provider = self.provider(model)
+        start = time.time()
+        try:
+            with span("llm.attempt", model=model, kind=kind):
+                result = await asyncio.wait_for(
+                    call(provider, model, max(end - start, 0.1)), max(end - start, 0.1)
+                )
+        except asyncio.CancelledError:
+            self.breakers[provider.name].release()
+            raise
+        except Exception as e:
+            self.failed(provider, e)
+            raise
+        self.breakers[provider.name].success()
+        self.latencies.record((model, kind), time.time() - start)
+        return result
+
+    async def ahedged(self, models, call, end, kind):
+        """`hedged` on the event loop: the losing requests are cancelled"""
+        queue = list(models)
+        pending = {}
+        errors = []
+        hedge_at = None
+
+        def launch():
+            nonlocal hedge_at
+            while queue:
+                model = queue.pop(0)
+                if not self.breakers[self.provider(model).name].allow():
+                    print(f"llm: {model} skipped, circuit open")
+                    continue
+                task = asyncio.ensure_future(self.aattempt(model, call, end, kind))
+                pending[task] = model
+                delay = self.latencies.hedge_delay((model, kind))
+                hedge_at = None if delay is None else time.time() + delay
+                return
+
+        try:
+            launch()
+            while pending and time.time() < end:
+                timeout = end - time.time()
+                if queue and hedge_at is not None:
+                    timeout = min(timeout, max(hedge_at - time.time(), 0))
+                done, _ = await asyncio.wait(
+                    pending, timeout=timeout, return_when=FIRST_COMPLETED
+                )
+                if not done:
+                    if queue and hedge_at is not None and time.time() >= hedge_at:
+                        print(f"llm: {pending[next(iter(pending))]} is slow, hedging")
+                        launch()
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    if task.exception() is not None:
+                        print(f"llm: {model} failed: {task.exception()!r}")
+                        errors.append((model, task.exception()))
+                        continue
+                    annotate(model=model, hedged=len(errors) + len(pending) > 0)
+                    return task.result(), model
+                if not pending:
+                    launch()
+            if pending:
+                errors.append(
+                    (pending[next(iter(pending))], TimeoutError("deadline exceeded"))
+                )
+            raise LLMUnavailable(errors)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def astream(
+        self,
+        messages,
+        models=(OPENAI_DEFAULT_MODEL,),
+        temperature=None,
+        deadline=LLM_FIRST_TOKEN_DEADLINE,
+        parts=None,
+        fallback=False,
+        **params,
+    ):
+        """Async version of `stream`, returns an async iterator of deltas"""
+
+        async def call(provider, model, timeout):
+            return await afirst_token(
+                provider.astream(model, messages, temperature, timeout, parts, **params)
+            )
+
+        end = time.time() + deadline
+        models = self.candidates(models, fallback)
+        for attempt in range(self.max_retries + 1):
+            try:
+                (pulled, deltas), model = await self.ahedged(
+                    models, call, end, "stream"
+                )
+                return self.adeltas(pulled, deltas, model)
+            except LLMUnavailable as e:
+                delay = self.backoff(attempt)
+                if (
+                    attempt == self.max_retries
+                    or not e.transient
+                    or time.time() + delay >= end
+                ):
+                    raise
+                print(f"llm: every model failed, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def adeltas(self, pulled, deltas, model):
+        for delta in pulled:
+            yield delta
+        try:
+            async for delta in deltas:
+                yield delta
+        except Exception as e:
+            self.failed(self.provider(model), e)
+            raise
+
+
+llm = LLMClient()
@@ -0,0 +1,431 @@
+"""
+In-process vector index, used by `VectorDatabase` when `db_provider` is 'local'.
+
+Each collection is stored in three files inside the index folder:
+`<name>.f32` holds the (normalized) embeddings as a raw float32 matrix that is
+memory-mapped for queries, `<name>.json` holds a snapshot of the ids, documents and
+metadatas, and `<name>.log` the entries written since the snapshot, one JSON line
+each, so a write only appends what it changed.
+Collections expose the subset of the Chroma `Collection` interface used by
+ChatTutor (`query`, `get`, `add`, `upsert`, `count`, `delete`), so the rest of the
+code does not care which provider answers.
+"""
+
+import json
+import os
+from threading import Lock, RLock
+
+import numpy as np
+
+
+class LocalCollection:
+    """
+    Vector collection held in memory and persisted to disk.
+
+    Queries are a single matrix-vector product over the rows that pass the `doc`
+    filter, followed by a partial sort. Metadata filters are evaluated on integer
+    codes of the metadata values, one array per filtered key. Embeddings are
+    normalized when written, so the distances returned are squared L2 distances between unit vectors
+    (`2 - 2 * cosine`), the same scale Chroma reports for OpenAI embeddings.
+
+    Attributes
+    ----------
+    name : str
+        name of the collection
+    path : str
+        folder the collection files are stored in
+    embedding_function : Callable[[list[str]], list[list[float]]]
+        embeds documents/queries given without embeddings
+    """
+
+    def __init__(self, name, path, embedding_function=None):
+        self.name = name
+        self.path = path
+        self.embedding_function = embedding_function
+        self.vectors_path = os.path.join(path, f"{name}.f32")
+        self.meta_path = os.path.join(path, f"{name}.json")
+        self.log_path = os.path.join(path, f"{name}.log")
+        self._lock = RLock()
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.dim = None
+        self.positions = {}
+        self.columns = {}  # metadata key -> (value codes of the rows, value -> code)
+        self.load()
+
+    def load(self):
+        """Reads the collection from disk (an empty collection if it was never written)"""
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            self.ids = meta["ids"]
+            self.documents = meta["documents"]
+            self.metadatas = meta["metadatas"]
+            self.dim = meta["dim"]
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self.logged = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r") as f:
+                for line in f:
+                    try:
+                        id, document, metadata = json.loads(line)
+                    except ValueError:
+                        break  # line cut by an interrupted write
+                    self.set_entry(id, document, metadata)
+                    self.logged += 1
+        self.columns = {}
+        self.map_vectors()
+
+    def set_entry(self, id, document, metadata):
+        """Updates the entry of `id`, or appends it; returns whether it was appended"""
+        position = self.positions.get(id)
+        if position is not None:
+            self.documents[position] = document
+            self.metadatas[position] = metadata
+            return False
+        self.positions[id] = len(self.ids)
+        self.ids.append(id)
+        self.documents.append(document)
+        self.metadatas.append(metadata)
+        return True
+
+    def map_vectors(self):
+        """Memory-maps the first `count()` rows of the vectors file"""
+        if self.dim is None or len(self.ids) == 0:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            return
+        # rows past len(ids) come from an interrupted write and are ignored
+        self.vectors = np.memmap(
+            self.vectors_path,
+            dtype=np.float32,
+            mode="r",
+            shape=(len(self.ids), self.dim),
+        )
+
+    def save_meta(self):
+        """Atomically rewrites the snapshot of the ids, documents and metadatas, and
+        empties the log"""
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "dim": self.dim,
+                    "ids": self.ids,
+                    "documents": self.documents,
+                    "metadatas": self.metadatas,
+                },
+                f,
+            )
+        os.replace(tmp_path, self.meta_path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.logged = 0
+
+    def append_meta(self, entries):
+        """Appends (id, document, metadata) entries to the log"""
+        with open(self.log_path, "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+        self.logged += len(entries)
+
+    @staticmethod
+    def normalize(embeddings):
+        """float32 matrix of the embeddings, with rows scaled to unit length"""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim == 1:
+            matrix = matrix[None, :]
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def embed(self, texts):
+        if self.embedding_function is None:
+            raise Exception(f"collection {self.name} has no embedding function")
+        return self.embedding_function(list(texts))
+
+    def count(self):
+        return len(self.ids)
+
+    def column(self, key):
+        """Integer codes of the `key` metadata of every row, and the code of each value"""
+        column = self.columns.get(key)
+        if column is None or len(column[0]) != len(self.ids):
+            codes = {}
+            values = [
+                metadata.get(key) if metadata else None for metadata in self.metadatas
+            ]
+            column = (
+                np.fromiter(
+                    (codes.setdefault(value, len(codes)) for value in values),
+                    dtype=np.int64,
+                    count=len(values),
+                ),
+                codes,
+            )
+            self.columns[key] = column
+        return column
+
+    def mask(self, where):
+        """
+        Boolean mask of the rows matching a Chroma-style `where` filter. Supports
+        `{key: value}`, `{key: {"$eq": value}}`, `{key: {"$ne": value}}` and
+        `{key: {"$in": [values]}}`, combined with AND when several keys are given.
+        """
+        if not where:
+            return None
+        mask = np.ones(len(self.ids), dtype=bool)
+        for key, condition in where.items():
+            if isinstance(condition, dict):
+                ((op, expected),) = condition.items()
+            else:
+                op, expected = "$eq", condition
+            if op in ("$eq", "$ne"):
+                expected = [expected]
+            elif op not in ("$in", "$nin"):
+                raise Exception(f"unsupported where operator {op}")
+            values, codes = self.column(key)
+            matches = np.isin(
+                values, [codes[value] for value in expected if value in codes]
+            )
+            if op in ("$ne", "$nin"):
+                matches = ~matches
+            mask &= matches
+        return mask
+
+    def query(
+        self,
+        query_embeddings=None,
+        query_texts=None,
+        n_results=10,
+        where=None,
+        include=["metadatas", "documents", "distances"],
+    ):
+        """Nearest neighbours of each query, in the Chroma `QueryResult` format"""
+        if query_embeddings is None:
+            if isinstance(query_texts, str):
+                query_texts = [query_texts]
+            query_embeddings = self.embed(query_texts)
+        queries = self.normalize(query_embeddings)
+
+        with self._lock:
+            vectors = self.vectors
+            rows = np.arange(len(self.ids))
+            mask = self.mask(where)
+            if mask is not None:
+                rows = rows[mask]
+            candidates = vectors[rows] if mask is not None else vectors
+            result = {key: [] for key in ["ids"] + list(include)}
+            for query in queries:
+                if len(rows) == 0:
+                    order = rows
+                    similarities = np.zeros(0, dtype=np.float32)
+                else:
+                    similarities = candidates @ query
+                    k = min(n_results, len(rows))
+                    top = np.argpartition(-similarities, k - 1)[:k]
+                    top = top[np.argsort(-similarities[top], kind="stable")]
+                    order = rows[top]
+                    similarities = similarities[top]
+                self.fill(
+                    result, order, include, distances=2 - 2 * similarities, nested=True
+                )
+            return result
+
+    def fill(self, result, rows, include, distances=None, nested=False):
+        """Adds the fields in `include` of the given rows to a result dict"""
+        fields = {"ids": [self.ids[i] for i in rows]}
+        if "documents" in include:
+            fields["documents"] = [self.documents[i] for i in rows]
+        if "metadatas" in include:
+            # copies, like chroma: callers modify the results
+            fields["metadatas"] = [
+                None if self.metadatas[i] is None else dict(self.metadatas[i])
+                for i in rows
+            ]
+        if "embeddings" in include:
+            fields["embeddings"] = [self.vectors[i].tolist() for i in rows]
+        if "distances" in include and distances is not None:
+            fields["distances"] = [float(distance) for distance in distances]
+        for key, value in fields.items():
+            if nested:
+                result[key].append(value)
+            else:
+                result[key] = value
+        return result
+
+    def get(
+        self,
+        ids=None,
+        where=None,
+        limit=None,
+        offset=None,
+        include=["metadatas", "documents"],
+    ):
+        """Entries by id and/or `where` filter, in the Chroma `GetResult` format"""
+        with self._lock:
+            if ids is not None:
+                rows = [self.positions[id] for id in ids if id in self.positions]
+            else:
+                rows = list(range(len(self.ids)))
+            mask = self.mask(where)
+            if mask is not None:
+                rows = [i for i in rows if mask[i]]
+            rows = rows[offset or 0 :]
+            if limit is not None:
+                rows = rows[:limit]
+            result = {
+                "ids": [],
+                "embeddings": None,
+                "documents": None,
+                "metadatas": None,
+            }
+            return self.fill(result, rows, include)
+
+    def upsert(self, ids, embeddings=None, metadatas=None, documents=None):
+        """Inserts new entries and overwrites the ones whose id already exists"""
+        if embeddings is None:
+            embeddings = self.embed(documents)
+        vectors = self.normalize(embeddings)
+        metadatas = metadatas or [None] * len(ids)
+        documents = documents or [None] * len(ids)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise Exception(
+                    f"collection {self.name} holds {self.dim}-d embeddings, got {vectors.shape[1]}-d"
+                )
+
+            # chroma rejects repeated ids, here the last entry of an id wins
+            last = {id: i for i, id in enumerate(ids)}
+            entries = []
+            appended = []
+            updated = {}
+            for i, (id, vector, metadata, document) in enumerate(
+                zip(ids, vectors, metadatas, documents)
+            ):
+                if last[id] != i:
+                    continue
+                entries.append((id, document, metadata))
+                if self.set_entry(id, document, metadata):
+                    appended.append(vector)
+                else:
+                    updated[self.positions[id]] = vector
+
+            old_count = len(self.ids) - len(appended)
+            # drop rows left by an interrupted write before appending
+            mode = "r+b" if os.path.exists(self.vectors_path) else "w+b"
+            with open(self.vectors_path, mode) as f:
+                f.truncate(old_count * self.dim * 4)
+                f.seek(0, os.SEEK_END)
+                if appended:
+                    f.write(np.stack(appended).astype(np.float32).tobytes())
+                for position, vector in updated.items():
+                    if position < old_count:
+                        f.seek(position * self.dim * 4)
+                        f.write(vector.astype(np.float32).tobytes())
+            # the snapshot is rewritten once the log outgrows it (overwrites only)
+            if os.path.exists(self.meta_path) and self.logged + len(entries) <= len(
+                self.ids
+            ):
+                self.append_meta(entries)
+            else:
+                self.save_meta()
+            self.columns = {}
+            self.map_vectors()
+
+    def add(self, ids, embeddings=None, metadatas=None, documents=None):
+        """Same as `upsert`"""
+        self.upsert(
+            ids, embeddings=embeddings, metadatas=metadatas, documents=documents
+        )
+
+    def delete(self, ids=None, where=None):
+        """Removes entries by id and/or `where` filter and compacts the files"""
+        with self._lock:
+            removed = set(self.get(ids=ids, where=where, include=[])["ids"])
+            if not removed:
+                return
+            keep = [i for i, id in enumerate(self.ids) if id not in removed]
+            vectors = np.array(self.vectors[keep], dtype=np.float32)
+            self.ids = [self.ids[i] for i in keep]
+            self.documents = [self.documents[i] for i in keep]
+            self.metadatas = [self.metadatas[i] for i in keep]
+            self.positions = {id: i for i, id in enumerate(self.ids)}
+            self.vectors = None
+            with open(self.vectors_path, "wb") as f:
+                f.write(vectors.tobytes())
+            self.save_meta()
+            self.columns = {}
+            self.map_vectors()
+
+
+class LocalVectorIndex:
+    """
+    Client-like entry point of the local index, a folder of `LocalCollection`s.
+    Mirrors the parts of the Chroma client used by `VectorDatabase`.
+
+    Attributes
+    ----------
+    path : str
+        folder the collections are stored in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._collections = {}
+        self._lock = Lock()
+
+    def get_or_create_collection(self, name, embedding_function=None):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = LocalCollection(name, self.path, embedding_function)
+                self._collections[name] = collection
+            elif embedding_function is not None:
+                collection.embedding_function = embedding_function
+            return collection
+
+    def stored(self, name):
+        """Whether the folder holds a snapshot of collection `name`; its vectors file
+        tells it apart from other JSON files dropped in the folder"""
+        return os.path.exists(
+            os.path.join(self.path, f"{name}.json")
+        ) and os.path.exists(os.path.join(self.path, f"{name}.f32"))
+
+    def get_collection(self, name, embedding_function=None):
+        if name not in self._collections and not self.stored(name):
+            raise ValueError(f"Collection {name} does not exist.")
+        return self.get_or_create_collection(name, embedding_function)
+
+    def list_collections(self):
+        names = {
+            file[: -len(".json")]
+            for file in os.listdir(self.path)
+            if file.endswith(".json") and self.stored(file[: -len(".json")])
+        }
+        names.update(self._collections.keys())
+        return [self.get_or_create_collection(name) for name in sorted(names)]
+
+    def delete_collection(self, name):
+        with self._lock:
+            self._collections.pop(name, None)
+            for suffix in (".json", ".log", ".f32"):
+                file = os.path.join(self.path, f"{name}{suffix}")
+                if os.path.exists(file):
+                    os.remove(file)
+
+
+_indexes = {}
+_indexes_lock = Lock()
+
+
+def open_local_index(path):
+    """One `LocalVectorIndex` per folder and process, so every user sees the same writes"""
+    path = os.path.abspath(path)
+    with _indexes_lock:
+        if path not in _indexes:
+            _indexes[path] = LocalVectorIndex(path)
+        return _indexes[path]
@@ -186,14 +186,28 @@ def parse_pdf(file_contents: str, doc: Doc, chunk_chars: int, overlap: int) -> L
             pg = "-".join([pages[0], pages[-1]])
 
             # print(split[:chunk_chars])
-            text = [Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc)]
+            text = [
+                Text(
+                    text=split[:chunk_chars],
+                    name=f"{doc.docname} pages {pg}",
+                    doc=doc,
+                    chunk=len(texts),
+                )
+            ]
             # database.add_texts_chroma(text)
             texts.append(text[0])
             split = split[chunk_chars - overlap :]
             pages = [str(i + 1)]
     if len(split) > overlap:
         pg = "-".join([pages[0], pages[-1]])
-        texts.append(Text(text=split[:chunk_chars], name=f"{doc.docname} pages {pg}", doc=doc))
+        texts.append(
+            Text(
+                text=split[:chunk_chars],
+                name=f"{doc.docname} pages {pg}",
+                doc=doc,
+                chunk=len(texts),
+            )
+        )
     # pdfFileObj.close()
     return texts
 
@@ -263,6 +277,7 @@ def texts_from_str(text_str: str, doc: Doc, chunk_chars: int, overlap: int):
                 text=text_str,
                 name=f"{doc.docname} chunk {index}",
                 doc=doc,
+                chunk=index,
             )
         )
         return texts
@@ -273,6 +288,7 @@ def texts_from_str(text_str: str, doc: Doc, chunk_chars: int, overlap: int):
                 text=text_str[:chunk_chars],
                 name=f"{doc.docname} chunk {index}",
                 doc=doc,
+                chunk=index,
             )
         )
         index += 1
@@ -284,6 +300,7 @@ def texts_from_str(text_str: str, doc: Doc, chunk_chars: int, overlap: int):
                 text=text_str[:chunk_chars],
                 name=f"{doc.docname} pages {index}",
                 doc=doc,
+                chunk=index,
             )
         )
     return texts
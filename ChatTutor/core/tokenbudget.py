@@ -0,0 +1,120 @@
+"""
+Token counting and truncation shared by the tutors, the ingestion pipeline and the scripts.
+
+Encoders are loaded once per process, truncation is a single encode-slice-decode,
+and the token counts of conversation messages are memoized by content hash, so
+re-counting the same conversation on every turn costs a dictionary lookup per message.
+"""
+
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    """Process wide tiktoken encoder"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def encode(text, encoding_name=DEFAULT_ENCODING):
+    return get_encoding(encoding_name).encode(str(text), disallowed_special=())
+
+
+def count_tokens(text, encoding_name=DEFAULT_ENCODING):
+    """Number of tokens of a text"""
+    return len(encode(text, encoding_name))
+
+
+def truncate_tokens(text, max_tokens=None, encoding_name=DEFAULT_ENCODING):
+    """
+    First `max_tokens` tokens of a text (the whole text if it is shorter, or if
+    `max_tokens` is None or 0)
+    """
+    if not max_tokens:
+        return text
+    tokens = encode(text, encoding_name)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding(encoding_name).decode(tokens[:max_tokens])
+
+
+def truncate_rows(rows, max_tokens=None, encoding_name=DEFAULT_ENCODING):
+    """
+    Longest prefix of `rows` whose text (`str` of every row, plus a separator)
+    fits in `max_tokens` tokens, so a listing is never cut in the middle of a row
+    (all the rows if `max_tokens` is None or 0)
+    """
+    if not max_tokens:
+        return list(rows)
+    kept = []
+    used = 0
+    for row in rows:
+        used += count_tokens(str(row), encoding_name) + 1
+        if used > max_tokens:
+            break
+        kept.append(row)
+    return kept
+
+
+class TokenMemo:
+    """
+    LRU of token counts keyed by (encoding, sha1 of the content).
+
+    Attributes
+    ----------
+    max_entries : int
+        maximum number of counts kept
+    """
+
+    def __init__(self, max_entries=50000):
+        self.max_entries = max_entries
+        self._counts = OrderedDict()
+        self._lock = Lock()
+
+    def count(self, text, encoding_name=DEFAULT_ENCODING):
+        text = str(text)
+        key = (encoding_name, hashlib.sha1(text.encode("utf-8")).digest())
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+        count = count_tokens(text, encoding_name)
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+
+token_memo = TokenMemo()
+
+
+def count_message_tokens(text, encoding_name=DEFAULT_ENCODING):
+    """Memoized `count_tokens`, for texts that are counted again and again (messages)"""
+    return token_memo.count(text, encoding_name)
+
+
+def truncate_conversation(
+    conversation, token_limit=10000, encoding_name=DEFAULT_ENCODING
+):
+    """
+    Latest messages of a conversation whose contents fit within `token_limit` tokens
+
+    Returns:
+        (the truncated conversation, its number of tokens)
+    """
+    tokens = 0
+    for i in range(len(conversation) - 1, -1, -1):
+        message_tokens = count_message_tokens(conversation[i]["content"], encoding_name)
+        if tokens + message_tokens > token_limit:
+            print("reached token limit at index", i)
+            return conversation[i + 1 :], tokens
+        tokens += message_tokens
+    return conversation, tokens
@@ -0,0 +1,288 @@
+"""
+Request tracing: nested, timed spans across the /ask path.
+
+A request starts a trace (`start_trace`), stages open spans under the current one
+(`span` / `traced`), and when the root span ends the whole tree is handed to the
+exporters. The current span is kept in a context variable, so nesting follows the
+code; work sent to thread pools keeps its parent through `in_context`, asyncio
+tasks and `asyncio.to_thread` copy the context by themselves.
+
+Outside a trace (scripts, ingestion) spans are no-ops, and so is everything when
+no exporter is configured. Set CHATTUTOR_TRACE_FILE to write one JSON line per
+request, and summarize a file with
+
+    python -m core.tracing traces.jsonl
+"""
+
+import contextvars
+import functools
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Lock
+
+import numpy as np
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed stage of a request
+
+    Attributes
+    ----------
+    name : str
+        stage name, e.g. "engineer_prompt"
+    trace : Trace
+        trace the span belongs to
+    parent_id : str | None
+        id of the enclosing span, None for the root
+    attributes : dict
+        free form details (collection, model, cache hit, ...)
+    """
+
+    def __init__(self, name, trace, parent_id=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def child(self, name, **attributes):
+        """New span under this one (not made current, end it with `end`)"""
+        return Span(name, self.trace, self.span_id, attributes)
+
+    def end(self, **attributes):
+        if self.duration is not None:
+            return
+        self.attributes.update(attributes)
+        self.duration = time.time() - self.start
+        self.trace.finished(self)
+
+    @contextmanager
+    def activate(self):
+        """Makes this span the current one inside the block (without ending it)"""
+        token = current_span.set(self)
+        try:
+            yield self
+        finally:
+            current_span.reset(token)
+
+    def __enter__(self):
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = repr(exc)
+        self.end()
+        return False
+
+    def asdict(self):
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+        }
+
+
+class NoopSpan:
+    """Span used outside traces: records nothing"""
+
+    name = None
+    attributes = {}
+
+    def set(self, **attributes):
+        pass
+
+    def child(self, name, **attributes):
+        return self
+
+    def end(self, **attributes):
+        pass
+
+    @contextmanager
+    def activate(self):
+        yield self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+    """The spans of one request, exported together when the root span ends"""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._lock = Lock()
+
+    def finished(self, span):
+        with self._lock:
+            self.spans.append(span)
+        if span.parent_id is None:
+            self.tracer.export(self, span)
+
+
+class JSONLExporter:
+    """Appends one JSON line per trace to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    def export(self, record):
+        line = json.dumps(record, default=str, separators=(",", ":"))
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class Tracer:
+    """
+    Starts traces and hands the finished ones to its exporters
+
+    Attributes
+    ----------
+    exporters : list
+        objects with an `export(record: dict)` method
+    """
+
+    def __init__(self, exporters=None):
+        self.exporters = list(exporters or [])
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def start_trace(self, name, **attributes):
+        """Root span of a new trace (not made current), or a no-op span without exporters"""
+        if not self.exporters:
+            return NOOP_SPAN
+        return Span(name, Trace(self), None, attributes)
+
+    def export(self, trace, root):
+        with trace._lock:
+            spans = sorted(trace.spans, key=lambda span: span.start)
+        record = {
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "start": root.start,
+            "duration_ms": round(root.duration * 1000, 3),
+            "spans": [span.asdict() for span in spans],
+        }
+        for exporter in self.exporters:
+            try:
+                exporter.export(record)
+            except Exception as e:
+                print(f"tracing: exporter {type(exporter).__name__} failed: {e}")
+
+
+tracer = Tracer()
+if os.getenv("CHATTUTOR_TRACE_FILE"):
+    tracer.add_exporter(JSONLExporter(os.getenv("CHATTUTOR_TRACE_FILE")))
+
+
+def start_trace(name, **attributes):
+    return tracer.start_trace(name, **attributes)
+
+
+def span(name, **attributes):
+    """Child of the current span, to use as a context manager (no-op outside a trace)"""
+    parent = current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return parent.child(name, **attributes)
+
+
+def annotate(**attributes):
+    """Sets attributes on the current span (if any)"""
+    (current_span.get() or NOOP_SPAN).set(**attributes)
+
+
+def traced(name):
+    """Decorator running the function in a span called `name`"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def in_context(func):
+    """`func` bound to a copy of the current context, to submit to a thread pool"""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+def traced_stream(generator, root):
+    """
+    Iterates a response generator with `root` as the current span, and ends `root`
+    when the stream ends (or the client goes away)
+    """
+    try:
+        while True:
+            with root.activate():
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+            yield item
+    except GeneratorExit:
+        root.set(disconnected=True)
+        generator.close()
+        raise
+    finally:
+        root.end()
+
+
+def summarize(path):
+    """
+    p50 / p95 duration of every stage over the traces of a JSONL file
+
+    Returns:
+        dict[str, dict]: span name -> {"count", "p50_ms", "p95_ms"}
+    """
+    durations = {}
+    with open(path) as f:
+        for line in f:
+            for record in json.loads(line)["spans"]:
+                durations.setdefault(record["name"], []).append(record["duration_ms"])
+    return {
+        name: {
+            "count": len(values),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95)),
+        }
+        for name, values in sorted(durations.items())
+    }
+
+
+if __name__ == "__main__":
+    for name, stats in summarize(sys.argv[1]).items():
+        print(
+            f"{name:40s} n={stats['count']:6d} p50={stats['p50_ms']:10.1f}ms p95={stats['p95_ms']:10.1f}ms"
+        )
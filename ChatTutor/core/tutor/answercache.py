@@ -0,0 +1,260 @@
+"""
+Semantic answer cache, used by `Tutor.cached_ask_question`.
+
+Large courses get the same conceptual question over and over. Answers to
+standalone questions are kept per scope - (tutor type, collections, section
+docs, model, pipeline) - with the embedding of the question; a later question of
+the same scope whose embedding is close enough replays the stored answer and
+sources instead of calling the LLM.
+
+Embeddings of questions that differ only in a number or a name ("homework 3" and
+"homework 4") are usually closer than any useful threshold, so a hit also requires
+both questions to have the same key terms (numbers and proper nouns).
+
+Entries of a collection are dropped when it is written to or deleted from
+(`VectorDatabase.on_write`), entries of a tutor that reads SQL tables when one of
+them is written to (`DataBase.on_write`), and a per-source generation keeps
+answers that were being generated during the write from being stored afterwards.
+
+The cache is off unless ANSWER_CACHE_ENABLED=1.
+"""
+
+import os
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "0") == "1"
+# cosine similarity between question embeddings above which an answer is reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.96))
+
+# prefix of the SQL tables among the sources of a scope
+SQL_SOURCE_PREFIX = "sql:"
+
+WORD_RE = re.compile(r"[\w'-]+", re.UNICODE)
+SENTENCE_ENDS = (".", "?", "!", ":")
+
+
+def key_terms(prompt):
+    """
+    Lower case numbers and proper nouns of a question: words with a digit, all caps
+    words, and capitalized words that do not start a sentence
+    """
+    terms = set()
+    sentence_start = True
+    for match in WORD_RE.finditer(prompt):
+        word = match.group()
+        if (
+            any(c.isdigit() for c in word)
+            or (len(word) > 1 and word.isupper())
+            or (word[0].isupper() and not sentence_start and word != "I")
+        ):
+            terms.add(word.lower())
+        sentence_start = prompt.startswith(SENTENCE_ENDS, match.end())
+    return frozenset(terms)
+
+
+class AnswerEntry:
+    """
+    One cached answer
+
+    Attributes
+    ----------
+    embedding : np.ndarray
+        unit embedding of the question
+    prompt : str
+        the question
+    terms : frozenset[str]
+        key terms of the question (see `key_terms`)
+    answer : str
+        the streamed answer, concatenated
+    valid_docs : list[dict]
+        the sources sent with the answer
+    expires_at : float
+        `time.time()` after which the entry is ignored
+    """
+
+    def __init__(self, embedding, prompt, answer, valid_docs, expires_at):
+        self.embedding = embedding
+        self.prompt = prompt
+        self.terms = key_terms(prompt)
+        self.answer = answer
+        self.valid_docs = valid_docs
+        self.expires_at = expires_at
+
+
+class AnswerCache:
+    """
+    Answers by scope, matched by question embedding similarity.
+
+    Attributes
+    ----------
+    enabled : bool
+        whether answers are looked up and stored at all
+    threshold : float
+        minimum cosine similarity for a hit
+    ttl : float
+        seconds an answer stays valid
+    max_per_scope : int
+        answers kept per scope (oldest dropped first)
+    max_scopes : int
+        scopes kept (least recently used dropped first)
+    """
+
+    def __init__(
+        self,
+        enabled=ANSWER_CACHE_ENABLED,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", 86400)),
+        max_per_scope=int(os.getenv("ANSWER_CACHE_MAX_PER_SCOPE", 256)),
+        max_scopes=int(os.getenv("ANSWER_CACHE_MAX_SCOPES", 512)),
+    ):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_per_scope = max_per_scope
+        self.max_scopes = max_scopes
+        self.scopes = OrderedDict()  # scope -> list of AnswerEntry
+        self.generations = {}  # collection -> number of invalidations
+        self.attached = set()  # ids of the VectorDatabases and DataBases listened to
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def scope(tutor_type, collections, from_doc, model, pipeline, tables=()):
+        if from_doc:
+            from_doc = frozenset([from_doc] if isinstance(from_doc, str) else from_doc)
+        else:
+            from_doc = None
+        sources = frozenset(collections) | frozenset(
+            SQL_SOURCE_PREFIX + table for table in tables
+        )
+        return (tutor_type, sources, from_doc, model, pipeline)
+
+    def attach(self, vector_db):
+        """Drops the answers of a collection whenever `vector_db` writes to it"""
+        with self._lock:
+            if id(vector_db) in self.attached:
+                return
+            self.attached.add(id(vector_db))
+        vector_db.on_write(self.invalidate)
+
+    def attach_database(self, database):
+        """Drops the answers built from a SQL table whenever `database` writes to it"""
+        with self._lock:
+            if id(database) in self.attached:
+                return
+            self.attached.add(id(database))
+        database.on_write(lambda table: self.invalidate(SQL_SOURCE_PREFIX + table))
+
+    def generation(self, scope):
+        """Snapshot to pass to `put`, taken before the answer is generated"""
+        with self._lock:
+            return tuple(self.generations.get(name, 0) for name in sorted(scope[1]))
+
+    def get(self, scope, embedding, prompt):
+        """
+        Closest live answer of the scope above the threshold whose question has the
+        key terms of `prompt`, or None
+        """
+        terms = key_terms(prompt)
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / np.linalg.norm(vector)
+        now = time.time()
+        with self._lock:
+            entries = [
+                entry for entry in self.scopes.get(scope, []) if entry.expires_at > now
+            ]
+            if scope in self.scopes:
+                self.scopes[scope] = entries
+                self.scopes.move_to_end(scope)
+            if not entries:
+                self.misses += 1
+                return None
+            similarities = np.stack([entry.embedding for entry in entries]) @ vector
+            similarities[[entry.terms != terms for entry in entries]] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entries[best]
+
+    def put(self, scope, embedding, generation, prompt, answer, valid_docs):
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / np.linalg.norm(vector)
+        entry = AnswerEntry(vector, prompt, answer, valid_docs, time.time() + self.ttl)
+        with self._lock:
+            current = tuple(self.generations.get(name, 0) for name in sorted(scope[1]))
+            if current != generation:
+                # the collection changed while the answer was generated
+                return
+            entries = self.scopes.setdefault(scope, [])
+            entries.append(entry)
+            del entries[: -self.max_per_scope]
+            self.scopes.move_to_end(scope)
+            while len(self.scopes) > self.max_scopes:
+                self.scopes.popitem(last=False)
+
+    def invalidate(self, collection_name):
+        """Drops the answers built from a collection (or SQL table, prefixed)"""
+        with self._lock:
+            self.generations[collection_name] = (
+                self.generations.get(collection_name, 0) + 1
+            )
+            for scope in [
+                scope for scope in self.scopes if collection_name in scope[1]
+            ]:
+                del self.scopes[scope]
+
+
+answer_cache = AnswerCache()
+
+
+class AnswerRecorder:
+    """Collects the answer and sources of a response stream while it is sent"""
+
+    def __init__(self):
+        self.parts = []
+        self.valid_docs = []
+        self.failed = False
+
+    def feed(self, message):
+        if "valid_docs" in message:
+            self.valid_docs = message["valid_docs"]
+        if "error" in message:
+            self.failed = True
+        content = message.get("content")
+        if isinstance(content, str):
+            self.parts.append(content)
+
+    @property
+    def answer(self):
+        return "".join(self.parts)
+
+    @property
+    def complete(self):
+        return not self.failed and self.answer.strip() != ""
+
+
+def replay_answer(entry, processing_prompt_time=0.0, chunk_size=16):
+    """
+    Messages of a cached answer, in the order `Tutor.ask_question` yields them
+    (sources, timing, role, content deltas, end of message)
+    """
+    # imported here: core.extensions connects the vector databases when imported
+    from core.extensions import stream_text
+
+    yield {
+        "content": "",
+        "valid_docs": entry.valid_docs,
+        "processing_prompt_time": processing_prompt_time,
+    }
+    yield {"content": "", "elapsed_time": 0.0}
+    yield {"role": "assistant", "content": ""}
+    yield from stream_text(entry.answer, chunk_size=chunk_size)
+    yield {}
@@ -0,0 +1,53 @@
+"""
+Context packing: choosing which retrieved documents go into the system prompt.
+
+Every candidate is rendered by its tutor first; the packer then fills a token
+budget greedily by relevance per token, so a short relevant snippet is not pushed
+out by a long marginal one, and documents are either included whole or dropped
+(never cut in the middle).
+"""
+
+import os
+
+from core.tokenbudget import count_message_tokens
+
+# tokens of retrieved context allowed in a system prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+
+
+def relevance(doc):
+    """
+    Relevance of a candidate in (0, 1], from its distance (squared l2 between unit
+    embeddings, so 1 - distance / 2 is the cosine similarity). Candidates without
+    a distance are kept as most relevant.
+    """
+    distance = doc.get("distance")
+    if not isinstance(distance, (int, float)):
+        return 1.0
+    return max(1e-3, 1 - distance / 2)
+
+
+def pack_context(docs, texts, budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Args:
+        docs (list[dict]): candidate documents (valid_docs entries, with "distance")
+        texts (list[str]): how each document is rendered in the prompt
+        budget (int): maximum number of tokens of the kept texts
+
+    Returns:
+        tuple[list[dict], list[str], list[dict]]: the kept documents and their texts,
+        in their original order, and the dropped documents
+    """
+    tokens = [count_message_tokens(text) for text in texts]
+    order = sorted(
+        range(len(docs)), key=lambda i: -relevance(docs[i]) / max(tokens[i], 1)
+    )
+    kept = set()
+    used = 0
+    for i in order:
+        if used + tokens[i] <= budget:
+            kept.add(i)
+            used += tokens[i]
+    packed = [i for i in range(len(docs)) if i in kept]
+    dropped = [docs[i] for i in range(len(docs)) if i not in kept]
+    return [docs[i] for i in packed], [texts[i] for i in packed], dropped
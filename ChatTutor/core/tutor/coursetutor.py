@@ -1,10 +1,23 @@
+import os
+from functools import partial
+
+import numpy as np
 from ..openai_tools import OPENAI_DEFAULT_MODEL
 from core.tutor.systemmsg import default_system_message
 from core.tutor.tutor import Tutor
+from core.tutor.utils import TopK, fan_out, llm_pool
+from core.tracing import in_context
 from abc import ABC, ABCMeta, abstractmethod
 from enum import Enum
 from nice_functions import pprint, bold, green, blue, red, time_it
 
+# seconds a request waits for its collections, the slower ones are left out
+RETRIEVAL_DEADLINE = float(os.getenv("RETRIEVAL_DEADLINE", 10))
+# retrieve for the raw message while the prompt is rewritten, and keep the results
+# if the rewritten prompt's embedding is at least this similar (cosine) to the raw one
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1"
+SPECULATIVE_SIMILARITY = float(os.getenv("SPECULATIVE_SIMILARITY", 0.9))
+
 
 class CourseTutor(Tutor):
     def __init__(
@@ -18,17 +31,26 @@ class CourseTutor(Tutor):
 
     @abstractmethod
     def get_collection_valid_docs(
-        self, prompt, coll_name, coll_desc, from_doc=None, threshold=0.5, query_limit=3
+        self,
+        prompt,
+        coll_name,
+        coll_desc,
+        from_doc=None,
+        threshold=0.5,
+        query_limit=3,
+        query_embedding=None,
     ):
         """_summary_
 
         Args:
             prompt (str): prompt message
-            coll_name (str): collection name
+            coll_name (str): collection name, passed as `collection_name` when querying the embedding_db
             coll_desc (str): collection desc
             from_doc (str | list[str], optional): doc(s) to pull from. Defaults to None.
             threshold (float, optional): Maximum distance from the query. Defaults to 0.5.
             query_limit (int, optional): Maximum documents to be returned. Defaults to 3.
+            query_embedding (list[float], optional): embedding of the prompt, computed once per
+            request by `get_valid_docs` and shared by all collections. Defaults to None.
 
         Advised Return:
             ```
@@ -49,6 +71,10 @@ class CourseTutor(Tutor):
         """Gets valid docs for each collection in self.collections
         Makes use of the abstract `get_collection_valid_docs` function
 
+        Collections are queried concurrently (bounded by the retrieval pool and
+        `RETRIEVAL_DEADLINE`), and the closest `limit + 2` documents are kept
+        as the results come in.
+
         Args:
             prompt (str): prompt message
             from_doc (str | list[str], optional): doc(s) to pull from. Defaults to None.
@@ -68,31 +94,84 @@ class CourseTutor(Tutor):
             : the valid documents (closest to the query)
             that will be used as knowledge base by the tutor
         """
-        arr = []
         valid_docs = []
         query_limit = limit * 5
         process_limit = limit + 2  # each is close to 800
 
-        # add all docs with distance below threshold to array
+        # embed the prompt once, every collection is queried with the same embedding
+        query_embedding = None
+        if self.embedding_db and len(self.collections) > 0:
+            query_embedding = time_it(self.embedding_db.embed_query)(prompt)
+
+        # one query task per collection
+        tasks = []
         for coll_name, coll_desc in self.collections.items():
             # if is_generic_message:
             #    continue
             if self.embedding_db and coll_name != None:
                 print(f"Collection: {coll_name}")
-                self.embedding_db.load_datasource(coll_name)
-                arr = arr + self.get_collection_valid_docs(
-                    prompt, coll_name, coll_desc, from_doc, threshold, query_limit
+                tasks.append(
+                    (
+                        coll_name,
+                        partial(
+                            self.get_collection_valid_docs,
+                            prompt,
+                            coll_name,
+                            coll_desc,
+                            from_doc,
+                            threshold,
+                            query_limit,
+                            query_embedding,
+                        ),
+                    )
                 )
 
-        # sort by distance, increasing
-        sorted_docs = sorted(arr, key=lambda el: el["distance"])
-        valid_docs = sorted_docs[:process_limit]
+        # keep the closest documents (by distance, increasing) as the collections answer
+        closest_docs = TopK(process_limit, key=lambda el: el["distance"])
+        for collection_docs in fan_out(tasks, timeout=RETRIEVAL_DEADLINE):
+            closest_docs.extend(collection_docs)
+        valid_docs = closest_docs.sorted()
         pprint(blue("Array begin"))
 
-        pprint(f"Documents: {arr}")
+        pprint(f"Documents: {valid_docs}")
         pprint(blue(f"Array length: {len(valid_docs)}"))
         return valid_docs
 
+    def speculation_holds(self, raw_prompt, prompt):
+        """Whether documents retrieved for the raw message can stand for the rewritten prompt:
+        the prompt is unchanged, or its embedding is close enough to the raw message's"""
+        if prompt == raw_prompt:
+            return True
+        try:
+            raw_embedding, embedding = self.embedding_db.embed_queries([raw_prompt, prompt])
+        except Exception as e:
+            print(red("speculation_holds: embedding failed: "), e)
+            return False
+        if raw_embedding is None or embedding is None:
+            return False
+        raw_embedding, embedding = np.asarray(raw_embedding), np.asarray(embedding)
+        similarity = (
+            raw_embedding @ embedding / (np.linalg.norm(raw_embedding) * np.linalg.norm(embedding))
+        )
+        pprint("speculative retrieval similarity", similarity)
+        return similarity >= SPECULATIVE_SIMILARITY
+
+    def render_doc(self, doc):
+        """String of one valid document, as it appears in the system message"""
+        doc_title_or_file_name = doc["metadata"].get("title", None) or doc["metadata"].get(
+            "doc", None
+        )
+        doc_authors = ""
+        doc_content = doc["doc"]
+        if doc["metadata"].get("authors"):
+            doc_authors = doc["metadata"].get("authors")
+            doc_authors += rf" by '{doc_authors}'"
+
+        doc_content = (
+            rf"Course section at:'{doc_title_or_file_name}', by {doc_authors}: {doc_content}"
+        )
+        return "-" * 100 + f"\n{doc_content}\n\n"
+
     def prettify(self, valid_docs):
         """Generate string of valid documents
 
@@ -102,23 +181,7 @@ class CourseTutor(Tutor):
         Returns:
             string: string containing the docs' contents
         """
-        docs = ""
-        for doc in valid_docs:
-            doc_title_or_file_name = doc["metadata"].get("title", None) or doc["metadata"].get(
-                "doc", None
-            )
-            doc_authors = ""
-            doc_content = doc["doc"]
-            if doc["metadata"].get("authors"):
-                doc_authors = doc["metadata"].get("authors")
-                doc_authors += rf" by '{doc_authors}'"
-
-            doc_content = (
-                rf"Course section at:'{doc_title_or_file_name}', by {doc_authors}: {doc_content}"
-            )
-            doc_reference = "-" * 100 + f"\n{doc_content}\n\n"
-            docs += doc_reference
-        return docs
+        return "".join(self.render_doc(doc) for doc in valid_docs)
 
     def debug_log_valid_docs(self, valid_docs):
         """Log valid_docs
@@ -148,8 +211,6 @@ class CourseTutor(Tutor):
         print("#" * 100)
         print("beggining ask_question:")
 
-        if pipeline != "openai":
-            self.engineer_prompts = False
         # Ensuring the last message in the conversation is a user's question
         assert (
             conversation[-1]["role"] == "user"
@@ -157,20 +218,42 @@ class CourseTutor(Tutor):
         conversation = self.truncate_conversation(conversation)
 
         prompt = conversation[-1]["content"]
+        context = self.engineer_prompts and pipeline == "openai"
 
-        (
-            prompt,
-            is_generic_message,
-            is_furthering_message,
-            get_furthering_message,
-        ) = time_it(self.engineer_prompt)(
-            conversation, context=self.engineer_prompts
-        )  # if contest is st to False, it is equivalent to conversation[-1]["content"]
-        # Querying the database to retrieve relevant documents to the user's question
-        pprint(blue(prompt))
-        valid_docs = self.get_valid_docs(prompt, from_doc, threshold, limit)
+        if context and SPECULATIVE_RETRIEVAL and self.embedding_db and len(self.collections) > 0:
+            # retrieve for the raw message while the prompt is being rewritten
+            raw_prompt = prompt
+            rewrite = llm_pool.submit(
+                in_context(partial(time_it(self.engineer_prompt), conversation, context=True))
+            )
+            valid_docs = self.get_valid_docs(raw_prompt, from_doc, threshold, limit)
+            (
+                prompt,
+                is_generic_message,
+                is_furthering_message,
+                get_furthering_message,
+            ) = rewrite.result()
+            pprint(blue(prompt))
+            if not self.speculation_holds(raw_prompt, prompt):
+                pprint(red("speculative retrieval discarded, querying the rewritten prompt"))
+                valid_docs = self.get_valid_docs(prompt, from_doc, threshold, limit)
+        else:
+            (
+                prompt,
+                is_generic_message,
+                is_furthering_message,
+                get_furthering_message,
+            ) = time_it(self.engineer_prompt)(
+                conversation, context=context
+            )  # if contest is st to False, it is equivalent to conversation[-1]["content"]
+            # Querying the database to retrieve relevant documents to the user's question
+            pprint(blue(prompt))
+            valid_docs = self.get_valid_docs(prompt, from_doc, threshold, limit)
+        valid_docs, doc_texts = self.pack_docs(
+            valid_docs, [self.render_doc(doc) for doc in valid_docs]
+        )
         self.debug_log_valid_docs(valid_docs)
-        docs = self.prettify(valid_docs)
+        docs = "".join(doc_texts)
 
         messages = [{"role": c["role"], "content": c["content"]} for c in conversation]
         if self.embedding_db and len(self.collections) > 0:
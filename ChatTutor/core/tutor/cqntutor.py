@@ -8,7 +8,12 @@ from core.tutor.tutor import Tutor
 from abc import ABC, ABCMeta, abstractmethod
 from enum import Enum
 from nice_functions import pprint, bold, green, blue, red, time_it
+import os
 from core.tutor.utils import truncate_to_x_number_of_tokens, get_number_of_tokens
+from core.tutor.utils import run_concurrently
+
+# seconds each pre-answer classification call may take before its default is used
+CLASSIFICATION_TIMEOUT = float(os.getenv("CLASSIFICATION_TIMEOUT", 15))
 
 # See sqlquerytutor for actual cqn tutor
 
@@ -85,7 +90,7 @@ class CQNTutor(Tutor):
         if self.gemini == False:
             return self.get_paper_titles_from_prompt(prompt)
         # print("entering get_type_of_question")
-        paper_titles_from_prompt = time_it(self.genai_model.generate_content, "generate_content")(
+        paper_titles_from_prompt = time_it(self.simple_gemini, "generate_content")(
             [
                 f"""
             You will get a question, or a summary of a conversation between a bot and a user. 
@@ -97,8 +102,7 @@ class CQNTutor(Tutor):
                 f"""Which paper titles can you identify in this sentence? "{prompt}""",
             ]
         )
-        paper_titles_from_prompt.resolve()
-        return paper_titles_from_prompt.text
+        return paper_titles_from_prompt
 
     def get_required_level_of_information(self, prompt, explain=False):
         if self.gemini == False:
@@ -109,7 +113,7 @@ class CQNTutor(Tutor):
 
         # print("entering get_type_of_question")
         required_level_of_information = time_it(
-            self.genai_model.generate_content, "required_level_of_information"
+            self.simple_gemini, "required_level_of_information"
         )(
             [
                 f"""
@@ -141,8 +145,7 @@ class CQNTutor(Tutor):
 
         # if explain:
         pprint(required_level_of_information)
-        required_level_of_information.resolve()
-        required_level_of_information = required_level_of_information.text.lower()
+        required_level_of_information = required_level_of_information.lower()
         if "full paper content" in required_level_of_information:
             return "high"
         elif "paper summary" in required_level_of_information:
@@ -152,25 +155,48 @@ class CQNTutor(Tutor):
         else:
             return "basic"
 
-    def get_metadata_from_paper_titles_from_prompt(self, paper_titles_from_prompt):
+    def clean_paper_titles(self, paper_titles_from_prompt):
         paper_titles_from_prompt = paper_titles_from_prompt.replace('"', "")
         paper_titles_from_prompt = paper_titles_from_prompt.replace("[", "")
         paper_titles_from_prompt = paper_titles_from_prompt.replace("]", "")
-        self.embedding_db.load_datasource(f"cqn_openaicol_ttv_titles")
+        return paper_titles_from_prompt
+
+    def get_metadata_from_paper_titles_from_prompt(
+        self, paper_titles_from_prompt, query_embedding=None
+    ):
+        paper_titles_from_prompt = self.clean_paper_titles(paper_titles_from_prompt)
         (
             documents,
             metadatas,
             distances,
             documents_plain,
-        ) = time_it(
-            self.embedding_db.query
-        )(paper_titles_from_prompt, 10, None, metadatas=True)
+        ) = time_it(self.embedding_db.query)(
+            paper_titles_from_prompt,
+            10,
+            None,
+            metadatas=True,
+            collection_name="cqn_openaicol_ttv_titles",
+            query_embedding=query_embedding,
+        )
         metadata_from_paper_titles_from_prompt = []
         for meta, dist in zip(metadatas, distances):
             if dist < 0.2:
                 metadata_from_paper_titles_from_prompt.append(meta)
         return metadata_from_paper_titles_from_prompt
 
+    def get_metadata_from_prompt(self, prompt):
+        """Metadata of the papers whose titles are mentioned in the prompt"""
+        # titles quoted in the prompt are found lexically, without asking the LLM for them
+        metadata_from_paper_titles_from_prompt = time_it(self.embedding_db.match_documents)(
+            prompt, "cqn_openaicol_ttv_titles"
+        )
+        if metadata_from_paper_titles_from_prompt:
+            return metadata_from_paper_titles_from_prompt
+
+        paper_titles_from_prompt = self.get_paper_titles_from_prompt(prompt)
+        pprint("paper_titles_from_prompt", paper_titles_from_prompt)
+        return self.get_metadata_from_paper_titles_from_prompt(paper_titles_from_prompt)
+
     def process_prompt(
         self, conversation, from_doc=None, threshold=0.5, limit=3, pipeline="openai"
     ):
@@ -182,8 +208,6 @@ class CQNTutor(Tutor):
         conversation = self.truncate_conversation(conversation)
 
         prompt = conversation[-1]["content"]
-        required_level_of_information = self.get_required_level_of_information(prompt=prompt)
-        pprint("required_level_of_information ", green(required_level_of_information))
 
         # todo: fix prompt to take context from all messages
         (
@@ -198,12 +222,28 @@ class CQNTutor(Tutor):
         arr = []
         # add al docs with distance below threshold to array
 
-        paper_titles_from_prompt = self.get_paper_titles_from_prompt(prompt)
-        pprint("paper_titles_from_prompt", paper_titles_from_prompt)
-
-        metadata_from_paper_titles_from_prompt = self.get_metadata_from_paper_titles_from_prompt(
-            paper_titles_from_prompt
+        # the classification, the titles lookup (titles -> metadata) and the prompt
+        # embedding are independent, they run at the same time
+        classification = time_it(run_concurrently)(
+            {
+                "level": (
+                    lambda: self.get_required_level_of_information(prompt=prompt),
+                    CLASSIFICATION_TIMEOUT,
+                    "high",
+                ),
+                "titles": (
+                    lambda: self.get_metadata_from_prompt(prompt),
+                    CLASSIFICATION_TIMEOUT,
+                    [],
+                ),
+                # None: the queries embed the prompt themselves
+                "embedding": (lambda: self.embedding_db.embed_query(prompt), None, None),
+            }
         )
+        required_level_of_information = classification["level"]
+        pprint("required_level_of_information ", green(required_level_of_information))
+        metadata_from_paper_titles_from_prompt = classification["titles"]
+        prompt_embedding = classification["embedding"]
         pprint(
             "metadata_from_paper_titles_from_prompt",
             metadata_from_paper_titles_from_prompt,
@@ -232,7 +272,6 @@ class CQNTutor(Tutor):
                         coll_name == "cqn_openaicol_ttv"
                         and required_level_of_information == "basic"
                     ):
-                        self.embedding_db.load_datasource(f"{coll_name}")
                         query_limit = 100
                         process_limit = 20  # each basic entry has close to 100 tokens
                         show_limit = 0
@@ -240,14 +279,12 @@ class CQNTutor(Tutor):
                         coll_name == "cqn_openaicol_ttv"
                         and required_level_of_information == "medium"
                     ):
-                        self.embedding_db.load_datasource(f"{coll_name}")
                         query_limit = 100
                         process_limit = 10  # each basic entry has close to 350 tokens
                         keep_only_first_x_tokens_for_processing = 200
                         show_limit = 3
                     else:
                         required_level_of_information = "high"
-                        self.embedding_db.load_datasource(coll_name)
                         query_limit = 10
                         process_limit = 3  # each is close to 800
                         show_limit = 3
@@ -267,7 +304,7 @@ class CQNTutor(Tutor):
                     pprint(
                         "\nQuerying embedding_db with prompt:",
                         blue(prompt),
-                        self.embedding_db.datasource,
+                        coll_name,
                     )
 
                     (
@@ -275,15 +312,29 @@ class CQNTutor(Tutor):
                         metadatas,
                         distances,
                         documents_plain,
-                    ) = time_it(
-                        self.embedding_db.query
-                    )(prompt, query_limit, from_doc, metadatas=True)
+                        ranks,
+                    ) = time_it(self.embedding_db.query)(
+                        prompt,
+                        query_limit,
+                        from_doc,
+                        metadatas=True,
+                        collection_name=coll_name,
+                        query_embedding=prompt_embedding,
+                        hybrid=True,
+                        ranks=True,
+                    )
                     pprint(rf"got {len(documents)} documents")
-                    for doc, meta, dist in zip(documents, metadatas, distances):
+                    for doc, meta, dist, rank in zip(documents, metadatas, distances, ranks):
                         pprint(green(doc), dist, "\n")
                         # if no fromdoc specified, and distance is lowe thhan thersh, add to array of possible related documents
                         # if from_doc is specified, threshold is redundant as we have only one possible doc
-                        if dist <= threshold or from_doc != None or pipeline == "gemini":
+                        # lexical hits are kept whatever their embedding distance
+                        if (
+                            dist <= threshold
+                            or rank["lexical"]
+                            or from_doc != None
+                            or pipeline == "gemini"
+                        ):
                             arr.append(
                                 {
                                     "coll_desc": coll_desc,
@@ -291,9 +342,11 @@ class CQNTutor(Tutor):
                                     "doc": doc,
                                     "metadata": meta,
                                     "distance": dist,
+                                    "score": rank["score"],
                                 }
                             )
-            sorted_docs = sorted(arr, key=lambda el: el["distance"])
+            # by fused (vector + lexical) score, across the collections
+            sorted_docs = sorted(arr, key=lambda el: -el["score"])
             valid_docs = sorted_docs[:process_limit]
 
             # print in the console basic info of valid docs
@@ -308,17 +361,15 @@ class CQNTutor(Tutor):
             # stringify the docs and add to context message
             docs = ""
             if required_level_of_information in {"basic", "medium"}:
-                docs = "\n\n"
-                docs += "IMPORTANT: if the user asks information about papers, ALWAYS asumme they want information related to the provided list of papers. All these papers belong to the Quantum Networks Database (CQN database). If there is a list, there must (most of the times) be answer!"
-                docs += "The following is the list of papers from the Quantum Networks Database (CQN database) that must be used as source of information to answer the user's question:\n\n"
-                for doc in valid_docs:
-                    doc_content = truncate_to_x_number_of_tokens(
+                doc_texts = [
+                    truncate_to_x_number_of_tokens(
                         doc["doc"], keep_only_first_x_tokens_for_processing
                     )
-                    collection_db_response = doc_content
-                    docs += collection_db_response + "\n"
-                docs += "The 'provided list of papers' finish here."
+                    + "\n"
+                    for doc in valid_docs
+                ]
             else:
+                doc_texts = []
                 for doc in valid_docs:
 
                     doc_title_or_file_name = doc["metadata"].get("title", None) or doc[
@@ -338,8 +389,17 @@ class CQNTutor(Tutor):
                     )
 
                     doc_reference = "-" * 100 + f"\n{doc_content}\n\n"
-                    docs += doc_reference
+                    doc_texts.append(doc_reference)
                 # print('#### COLLECTION DB RESPONSE:', collection_db_response)
+            valid_docs, doc_texts = self.pack_docs(valid_docs, doc_texts)
+            if required_level_of_information in {"basic", "medium"}:
+                docs = "\n\n"
+                docs += "IMPORTANT: if the user asks information about papers, ALWAYS asumme they want information related to the provided list of papers. All these papers belong to the Quantum Networks Database (CQN database). If there is a list, there must (most of the times) be answer!"
+                docs += "The following is the list of papers from the Quantum Networks Database (CQN database) that must be used as source of information to answer the user's question:\n\n"
+                docs += "".join(doc_texts)
+                docs += "The 'provided list of papers' finish here."
+            else:
+                docs = "".join(doc_texts)
             # debug log
         pprint("collections", self.collections)
         pprint("len collections", len(self.collections))
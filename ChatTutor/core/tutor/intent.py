@@ -0,0 +1,178 @@
+"""
+Local "standalone vs follow-up" classifier for the last user message, used by
+`Tutor.engineer_prompt` instead of asking the LLM on every message.
+
+Two signals are combined:
+    - lexical cues: pronouns and references to the previous answer ("it", "this paper",
+      "the second one", "explain more", ...), very short messages, leading conjunctions;
+    - nearest centroid: the prompt embedding is compared to the centroids of a few
+      example follow-up and standalone questions (embedded once, through the cache).
+
+Only the messages the classifier is unsure about go to the LLM.
+"""
+
+import re
+from threading import Lock
+
+import numpy as np
+
+STANDALONE = "standalone"
+FOLLOW_UP = "follow_up"
+UNSURE = "unsure"
+
+FOLLOW_UP_EXAMPLES = [
+    "Can you explain that in more detail?",
+    "What does it mean?",
+    "Who are the authors of this paper?",
+    "Summarize it",
+    "Why is that?",
+    "Can you give me an example?",
+    "What about the second one?",
+    "Tell me more about him",
+    "And what are their main results?",
+    "What equation did they use?",
+    "Thanks! Can you elaborate on the last point?",
+    "Is that correct?",
+]
+
+STANDALONE_EXAMPLES = [
+    "What is quantum entanglement?",
+    "Explain the Schrodinger equation",
+    "List the papers about quantum repeaters",
+    "Who wrote papers on superconducting qubits?",
+    "How does a Bell state measurement work?",
+    "What is the difference between a qubit and a classical bit?",
+    "Summarize the paper 'Entanglement distribution in quantum networks'",
+    "When is the homework due for this course?",
+    "What are the prerequisites for the course?",
+    "Give me an overview of quantum error correction",
+    "How many papers are in the database?",
+    "Derive the uncertainty principle",
+]
+
+# references to something said before
+ANAPHORA = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|"
+    r"above|previous|earlier|last one|first one|second one|third one|same|again|"
+    r"more|further|elaborate|expand|continue|else|also)\b"
+)
+# follow-up openers: "and ...", "what about ...", "why?", "thanks", "ok so ..."
+OPENERS = re.compile(
+    r"^(and|but|so|also|then|ok|okay|thanks|thank you|what about|how about|why|"
+    r"really|wait|same|now)\b"
+)
+# a standalone question usually names its subject (quoted title, capitalized name)
+NAMED_SUBJECT = re.compile(r"(\"[^\"]+\"|'[^']{3,}'|(?<=\s)[A-Z][a-zA-Z]+)")
+
+
+class IntentClassifier:
+    """
+    Decides whether the last user message needs the previous messages to be understood.
+
+    Attributes
+    ----------
+    follow_up_threshold : float
+        score above which a message is a follow-up
+    standalone_threshold : float
+        score below which a message is standalone; scores in between are unsure
+    """
+
+    def __init__(self, follow_up_threshold=0.5, standalone_threshold=-0.4):
+        self.follow_up_threshold = follow_up_threshold
+        self.standalone_threshold = standalone_threshold
+        self.centroids = None
+        self._lock = Lock()
+
+    @staticmethod
+    def lexical_score(prompt):
+        """Score in [-1, 1] from the wording alone, positive for follow-ups"""
+        text = prompt.strip()
+        lowered = text.lower()
+        words = re.findall(r"\w+", lowered)
+        score = 0.0
+        cues = len(ANAPHORA.findall(lowered))
+        score += min(cues, 2) * 0.3
+        if OPENERS.match(lowered):
+            cues += 1
+            score += 0.4
+        if len(words) <= 4:
+            score += 0.3
+        elif len(words) >= 12:
+            score -= 0.3
+        if NAMED_SUBJECT.search(text):
+            score -= 0.4
+        if cues == 0:
+            score -= 0.4
+        return max(-1.0, min(1.0, score))
+
+    def load_centroids(self, embed):
+        """Embeds the examples once and keeps the (normalized) centroid of each class"""
+        with self._lock:
+            if self.centroids is None:
+                vectors = embed(FOLLOW_UP_EXAMPLES + STANDALONE_EXAMPLES)
+                if vectors is None or any(vector is None for vector in vectors):
+                    return None
+                vectors = np.asarray(vectors, dtype=np.float32)
+                follow_up = vectors[: len(FOLLOW_UP_EXAMPLES)].mean(axis=0)
+                standalone = vectors[len(FOLLOW_UP_EXAMPLES) :].mean(axis=0)
+                self.centroids = (
+                    follow_up / np.linalg.norm(follow_up),
+                    standalone / np.linalg.norm(standalone),
+                )
+            return self.centroids
+
+    def centroid_score(self, prompt_embedding, embed):
+        """Score in [-1, 1] from the prompt embedding, positive for follow-ups"""
+        centroids = self.load_centroids(embed)
+        if centroids is None or prompt_embedding is None:
+            return 0.0
+        vector = np.asarray(prompt_embedding, dtype=np.float32)
+        vector = vector / np.linalg.norm(vector)
+        follow_up, standalone = centroids
+        # cosine margins between the two centroids are small, scale them up
+        return float(np.clip((vector @ follow_up - vector @ standalone) * 10, -1, 1))
+
+    def classify(self, conversation, embed=None):
+        """
+        Args:
+            conversation (list[{"role": str, "content": str}]): conversation, last
+            message from the user
+            embed (Callable[[list[str]], list[list[float]]], optional): embedding function
+            (e.g. `VectorDatabase.embed_queries`). Without it only the wording is used.
+
+        Returns:
+            tuple[str, float]: STANDALONE, FOLLOW_UP or UNSURE, and the score it comes from
+        """
+        if not any(message["role"] == "assistant" for message in conversation[:-1]):
+            return STANDALONE, -1.0
+        prompt = conversation[-1]["content"]
+        score = self.lexical_score(prompt)
+        if embed is not None:
+            (prompt_embedding,) = embed([prompt])
+            score = 0.5 * score + 0.5 * self.centroid_score(prompt_embedding, embed)
+        if score >= self.follow_up_threshold:
+            return FOLLOW_UP, score
+        if score <= self.standalone_threshold:
+            return STANDALONE, score
+        return UNSURE, score
+
+
+intent_classifier = IntentClassifier()
+
+
+def previous_context(conversation, max_chars=300):
+    """
+    Short note on what a follow-up refers to, built from the previous messages:
+    the previous user question and the start of the last answer.
+    """
+    previous_question = next(
+        (m["content"] for m in reversed(conversation[:-1]) if m["role"] == "user"), ""
+    )
+    last_answer = next(
+        (m["content"] for m in reversed(conversation[:-1]) if m["role"] == "assistant"),
+        "",
+    )
+    note = f"referring to: {previous_question.strip()}"
+    if last_answer:
+        note += f" - {' '.join(last_answer.split())[:max_chars]}"
+    return note
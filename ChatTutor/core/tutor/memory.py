@@ -0,0 +1,206 @@
+"""
+Rolling summary memory of long chats.
+
+The client sends the whole conversation with every /ask. Instead of passing all of
+it on (and cutting the oldest messages at the token limit), the older messages of
+a chat are folded into a running summary, stored per chat and user (`ChatSummary`),
+and the tutor gets the summary followed by the recent messages:
+
+    [{"role": "system", "content": "Summary of the earlier conversation: ..."}, recent...]
+
+Folding is incremental (the previous summary plus the newly old messages) and runs
+in the background after the unsummarized part grew past MEMORY_FOLD_TOKENS, so no
+answer waits on it; until it is done the recent part is only truncated. The prompt
+therefore stays around MEMORY_SUMMARY_TOKENS + MEMORY_FOLD_TOKENS however long the
+chat runs.
+
+A stored summary is only used when the first messages it covers are still the
+first messages of the conversation (checked by hash), so a cleared chat starts over.
+
+The chat id comes from the client, so summaries are kept per authenticated user:
+a caller can only read or overwrite the summaries of its own chats, and anonymous
+conversations are passed on as they are.
+"""
+
+import hashlib
+import os
+from threading import Lock
+
+from core import tokenbudget
+from core.data import DataBase
+from core.llmclient import llm
+from core.tracing import in_context
+from core.tutor.utils import llm_pool
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+# unsummarized tokens above which the older messages are folded into the summary
+MEMORY_FOLD_TOKENS = int(os.getenv("MEMORY_FOLD_TOKENS", 6000))
+# tokens of the latest messages kept as they are when folding
+MEMORY_RECENT_TOKENS = int(os.getenv("MEMORY_RECENT_TOKENS", 2500))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", 600))
+MEMORY_MODEL = os.getenv("MEMORY_MODEL", "gpt-3.5-turbo-16k")
+
+SUMMARY_PREFIX = "Summary of the earlier conversation with the user: "
+
+summarizer_system_message = f"""
+You maintain the memory of a tutoring conversation between a student and an assistant.
+You get the current summary (possibly empty) and the messages that followed it.
+Write the new summary: what the student is working on, the questions asked, the key
+explanations, facts, formulas and papers given by the assistant, and anything the
+student said about themselves or their level. Be factual and concise, no more than
+{MEMORY_SUMMARY_TOKENS} tokens, and do not address the student.
+"""
+
+
+def prefix_hash(conversation, count):
+    """Hash of the roles and contents of the first `count` messages"""
+    digest = hashlib.sha1()
+    for message in conversation[:count]:
+        digest.update(message["role"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(str(message["content"]).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ConversationMemory:
+    """
+    Folds the older messages of chats into running summaries.
+
+    Attributes
+    ----------
+    enabled : bool
+        whether conversations are compacted at all
+    fold_tokens : int
+        unsummarized tokens that trigger a fold
+    recent_tokens : int
+        tokens of the latest messages left out of a fold
+    token_limit : int
+        limit the unsummarized messages are truncated to while a fold is pending
+    """
+
+    def __init__(
+        self,
+        enabled=MEMORY_ENABLED,
+        fold_tokens=MEMORY_FOLD_TOKENS,
+        recent_tokens=MEMORY_RECENT_TOKENS,
+        token_limit=10000,
+        model=MEMORY_MODEL,
+        executor=llm_pool,
+    ):
+        self.enabled = enabled
+        self.fold_tokens = fold_tokens
+        self.recent_tokens = recent_tokens
+        self.token_limit = token_limit
+        self.model = model
+        self.executor = executor
+        self.folding = set()  # (owner, chat) with a fold in flight
+        self._lock = Lock()
+
+    def stored(self, owner_id, chat_id, conversation):
+        """(summary, number of messages it covers) usable for this conversation"""
+        row, _ = DataBase().get_chat_summary(owner_id, chat_id)
+        if row is None or not row["summary"]:
+            return "", 0
+        covered = row["covered"]
+        # the last message (the question) is never folded
+        if (
+            covered >= len(conversation)
+            or prefix_hash(conversation, covered) != row["prefix_hash"]
+        ):
+            return "", 0
+        return row["summary"], covered
+
+    def compact(self, chat_id, conversation, owner_id=None):
+        """
+        The conversation to answer: the stored summary of the chat, then the messages
+        it does not cover. Schedules a fold if these got too long.
+
+        Args:
+            chat_id (str | None): chat the conversation belongs to
+            conversation (list[{"role": str, "content": str}]): the whole conversation
+            owner_id (str | None): authenticated user asking, None if anonymous
+
+        Returns:
+            list[{"role": str, "content": str}]
+        """
+        if not self.enabled or not chat_id or not owner_id or len(conversation) < 2:
+            return conversation
+        try:
+            summary, covered = self.stored(owner_id, chat_id, conversation)
+        except Exception as e:
+            print("memory: could not load the summary of", chat_id, e)
+            return conversation
+        recent = conversation[covered:]
+        tokens = sum(
+            tokenbudget.count_message_tokens(message["content"]) for message in recent
+        )
+        if tokens > self.fold_tokens:
+            self.schedule_fold(owner_id, chat_id, conversation, summary, covered)
+            recent, _ = tokenbudget.truncate_conversation(recent, self.token_limit)
+        if not summary:
+            return recent
+        return [{"role": "system", "content": SUMMARY_PREFIX + summary}] + recent
+
+    def schedule_fold(self, owner_id, chat_id, conversation, summary, covered):
+        with self._lock:
+            if (owner_id, chat_id) in self.folding:
+                return
+            self.folding.add((owner_id, chat_id))
+        conversation = [
+            {"role": m["role"], "content": m["content"]} for m in conversation
+        ]
+        self.executor.submit(
+            in_context(self.fold), owner_id, chat_id, conversation, summary, covered
+        )
+
+    def split(self, conversation, covered):
+        """Index up to which the messages are folded: all but the latest `recent_tokens`
+        (and always the last message)"""
+        end = len(conversation) - 1
+        tokens = tokenbudget.count_message_tokens(conversation[end]["content"])
+        while end > covered:
+            message_tokens = tokenbudget.count_message_tokens(
+                conversation[end - 1]["content"]
+            )
+            if tokens + message_tokens > self.recent_tokens:
+                break
+            tokens += message_tokens
+            end -= 1
+        return end
+
+    def fold(self, owner_id, chat_id, conversation, summary, covered):
+        """Folds the older unsummarized messages into the summary and stores it"""
+        try:
+            end = self.split(conversation, covered)
+            if end <= covered:
+                return
+            messages = "\n\n".join(
+                f"{message['role']}: {message['content']}"
+                for message in conversation[covered:end]
+            )
+            new_summary = llm.complete(
+                [
+                    {"role": "system", "content": summarizer_system_message},
+                    {
+                        "role": "user",
+                        "content": f"Current summary:\n{summary or '(empty)'}\n\n"
+                        f"Messages that followed:\n{messages}",
+                    },
+                ],
+                models=[self.model],
+                temperature=0.2,
+                max_tokens=MEMORY_SUMMARY_TOKENS,
+            )
+            DataBase().upsert_chat_summary(
+                owner_id, chat_id, new_summary, end, prefix_hash(conversation, end)
+            )
+            print(f"memory: folded messages {covered}-{end} of chat {chat_id}")
+        except Exception as e:
+            print("memory: fold failed for chat", chat_id, e)
+        finally:
+            with self._lock:
+                self.folding.discard((owner_id, chat_id))
+
+
+conversation_memory = ConversationMemory()
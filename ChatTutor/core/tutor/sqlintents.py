@@ -0,0 +1,166 @@
+"""
+Deterministic routing of the common CQN database questions to prepared queries.
+
+"papers by Lukin", "who wrote <title>", "how many papers about entanglement": these
+used to go through the Gemini text-to-SQL call of `SQLQueryTutor` and
+`DataBase.safe_exec`. `SQLIntentRouter` recognizes them with regular expressions
+and maps them to `DataBase.cqn_template_query`, parameterized queries on `Author`,
+`Publication` and `PublicationAuthorLink`. Anything it does not recognize (or
+that refers to earlier messages) still goes to the LLM.
+"""
+
+import os
+import re
+
+SQL_INTENT_ROUTER = os.getenv("SQL_INTENT_ROUTER", "1") == "1"
+
+PAPERS = r"(?:papers?|publications?|articles?|works)"
+NAME = r"(?P<author>[a-z][\w.\-']*(?:\s+[a-z][\w.\-']*){0,3})"
+TOPIC = r"(?P<topic>[a-z][\w\-]*(?:\s+[\w\-]+){0,5})"
+IN_DB = r"(?:\s+(?:are\s+(?:there\s+)?)?(?:in|from)\s+(?:the\s+)?(?:cqn\s+)?(?:database|db))?"
+
+# "please give me all the ..." -> "..."
+REQUEST_PREFIX = re.compile(
+    r"^(?:(?:please|can you|could you|would you|hey)\s+)*"
+    r"(?:(?:give me|list|show me|show|find|get me|get|tell me|what are|which are|"
+    r"i need|i want|search for|look for)\s+)?"
+    r"(?:(?:all|every|of|the|some)\s+)*"
+)
+
+# words that make a question depend on the previous messages
+REFERENCES = set("it this that these those them him her he she they".split())
+# words that add a second condition ("papers by X about Y", "... since 2020"), left to the LLM
+CONNECTORS = set(
+    "about on in by from since after before with and or between during "
+    "published written related not".split()
+)
+# "titles" made of these words only do not name a paper
+PAPER_WORDS = {"paper", "papers", "article", "publication"}
+
+
+class SQLIntent:
+    """
+    A recognized question
+
+    Attributes
+    ----------
+    name : str
+        query of `DataBase.cqn_template_query`
+    params : dict
+        its values
+    """
+
+    def __init__(self, name, **params):
+        self.name = name
+        self.params = params
+
+    def __repr__(self):
+        params = ", ".join(f"{key}={value!r}" for key, value in self.params.items())
+        return f"TEMPLATE {self.name}({params})"
+
+
+def author_surname(name):
+    """Names are stored as initials and family name, so only the family name is matched"""
+    words = [word.strip(".'-") for word in name.split()]
+    words = [word for word in words if word and word not in ("et", "al", "and")]
+    return words[-1] if words else ""
+
+
+class SQLIntentRouter:
+    """
+    Matches a question against the known patterns, in order.
+
+    Attributes
+    ----------
+    enabled : bool
+        whether questions are routed at all
+    patterns : list[tuple[str, re.Pattern]]
+        (query name, pattern matched against the whole normalized question)
+    """
+
+    def __init__(self, enabled=SQL_INTENT_ROUTER):
+        self.enabled = enabled
+        self.patterns = [
+            (
+                "count_papers",
+                re.compile(
+                    rf"how many {PAPERS}{IN_DB}(?:\s+(?:are there|exist|do you have))?"
+                ),
+            ),
+            (
+                "count_papers_about",
+                re.compile(
+                    rf"how many {PAPERS}{IN_DB}(?:\s+(?:are there|exist|do you have))?"
+                    rf"\s+(?:about|on|regarding|related to|mentioning|mention)\s+{TOPIC}"
+                ),
+            ),
+            (
+                "papers_by_author",
+                re.compile(
+                    rf"{PAPERS}(?:\s+(?:written|published|authored))?\s+by\s+{NAME}"
+                ),
+            ),
+            (
+                "papers_by_author",
+                re.compile(
+                    rf"what(?: {PAPERS})? (?:has|did) {NAME} (?:write|written|publish|published)"
+                ),
+            ),
+            (
+                "authors_of_paper",
+                re.compile(
+                    r"(?:who (?:wrote|authored|are the authors of|is the author of)|authors? of)"
+                    r"\s+(?:the\s+)?(?:paper|article|publication)?\s*(?P<title>.{3,200})"
+                ),
+            ),
+            (
+                "papers_about",
+                re.compile(
+                    rf"{PAPERS}{IN_DB}\s+(?:about|on|regarding|related to|mentioning)\s+{TOPIC}"
+                ),
+            ),
+        ]
+
+    @staticmethod
+    def normalize(prompt):
+        prompt = " ".join(prompt.lower().split())
+        prompt = prompt.strip(" ?!.")
+        return REQUEST_PREFIX.sub("", prompt)
+
+    def route(self, prompt):
+        """The `SQLIntent` of a question, or None if the LLM should write the query"""
+        if not self.enabled or not prompt:
+            return None
+        question = self.normalize(prompt)
+        for name, pattern in self.patterns:
+            match = pattern.fullmatch(question)
+            if match is None:
+                continue
+            params = {
+                key: value.strip(" \"'`") for key, value in match.groupdict().items()
+            }
+            if any(value in REFERENCES for value in params.values()):
+                return None
+            words = set(
+                " ".join(params.get(key, "") for key in ("author", "topic")).split()
+            )
+            if words & CONNECTORS:
+                return None
+            if "author" in params:
+                params["author"] = author_surname(params["author"])
+                if len(params["author"]) < 2:
+                    return None
+            if "title" in params:
+                title_words = params["title"].split()
+                # "who wrote the paper", "... the paper on it", "... the paper about x"
+                if (
+                    set(title_words) <= PAPER_WORDS
+                    or set(title_words) & REFERENCES
+                    or title_words[0] in CONNECTORS
+                ):
+                    return None
+            return SQLIntent(name, **params)
+        return None
+
+
+sql_intent_router = SQLIntentRouter()
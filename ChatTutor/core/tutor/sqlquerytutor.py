@@ -8,11 +8,25 @@ from core.tutor.tutor import Tutor
 from abc import ABC, ABCMeta, abstractmethod
 from enum import Enum
 from nice_functions import pprint, bold, green, blue, red, time_it
+import os
 from core.tutor.utils import truncate_to_x_number_of_tokens, get_number_of_tokens
+from core.tutor.utils import run_concurrently
+from core.tokenbudget import truncate_rows, truncate_tokens
 from core.data import DataBase
+from core.data.schemaprompt import cqn_schema_prompt
+from core.data.paperindex import paper_index
+from core.tracing import annotate, span
+from core.tutor.sqlintents import sql_intent_router
+
+# seconds each pre-answer classification call may take before its default is used
+CLASSIFICATION_TIMEOUT = float(os.getenv("CLASSIFICATION_TIMEOUT", 15))
+# tokens of sql prequery result rows allowed in the system message
+SQL_DATA_TOKEN_BUDGET = int(os.getenv("SQL_DATA_TOKEN_BUDGET", 3000))
 
 
 class SQLQueryTutor(Tutor):
+    sql_tables = ("publication", "author", "publicationauthorlink")
+
     def __init__(
         self,
         embedding_db,
@@ -34,50 +48,17 @@ class SQLQueryTutor(Tutor):
 
         # print("entering get_type_of_question")
         required_level_of_information = time_it(
-            self.genai_model.generate_content, "required_level_of_information"
+            self.simple_gemini, "required_level_of_information"
         )(
             [
                 f"""
-            You are a research assistant that helps with SQL queries in the CQN database containing the following tables:
-            (The tables are written in SQLModel).
+            You are a research assistant that helps with SQL queries in the CQN database containing the following tables,
+            one per line as table(column type, ...), where PK marks the primary key and -> the column a foreign key points to.
+            Use the author table if the user asks about scientists as well!
             
             Tables:
             
-            'author' -> table name (to use in sql query)
-            Use this table if user asks about scientists as well!
-
-            'author' table implementation:
-            ```
-            {open('core/data/models/Author.py','r').read()}
-            ```
-            ----------------------------
-            'publication' -> table name (to use in sql query)
-            
-            'publication' table implemnetation:
-            ```
-            {open('core/data/models/Publication.py','r').read()}
-            ```
-            ----------------------------
-            'citations' -> table name (to use in sql query)
-            
-            'citations' table implemnetation:
-            ```
-            {open('core/data/models/Citations.py','r').read()}
-            ```
-            ----------------------------
-            'publicationauthorlink' -> table name (to use in sql query)
-            
-            'publicationauthorlink' table implemnetation:
-            ```
-            {open('core/data/models/PublicationAuthorLink.py','r').read()}
-            ```
-            ----------------------------
-            'publicationcitationlink' -> table name (to use in sql query)
-            
-            'publicationcitationlink' table implemnetation:
-            ```
-            {open('core/data/models/PublicationAuthorLink.py','r').read()}
-            ```
+            {cqn_schema_prompt()}
             
             You will be asked questions about these tables, and you have to respond with sql queries.
             Keep in mind that the fields will not be provided and will not match in exact form, so you
@@ -151,10 +132,9 @@ class SQLQueryTutor(Tutor):
                 content of the papers, simply write 'CHROMA' and nothing else.""",
             ]
         )
-        required_level_of_information.resolve()
         print("\nREQUIRED LEVEL OF INFO\n\n\n", required_level_of_information)
 
-        return required_level_of_information.text
+        return required_level_of_information
 
     def get_required_type_of_information(self, prompt, explain=False):
         return "CONTENT"
@@ -166,7 +146,7 @@ class SQLQueryTutor(Tutor):
 
         # print("entering get_type_of_question")
         required_level_of_information = time_it(
-            self.genai_model.generate_content, "required_level_of_information"
+            self.simple_gemini, "required_level_of_information"
         )(
             [
                 f"""
@@ -190,8 +170,7 @@ class SQLQueryTutor(Tutor):
                 based on what the user wants to know about!""",
             ]
         )
-        required_level_of_information.resolve()
-        return required_level_of_information.text
+        return required_level_of_information
 
     def process_prompt(
         self, conversation, from_doc=None, threshold=0.5, limit=3, pipeline="openai"
@@ -204,11 +183,28 @@ class SQLQueryTutor(Tutor):
         conversation = self.truncate_conversation(conversation)
 
         prompt = conversation[-1]["content"]
-        required_level_of_information = self.get_required_level_of_information(prompt=prompt)
+        # common database questions get a prepared query, the LLM writes the others
+        sql_intent = sql_intent_router.route(prompt) if self.prequery else None
+        annotate(sql_intent=sql_intent.name if sql_intent else None)
+        classifications = {
+            "type": (
+                lambda: self.get_required_type_of_information(prompt=prompt),
+                CLASSIFICATION_TIMEOUT,
+                "CONTENT",
+            ),
+        }
+        if sql_intent is None:
+            # "NONE" skips the sql prequery
+            classifications["level"] = (
+                lambda: self.get_required_level_of_information(prompt=prompt),
+                CLASSIFICATION_TIMEOUT,
+                "NONE",
+            )
+        # the classification calls are independent, they run at the same time
+        classification = time_it(run_concurrently)(classifications)
+        required_level_of_information = classification.get("level", repr(sql_intent))
         pprint("required_level_of_information ", green(required_level_of_information))
-        required_type_of_information = self.get_required_type_of_information(prompt=prompt).strip(
-            " "
-        )
+        required_type_of_information = classification["type"].strip(" ")
         pprint("required_type_of_information ", "|", green(required_type_of_information), "|")
 
         # todo: fix prompt to take context from all messages
@@ -230,18 +226,23 @@ class SQLQueryTutor(Tutor):
         show_limit = 0
 
         if "cqn_openaicol_ttv" in str(self.collections.items()):
+            # embed the prompt once, every collection is queried with the same embedding
+            prompt_embedding = None
+            if self.embedding_db:
+                prompt_embedding = time_it(self.embedding_db.embed_query)(prompt)
             for coll_name, coll_desc in self.collections.items():
                 # if is_generic_message:
                 #    continue
                 if self.embedding_db:
                     keep_only_first_x_tokens_for_processing = None  # none means all
+                    query_collection = coll_name
                     if (
                         coll_name == "cqn_openaicol_ttv"
                         and "TITLE" == required_type_of_information.strip()
                     ):
                         pprint(red("TTL"), green(required_type_of_information.strip()))
 
-                        self.embedding_db.load_datasource(f"{coll_name}_titles")
+                        query_collection = f"{coll_name}_titles"
                         query_limit = 100
                         process_limit = 20  # each basic entry has close to 100 tokens
                         show_limit = 0
@@ -259,14 +260,12 @@ class SQLQueryTutor(Tutor):
                         and "CONTENT" == required_type_of_information.strip()
                     ):
                         pprint(red("CONT"), green(required_type_of_information.strip()))
-                        self.embedding_db.load_datasource(coll_name)
                         query_limit = 10
                         process_limit = 3  # each is close to 800
                         show_limit = 3
                     elif coll_name == "cqn_openaicol_ttv":
                         pprint(red("DEF"), green(required_type_of_information.strip()))
 
-                        self.embedding_db.load_datasource(f"{coll_name}")
                         query_limit = 10
                         process_limit = 3  # each is close to 800
                         show_limit = 3
@@ -274,7 +273,7 @@ class SQLQueryTutor(Tutor):
                     pprint(
                         "\nQuerying embedding_db with prompt:",
                         blue(prompt),
-                        self.embedding_db.datasource,
+                        query_collection,
                     )
 
                     (
@@ -282,20 +281,30 @@ class SQLQueryTutor(Tutor):
                         metadatas,
                         distances,
                         documents_plain,
-                    ) = time_it(
-                        self.embedding_db.query
-                    )(prompt, query_limit, from_doc, metadatas=True)
+                        ranks,
+                    ) = time_it(self.embedding_db.query)(
+                        prompt,
+                        query_limit,
+                        from_doc,
+                        metadatas=True,
+                        collection_name=query_collection,
+                        query_embedding=prompt_embedding,
+                        hybrid=True,
+                        ranks=True,
+                    )
 
                     if required_level_of_information == "TITLE_CONTENT":
                         a = 0
 
                     pprint(rf"got {len(documents)} documents")
-                    for doc, meta, dist in zip(documents, metadatas, distances):
+                    for doc, meta, dist, rank in zip(documents, metadatas, distances, ranks):
                         pprint(green(doc), dist, "\n")
                         # if no fromdoc specified, and distance is lowe thhan thersh, add to array of possible related documents
                         # if from_doc is specified, threshold is redundant as we have only one possible doc
+                        # lexical hits are kept whatever their embedding distance
                         if (
                             dist <= threshold
+                            or rank["lexical"]
                             or from_doc != None
                             or pipeline == "gemini"
                             or pipeline
@@ -308,11 +317,11 @@ class SQLQueryTutor(Tutor):
                                     "doc": doc,
                                     "metadata": meta,
                                     "distance": dist,
+                                    "score": rank["score"],
                                 }
                             )
-            sorted_docs = sorted(arr, key=lambda el: -el["distance"])
-            if pipeline == "openai":
-                sorted_docs = sorted(arr, key=lambda el: el["distance"])
+            # by fused (vector + lexical) score, across the collections
+            sorted_docs = sorted(arr, key=lambda el: -el["score"])
 
             valid_docs = sorted_docs[:process_limit]
 
@@ -335,6 +344,15 @@ class SQLQueryTutor(Tutor):
                 docs = f"If the user is talking about 'this paper', he's probably refering to the paper with the id {from_doc}. You WILL find it's title below!"
             i = 0
             vd = []
+            doc_texts = []
+            # papers and authors of all the docs at once, from the in-memory index
+            with span("sql.enrich", docs=len(valid_docs)):
+                enrichment = paper_index.lookup(
+                    [
+                        doc["metadata"].get("title", None) or doc["metadata"].get("doc", None)
+                        for doc in valid_docs
+                    ]
+                )
             for doc in valid_docs:
 
                 doc_title_or_file_name = doc["metadata"].get("title", None) or doc["metadata"].get(
@@ -343,9 +361,10 @@ class SQLQueryTutor(Tutor):
 
                 id = doc_title_or_file_name
 
-                papers, _ = DataBase().get_paper_by_name(id)
-                paper = papers[0]
-                authors, _ = DataBase().get_authors_of_paper(id)
+                if id not in enrichment:
+                    print(red("paper not found:"), id)
+                    continue
+                paper, authors = enrichment[id]
                 # print("\n\n", green("Paper:"))
                 # print(red(paper))
                 doc_authors = ""
@@ -353,12 +372,16 @@ class SQLQueryTutor(Tutor):
                 doc_authors = doc["metadata"].get("authors", None)
                 if doc_authors == None:
                     doc_authors = f"{authors}"
-                    doc["metadata"]["title"] = paper["title"]
-                    doc["metadata"]["id"] = doc_title_or_file_name
-                    doc["metadata"]["authors"] = authors
-                    doc["metadata"]["entry_id"] = paper["link"]
-                    doc["metadata"]["links"] = paper["link"]
-                    doc["metadata"]["elaborate"] = True
+                    # a new dict, the retrieved metadata may be shared with the indexes
+                    doc["metadata"] = {
+                        **doc["metadata"],
+                        "title": paper["title"],
+                        "id": doc_title_or_file_name,
+                        "authors": authors,
+                        "entry_id": paper["link"],
+                        "links": paper["link"],
+                        "elaborate": True,
+                    }
                     doc_authors += rf" by '{doc_authors}'"
                 i += 1
                 vd.append(doc)
@@ -389,8 +412,10 @@ class SQLQueryTutor(Tutor):
                 )
 
                 doc_reference = "-" * 100 + f"\n{doc_content}\n\n"
-                docs += doc_reference
+                doc_texts.append(doc_reference)
                 # print('#### COLLECTION DB RESPONSE:', collection_db_response)
+            vd, doc_texts = self.pack_docs(vd, doc_texts)
+            docs += "".join(doc_texts)
             # debug log
         pprint("collections", self.collections)
         pprint("len collections", len(self.collections))
@@ -420,12 +445,23 @@ class SQLQueryTutor(Tutor):
             query_text = "NONE"
             sql_query_data = None
             if query != "NONE" and from_doc == None:
-                sql_query_data, s = DataBase().safe_exec(query=query)
+                with span("sql.prequery", template=sql_intent is not None):
+                    if sql_intent is not None:
+                        sql_query_data, s = DataBase().cqn_template_query(
+                            sql_intent.name, **sql_intent.params
+                        )
+                    else:
+                        sql_query_data, s = DataBase().safe_exec(query=query)
                 if s == False or sql_query_data == []:
                     query = "NONE"
                     query_text = "NONE"
                 else:
-                    query_text = f"Below you will find a json variable called sql_query_data which will contain RELEVANT INFORMATION TO THE USER QUERY THAT SHOULD BE PROVIDED TO THE USER IF PRESENT REGARDLESS OF WHAT YOU WERE PROVIDED ABOVE! IF THE sql_query_data IS NOT EMPTY, IGNORE ALL OF THE DATA ABOVE AS IT IS IRRELEVANT. IRRELEVANT. PROVIDE ONLY THE sql_query_data in a user friendly way. IF THE USER IS ASKING ABOUT AUTHORS, IDS, OR PAPER TITLES, OR PAPERS OF AUTHORS, OR AUTHORS OF PAPERS, OR LISTINGS OF THE DB, USE ONLY THE INFORMATION THAT IS PROVIDED TO YOU BELOW IN THE CQN DIRECT QUERY!! If the user isn't asking about a document's content or a broad topic, or related papers etc, on query, ignore the data above, and Provide this data exactly, in markdown form, stating that it is from the CQN DB: \n```\nsql_query_data={sql_query_data}\n # !! PROVIDE THIS TO THE USER, AS IT IS RELEVANT CQN DB INFORMATION\n```\n.  This is the only info you will provide in this message about CQN DB. If paper ids are present above, also provide them as well! As well as links to arxiv or scholar of the paper, and of the author if present. DO NOT PROVIDE ANY OTHER INFORMATION YOU MIGHT KNOW OUTSIDE THIS INFO AND CQN INFO UNLESS EXPLICITLY ASKED SO BY THE USER!"
+                    # whole rows only, a row cut in half reads as wrong data
+                    if isinstance(sql_query_data, list):
+                        sql_rows = truncate_rows(sql_query_data, SQL_DATA_TOKEN_BUDGET)
+                    else:
+                        sql_rows = truncate_tokens(str(sql_query_data), SQL_DATA_TOKEN_BUDGET)
+                    query_text = f"Below you will find a json variable called sql_query_data which will contain RELEVANT INFORMATION TO THE USER QUERY THAT SHOULD BE PROVIDED TO THE USER IF PRESENT REGARDLESS OF WHAT YOU WERE PROVIDED ABOVE! IF THE sql_query_data IS NOT EMPTY, IGNORE ALL OF THE DATA ABOVE AS IT IS IRRELEVANT. IRRELEVANT. PROVIDE ONLY THE sql_query_data in a user friendly way. IF THE USER IS ASKING ABOUT AUTHORS, IDS, OR PAPER TITLES, OR PAPERS OF AUTHORS, OR AUTHORS OF PAPERS, OR LISTINGS OF THE DB, USE ONLY THE INFORMATION THAT IS PROVIDED TO YOU BELOW IN THE CQN DIRECT QUERY!! If the user isn't asking about a document's content or a broad topic, or related papers etc, on query, ignore the data above, and Provide this data exactly, in markdown form, stating that it is from the CQN DB: \n```\nsql_query_data={sql_rows}\n # !! PROVIDE THIS TO THE USER, AS IT IS RELEVANT CQN DB INFORMATION\n```\n.  This is the only info you will provide in this message about CQN DB. If paper ids are present above, also provide them as well! As well as links to arxiv or scholar of the paper, and of the author if present. DO NOT PROVIDE ANY OTHER INFORMATION YOU MIGHT KNOW OUTSIDE THIS INFO AND CQN INFO UNLESS EXPLICITLY ASKED SO BY THE USER!"
 
             if from_doc != None:
                 query_text = "IF YOU CAN USE THE RELEVANT SECTIONS ABOVE TO ANSWER QUESTIONS THE USER ASKS ABOUT THE PAPER, PLEASE QUOTE THE PART OF THE DOCUMENT YOU GOT YOUR INFO FROM. DO NOT COPY-PASTE THE WHOLE DOCUMENTS. OTHERWISE STATE THAT IT'S GENERAL KNOWLEDGE/WELL KNOWN, IF THE INFORMATION IS NOT FROM THE ABOVE DOCUMENTS/PAPERS. IF THE INFORMATION ASKED BY THE USER IS NOT STATED IN THE ABOVE DOCUMENTS, FEEL FREE TO USE YOUR OWN KNOWLEDGE, HOWEVER STATE THAT YOU DID SO, AND THAT YOU CAN'T FIND THE ANSWER IN THE PAPER, NEVERTHELESS ANSWER THE QUESTION, AND STATE THAT IF THE USER WANTS TO SEARCH FOR THIS TOPIC IN THE PAPER HE SHOULD BE MORE PRECISE WITH HIS QUERY. DO NOT LET THE USER WITHOUT AN ANSWER! DO NOT LET THE USER WITH NO ANSWER! HELP THE USER FIND THE ANSWER TO HIS/HER QUESTION!!! "
@@ -478,12 +514,12 @@ class SQLQueryTutor(Tutor):
                         json_papers = None
 
             print(red(query_text))
-            messages[0]["content"] = messages[0]["content"][:12000]
+            # the docs in the system message are already within the context budget
             messages[0]["content"] += (
                 "Be as concise as possible! USE ONLY THE INFORMATION THAT WAS PROVIDED TO YOU IN THESE MESSAGES!! "
                 if query_text == "NONE"
                 else "\n\nCQN DIRECT QUERY: "
-                + query_text[:12000]
+                + query_text
                 + " PRESENT THIS IN A USER FRIENDLY ERROR NOT OMMITING ANY DATA FROM IT! IF THE USER ASKS ABOUT A TOPIC/ PROCEDURE/ EFFECT/ OR SOMETHING THAT COULD BE CONTAINED IN A PAPER, USE THE RELEVANT SECTIONS TO RESPOND ACCORDINGLY."
             )
 
@@ -0,0 +1,144 @@
+"""
+Server-sent events encoding of the tutor responses.
+
+The LLM streams one delta per token; sending each of them as its own SSE frame
+costs a `json.dumps` and a write per token. `SSEEncoder` merges consecutive
+content deltas into one frame until either `max_chars` characters are buffered
+or `max_delay` seconds passed since the first buffered delta. Any other message
+(sources, timings, errors, the final empty delta the frontend uses as end of
+message) flushes the buffer and is sent as is, so the order of the stream is kept.
+
+Frames keep the shape the clients parse:
+
+    data: {"time":float,"message":{...}}\\n\\n
+
+written without whitespace, with the time in milliseconds precision.
+"""
+
+import json
+import os
+import time
+
+# coalescing window of the content deltas
+SSE_COALESCE_CHARS = int(os.getenv("SSE_COALESCE_CHARS", 48))
+SSE_COALESCE_SECONDS = float(os.getenv("SSE_COALESCE_SECONDS", 0.05))
+
+
+def is_content_delta(message):
+    """True for messages that only carry a piece of the answer"""
+    return len(message) == 1 and isinstance(message.get("content"), str)
+
+
+def encode_event(elapsed, message):
+    """One SSE frame, `message` being a dict"""
+    return (
+        f'data: {{"time":{elapsed:.3f},"message":'
+        f'{json.dumps(message, separators=(",", ":"))}}}\n\n'
+    )
+
+
+def encode_content(elapsed, content):
+    """One SSE frame of a content delta (skips building and dumping a dict)"""
+    return f'data: {{"time":{elapsed:.3f},"message":{{"content":{json.dumps(content)}}}}}\n\n'
+
+
+class FrameBuffer:
+    """
+    Coalescing state of one stream
+
+    Attributes
+    ----------
+    start_time : float
+        `time.time()` the frame times are relative to
+    """
+
+    def __init__(self, max_chars, max_delay, start_time):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self.start_time = start_time
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_start = 0.0
+
+    def flush(self, now=None):
+        """Frame of the buffered deltas, or None if there are none"""
+        if not self.buffer:
+            return None
+        now = time.time() if now is None else now
+        frame = encode_content(now - self.start_time, "".join(self.buffer))
+        self.buffer, self.buffered = [], 0
+        return frame
+
+    def feed(self, message):
+        """Frames (0, 1 or 2) ready to be sent after `message`"""
+        now = time.time()
+        if is_content_delta(message):
+            if not message["content"]:
+                return []
+            if not self.buffer:
+                self.buffer_start = now
+            self.buffer.append(message["content"])
+            self.buffered += len(message["content"])
+            if (
+                self.buffered >= self.max_chars
+                or now - self.buffer_start >= self.max_delay
+            ):
+                return [self.flush(now)]
+            return []
+        frames = [self.flush(now)] if self.buffer else []
+        frames.append(encode_event(now - self.start_time, dict(message)))
+        return frames
+
+
+class SSEEncoder:
+    """
+    Turns the messages yielded by `Tutor.ask_question` (or `Tutor.aask_question`)
+    into SSE frames.
+
+    The window is checked when a delta arrives, so a frame waits at most for the
+    next delta after `max_delay` (the stream is pulled, there is no timer).
+
+    Attributes
+    ----------
+    max_chars : int
+        buffered characters that trigger a frame
+    max_delay : float
+        seconds after the first buffered delta that trigger a frame
+    """
+
+    def __init__(self, max_chars=SSE_COALESCE_CHARS, max_delay=SSE_COALESCE_SECONDS):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+
+    def frame_buffer(self, start_time=None):
+        start_time = time.time() if start_time is None else start_time
+        return FrameBuffer(self.max_chars, self.max_delay, start_time)
+
+    def encode(self, messages, start_time=None):
+        """
+        Args:
+            messages (Iterable[dict]): messages of the response
+            start_time (float, optional): `time.time()` the frame times are relative to
+
+        Yields:
+            str: SSE frames
+        """
+        frames = self.frame_buffer(start_time)
+        for message in messages:
+            yield from frames.feed(message)
+        last = frames.flush()
+        if last is not None:
+            yield last
+
+    async def aencode(self, messages, start_time=None):
+        """`encode` over an async iterable of messages"""
+        frames = self.frame_buffer(start_time)
+        async for message in messages:
+            for frame in frames.feed(message):
+                yield frame
+        last = frames.flush()
+        if last is not None:
+            yield last
+
+
+sse_encoder = SSEEncoder()
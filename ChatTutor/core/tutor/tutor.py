@@ -2,10 +2,10 @@ from abc import ABCMeta, ABC, abstractmethod, abstractclassmethod, abstractstati
 
 from copy import deepcopy
 from core.openai_tools import OPENAI_DEFAULT_MODEL
-import openai
-import tiktoken
+import asyncio
 import time
 import json
+from core import tokenbudget
 from core.extensions import stream_text
 from nice_functions import pprint, bold, green, blue, red, time_it, time_it_r
 from core.tutor.systemmsg import (
@@ -13,15 +13,35 @@ from core.tutor.systemmsg import (
     default_system_message,
     interpreter_system_message,
 )
+from core.tutor.contextpacker import CONTEXT_TOKEN_BUDGET, pack_context
+from core.tutor.intent import FOLLOW_UP, STANDALONE, intent_classifier, previous_context
+from core.tutor.streaming import sse_encoder
+from core.tutor.answercache import AnswerRecorder, answer_cache, replay_answer
+from core.tracing import annotate, span, traced
+from core.llmclient import GEMINI_DEFAULT_MODEL, llm
 from core.tutor.utils import (
     remove_score_and_doc_from_valid_docs,
     yield_docs_and_first_sentence_if_tutor_id_not_apologizing,
     yield_docs,
 )
-import google.generativeai as genai
 from core.data import DataBase
 from core.data.parsing.papers.json_papers import JSONPaperParser
 
+# yielded instead of the answer when the LLM call fails
+ERROR_MESSAGES = (
+    {"content": "", "valid_docs": []},
+    {
+        "content": """\n\nSorry, I am not able to provide a response. 
+                                
+                                One of three things happened:
+                                    - The context you provided was too wide, try to be more concise.
+                                    - The files you uploaded were too large
+                                    - I got disconnected from the server or I am currently being updated
+                                """,
+        "error": "true",
+    },
+)
+
 
 class Tutor(ABC):
     """
@@ -37,6 +57,9 @@ class Tutor(ABC):
         collection to load from.
     """
 
+    # SQL tables the answers are built from (writes to them drop the cached answers)
+    sql_tables = ()
+
     def __init__(
         self,
         embedding_db,
@@ -62,8 +85,10 @@ class Tutor(ABC):
         self.collections = {}
         self.system_message = system_message
         self.engineer_prompts = engineer_prompts
-        self.genai_model = genai.GenerativeModel("gemini-pro")
-        self.chat = self.genai_model.start_chat(history=[])
+        if embedding_db is not None:
+            answer_cache.attach(embedding_db)
+        if self.sql_tables:
+            answer_cache.attach_database(DataBase())
 
     def add_collection(self, name, desc):
         """Adds a collection to self.collections
@@ -73,6 +98,7 @@ class Tutor(ABC):
         """
         self.collections[name] = desc
 
+    @traced("engineer_prompt")
     def engineer_prompt(self, conversation, truncating_at=10, context=True):
         """
         Args:
@@ -106,31 +132,25 @@ class Tutor(ABC):
         #     """,
         #     f"If the usere were to ask this: '{prompt}', would you clasify it as a message that refers to above messages from context? Respond only with YES or NO!",
         # )
-        is_furthering_message = time_it(self.simple_gpt, "is_furthering_message")(
-            f"""
-            You are a model that detects weather a user given message refers to above messages and takes context from them, either by asking about further explanations on a topic discussed previously, or on a topic you just provided answer to. 
-            Respond ONLY with YES or NO.
-                - YES if the the user asks for an equation, or a summary, or more information, and he does not say where to get it from, but a paper was mentioned before.
-                - YES if the user provided message is a message that refers to above messages from context (ie, uses the word 'it' to referes to a previus paper), or if the user refers with pronouns about people mentioned in the above messages, or if the user thanks you for a given information or asks more about it, or invalidates or validates a piece of information you provided.
-                - NO if the message is a standalone message
-            
-            The current conversation between the user and the bot is:
-            
-            {truncated_convo}
-            """,
-            f"If the usere were to ask this: '{prompt}', would you clasify it as a message that refers to above messages from context? Respond only with YES or NO!",
-        )
-        pprint("truncated_convo", truncated_convo)
+        # standalone vs follow-up is decided locally, the LLM only sees the unsure messages
+        embed = None
+        if self.embedding_db and getattr(self.embedding_db, "embedding_function", None):
+            embed = self.embedding_db.embed_queries
+        with span("intent") as intent_span:
+            intent, intent_score = time_it(intent_classifier.classify)(conversation, embed)
+            intent_span.set(intent=intent, score=intent_score)
+        pprint("intent", intent, intent_score)
+
         get_furthering_message = "NO"
         is_generic_message = is_generic_message.strip() == "YES"
-        is_furthering_message = is_furthering_message.strip() == "YES"
-
-        pprint("is_generic_message", is_generic_message)
-        pprint("is_furthering_message", is_furthering_message)
-        pprint("get_furthering_message", get_furthering_message)
-
-        if is_furthering_message:
-            pprint("getting contex...")
+        if intent == STANDALONE:
+            is_furthering_message = False
+        elif intent == FOLLOW_UP:
+            is_furthering_message = True
+            get_furthering_message = "YES " + previous_context(conversation)
+        else:
+            pprint("truncated_convo", truncated_convo)
+            # a single call both decides and writes the context summary
             get_furthering_message = time_it(self.simple_gpt, "get_furthering_message")(
                 f"""
                 You are a model that detects weather a user given message refers to above messages and takes context from them, either by asking about further explanations on a topic discussed previously, or on a topic
@@ -138,17 +158,24 @@ class Tutor(ABC):
                     - YES + a small summary of what the user message is refering to, the person the user is refering to if applicable, or the piece of information the user is refering to, if the user provided message is a message that refers to above messages from context, or if the user refers with pronouns about people mentioned in the above messages,
                     or if the user thanks you for a given information or asks more about it, or invalidates or validates a piece of information you provided . You must attach a small summary of what the user message is refering to,
                     but you still have to maintain the user's question and intention. The summary should be rephrased from the view point of the user, as if the user formulated the question to convey the context the user is refering to. This is really important!
-                
+                    - NO if the message is a standalone message
+
                 The current conversation between the user and the bot is:
-                
+
                 {truncated_convo}
                 """,
                 f"If the usere were to ask this: '{prompt}', would you clasify it as a message that refers to above messages from context? If YES, provide a small summary of what the user would refer to.",
             )
+            is_furthering_message = get_furthering_message.strip().upper().startswith("YES")
+
+        pprint("is_generic_message", is_generic_message)
+        pprint("is_furthering_message", is_furthering_message)
+        pprint("get_furthering_message", get_furthering_message)
+
         if not is_furthering_message:
             get_furthering_message = "NO"
         if is_furthering_message:
-            prompt += f"\n({get_furthering_message[4:]})"
+            prompt += f"\n({get_furthering_message.strip()[4:]})"
 
         pprint("engineered prompt", green(prompt))
 
@@ -217,17 +244,215 @@ class Tutor(ABC):
             {
                 "content" : str, # chunk content (part of the response)
                 "valid_docs" : Oprional[list], # documents the query used to gain information
-                # yielded only once at the begining
+                # yielded first, before the LLM is called, with "processing_prompt_time"
                 "elapsed_time" : seconds, # time taken to generate the first response chunk
                 "processing_prompt_time" : seconds # time taken to process prompt (gain context/use knowledge base etc.)
             }
             ```
+            then one message with "elapsed_time", once the LLM call started, then the deltas
         """
 
+        messages, valid_docs, processing_prompt_time = self.prepare_answer(
+            conversation, from_doc, threshold, limit, pipeline
+        )
+        # sources go out before the LLM call, so they are shown while the answer is generated
+        for yielded_chain in yield_docs(valid_docs):
+            yielded_chain["processing_prompt_time"] = processing_prompt_time
+            yield yielded_chain
+
+        # time to first token, and the whole LLM stream
+        stream_span = span("llm.stream", model=selectedModel, pipeline=pipeline)
+        first_token_span = span("llm.first_token", model=selectedModel, pipeline=pipeline)
+        try:
+            # returns once the first token arrived, from this model or a hedged one
+            response, elapsed_time = time_it_r(llm.stream)(
+                messages, **self.answer_arguments(messages, selectedModel, pipeline)
+            )
+            first_token_span.end()
+            yield {"content": "", "elapsed_time": elapsed_time}
+
+            for delta in response:
+                yield delta
+            stream_span.end()
+        except Exception as e:
+            import logging
+
+            logging.error("Error at %s", "division", exc_info=e)
+            stream_span.end(error=repr(e))
+            yield from deepcopy(ERROR_MESSAGES)
+        finally:
+            # no-ops if they ended above; otherwise the call failed or the client left
+            first_token_span.end(aborted=True)
+            stream_span.end(aborted=True)
+
+    async def aask_question(
+        self,
+        conversation,
+        from_doc=None,
+        selectedModel=OPENAI_DEFAULT_MODEL,
+        threshold=0.5,
+        limit=3,
+        pipeline="openai",
+    ):
+        """Async version of `ask_question`, yielding the same messages.
+
+        Prompt processing (retrieval, classification calls, SQL) is blocking and runs
+        in a worker thread; the LLM stream, which holds the request for most of its
+        time, is awaited on the event loop, so a process can keep many streams open.
+        """
+        messages, valid_docs, processing_prompt_time = await asyncio.to_thread(
+            self.prepare_answer, conversation, from_doc, threshold, limit, pipeline
+        )
+        for yielded_chain in yield_docs(valid_docs):
+            yielded_chain["processing_prompt_time"] = processing_prompt_time
+            yield yielded_chain
+
+        stream_span = span("llm.stream", model=selectedModel, pipeline=pipeline)
+        first_token_span = span("llm.first_token", model=selectedModel, pipeline=pipeline)
+        try:
+            st = time.time()
+            response = await llm.astream(
+                messages, **self.answer_arguments(messages, selectedModel, pipeline)
+            )
+            first_token_span.end()
+            yield {"content": "", "elapsed_time": time.time() - st}
+
+            async for delta in response:
+                yield delta
+            stream_span.end()
+        except Exception as e:
+            import logging
+
+            logging.error("Error at %s", "division", exc_info=e)
+            stream_span.end(error=repr(e))
+            for message in deepcopy(ERROR_MESSAGES):
+                yield message
+        finally:
+            # no-ops if they ended above; otherwise the call failed or the client left
+            first_token_span.end(aborted=True)
+            stream_span.end(aborted=True)
+
+    @traced("answer_cache")
+    def answer_cache_lookup(self, conversation, from_doc, selectedModel, pipeline="openai"):
+        """Looks the last message up in the answer cache (see `core.tutor.answercache`).
+
+        Only standalone questions are cached: the answer to a follow-up depends on the
+        rest of the conversation.
+
+        Returns:
+            None if the answer can not be cached, otherwise
+            (scope, prompt embedding, cache generation, cached `AnswerEntry` or None)
+        """
+        if not answer_cache.enabled or not self.collections:
+            return None
+        try:
+            label, _ = intent_classifier.classify(conversation, self.embedding_db.embed_queries)
+            if label != STANDALONE:
+                return None
+            embedding = self.embedding_db.embed_query(conversation[-1]["content"])
+        except Exception as e:
+            print(red("answer cache lookup failed: "), e)
+            return None
+        if embedding is None:
+            return None
+        scope = answer_cache.scope(
+            type(self).__name__,
+            self.collections,
+            from_doc,
+            selectedModel,
+            pipeline,
+            self.sql_tables,
+        )
+        generation = answer_cache.generation(scope)
+        entry = answer_cache.get(scope, embedding, conversation[-1]["content"])
+        annotate(hit=entry is not None)
+        return scope, embedding, generation, entry
+
+    def cached_ask_question(
+        self,
+        conversation,
+        from_doc=None,
+        selectedModel=OPENAI_DEFAULT_MODEL,
+        pipeline="openai",
+    ):
+        """`ask_question` through the answer cache: a cached answer to a close enough
+        question of the same section is replayed, otherwise the new answer is stored
+        once it was streamed completely."""
+        st = time.time()
+        cached = self.answer_cache_lookup(conversation, from_doc, selectedModel, pipeline)
+        if cached is None:
+            yield from self.ask_question(conversation, from_doc, selectedModel, pipeline=pipeline)
+            return
+        scope, embedding, generation, entry = cached
+        if entry is not None:
+            yield from replay_answer(entry, time.time() - st)
+            return
+
+        recorder = AnswerRecorder()
+        for message in self.ask_question(conversation, from_doc, selectedModel, pipeline=pipeline):
+            recorder.feed(message)
+            yield message
+        if recorder.complete:
+            answer_cache.put(
+                scope,
+                embedding,
+                generation,
+                conversation[-1]["content"],
+                recorder.answer,
+                recorder.valid_docs,
+            )
+
+    async def acached_ask_question(
+        self,
+        conversation,
+        from_doc=None,
+        selectedModel=OPENAI_DEFAULT_MODEL,
+        pipeline="openai",
+    ):
+        """Async version of `cached_ask_question`"""
         st = time.time()
-        messages, valid_docs = self.process_prompt(
-            conversation, from_doc, threshold, limit, pipeline=pipeline
+        cached = await asyncio.to_thread(
+            self.answer_cache_lookup, conversation, from_doc, selectedModel, pipeline
         )
+        if cached is None:
+            async for message in self.aask_question(
+                conversation, from_doc, selectedModel, pipeline=pipeline
+            ):
+                yield message
+            return
+        scope, embedding, generation, entry = cached
+        if entry is not None:
+            for message in replay_answer(entry, time.time() - st):
+                yield message
+            return
+
+        recorder = AnswerRecorder()
+        async for message in self.aask_question(
+            conversation, from_doc, selectedModel, pipeline=pipeline
+        ):
+            recorder.feed(message)
+            yield message
+        if recorder.complete:
+            answer_cache.put(
+                scope,
+                embedding,
+                generation,
+                conversation[-1]["content"],
+                recorder.answer,
+                recorder.valid_docs,
+            )
+
+    def prepare_answer(self, conversation, from_doc, threshold, limit, pipeline="openai"):
+        """Everything `ask_question` does before calling the LLM
+
+        Returns:
+            (messages for the LLM, valid docs to send to the client, processing time in seconds)
+        """
+        st = time.time()
+        with span("process_prompt", tutor=type(self).__name__):
+            messages, valid_docs = self.process_prompt(
+                conversation, from_doc, threshold, limit, pipeline=pipeline
+            )
 
         query = "NONE"
         if not isinstance(messages, list):
@@ -258,89 +483,53 @@ class Tutor(ABC):
         # print(green(messages[0]["content"]))
 
         # print(red(query_text))
-        try:
-            response, elapsed_time = [], 0.0
-            if pipeline == "gemini":
-                response = self.chat.send_message(
-                    [
-                        # these are the valid docs
-                        messages[0]["content"],
-                        "Use the data above to answer this question: " + messages[-1]["content"],
-                    ],
-                    stream=True,
-                )
-                elapsed_time = 0.0
-            else:
-                msgs = messages
-                # for i in range(len(msgs)):
-                #     msgs[i]["content"] = msgs[i]["content"][:12000]
-                response, elapsed_time = time_it_r(openai.ChatCompletion.create)(
-                    model=selectedModel,
-                    messages=msgs,
-                    temperature=0.7,
-                    frequency_penalty=0.0,
-                    presence_penalty=0.0,
-                    stream=True,
-                )
-
-            # first_sentence = rf"({required_level_of_information}) "
-            first_sentence = ""
-            first_sentence_processed = False
-
-            valid_docs = valid_docs[0:limit]
-            valid_docs = remove_score_and_doc_from_valid_docs(valid_docs)
-            pprint(red("VALID DOCS: "))
-            print("\n")
-            pprint(green(valid_docs))
-            print("\n\n\n")
-            for chunk in response:
-                # print(chunk)
-                if pipeline == "gemini":
-                    try:
-                        chunk = {"choices": [{"delta": {"content": chunk.text}}]}
-                    except:
-                        chunk = {"choices": [{"delta": {"content": "~"}}]}
-                # print(chunk)
-
-                # cache first setences to process it content and decide later on if we send or not documents
-                # print(first_sentence)
-                # print(len(first_sentence))
-                # # ifx
-                # print("yielding")
-                # print(first_sentence)
-                # print(len(first_sentence))
-
-                # process first sentence
-                if not first_sentence_processed:
-                    first_sentence_processed = True
-                    first_sentence += chunk["choices"][0]["delta"]["content"]
-                    print("first_sentence", green(first_sentence))
-                    for yielded_chain in yield_docs(valid_docs):
-                        yielded_chain["elapsed_time"] = elapsed_time
-                        yielded_chain["processing_prompt_time"] = processing_prompt_time
-                        pprint(red("\n\tCHAIN:\n"))
-                        pprint(green(yielded_chain))
-                        yield yielded_chain
-
-                # print("yielded\n")
-
-                yield chunk["choices"][0]["delta"]
-        except Exception as e:
-            import logging
+        valid_docs = valid_docs[0:limit]
+        valid_docs = remove_score_and_doc_from_valid_docs(valid_docs)
+        pprint(red("VALID DOCS: "))
+        print("\n")
+        pprint(green(valid_docs))
+        print("\n\n\n")
+        return messages, valid_docs, processing_prompt_time
+
+    @staticmethod
+    def gemini_parts(messages):
+        return [
+            # these are the valid docs
+            messages[0]["content"],
+            "Use the data above to answer this question: " + messages[-1]["content"],
+        ]
 
-            logging.error("Error at %s", "division", exc_info=e)
-            yield {"content": "", "valid_docs": []}
-            # An error occured
-            yield {
-                "content": """\n\nSorry, I am not able to provide a response. 
-                                
-                                One of three things happened:
-                                    - The context you provided was too wide, try to be more concise.
-                                    - The files you uploaded were too large
-                                    - I got disconnected from the server or I am currently being updated
-                                """,
-                "error": "true",
-            }
+    def answer_arguments(self, messages, selectedModel, pipeline="openai"):
+        """Arguments of the `llm.stream` call answering `messages`"""
+        return dict(
+            models=[GEMINI_DEFAULT_MODEL if pipeline == "gemini" else selectedModel],
+            # an answer from another model beats an error message
+            fallback=True,
+            temperature=0.7,
+            parts=self.gemini_parts(messages),
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+        )
+
+    def pack_docs(self, valid_docs, doc_texts, budget=CONTEXT_TOKEN_BUDGET):
+        """Keeps the documents worth their tokens within the context budget,
+        see `core.tutor.contextpacker`
+
+        Args:
+            valid_docs (list[dict]): candidate documents, closest first
+            doc_texts (list[str]): how each document is rendered in the system prompt
+            budget (int, optional): Defaults to CONTEXT_TOKEN_BUDGET.
+
+        Returns:
+            tuple[list[dict], list[str]]: the kept documents and their texts
+        """
+        valid_docs, doc_texts, dropped = pack_context(valid_docs, doc_texts, budget)
+        if dropped:
+            pprint(
+                red(f"context budget ({budget} tokens): dropped {len(dropped)} docs"),
+                [doc["metadata"].get("doc") for doc in dropped],
+            )
+        return valid_docs, doc_texts
 
     def count_tokens(self, string: str, encoding_name="cl100k_base") -> int:
         """Counting the number of tokens in a string using the specified encoding
@@ -352,9 +541,7 @@ class Tutor(ABC):
         Returns:
             int: number of tokens
         """
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+        return tokenbudget.count_tokens(string, encoding_name)
 
     def truncate_conversation(self, conversation, token_limit=10000):
         """Truncates the conversation to fit within the token limit
@@ -366,15 +553,11 @@ class Tutor(ABC):
         Returns:
             List({role: ... , content: ...}): the truncated conversation
         """
-        tokens = 0
-        for i in range(len(conversation) - 1, -1, -1):
-            tokens += self.count_tokens(conversation[i]["content"])
-            if tokens > token_limit:
-                print("reached token limit at index", i)
-                return conversation[i + 1 :]
+        conversation, tokens = tokenbudget.truncate_conversation(conversation, token_limit)
         pprint("total tokens in conversation (does not include system role):", tokens)
         return conversation
 
+    @traced("llm.simple_gpt")
     def simple_gpt(
         self,
         system_message,
@@ -393,24 +576,34 @@ class Tutor(ABC):
         """
         print("Model to try:\n")
         print(models_to_try)
-        for model_to_try in models_to_try:
-            try:
-                response = openai.ChatCompletion.create(
-                    model=model_to_try,
-                    messages=[
-                        {"role": "system", "content": system_message},
-                        {"role": "user", "content": user_message},
-                    ],
-                    temperature=temperature,
-                    frequency_penalty=0.0,
-                    presence_penalty=0.0,
-                    # stream=True,
-                )
-                return response.choices[0].message.content
-            except Exception as e:
-                print(red(model_to_try), "FAILED!")
-                if model_to_try == models_to_try[-1]:
-                    raise (e)
+        # the models are tried in order (and hedged) by the client
+        return llm.complete(
+            [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": user_message},
+            ],
+            models=models_to_try,
+            temperature=temperature,
+            frequency_penalty=0.0,
+            presence_penalty=0.0,
+        )
+
+    def simple_gemini(self, parts, temperature=None):
+        """Gemini's response to a prompt made of several parts
+
+        Args:
+            parts (list[str])
+
+        Returns:
+            string : the response of the model
+        """
+        return llm.complete(
+            [{"role": "system", "content": parts[0]}]
+            + [{"role": "user", "content": part} for part in parts[1:]],
+            models=[GEMINI_DEFAULT_MODEL],
+            temperature=temperature,
+            parts=parts,
+        )
 
     def conversation_gpt(self, system_message, conversation):
         """Getting model's response for a conversation with multiple messages
@@ -422,15 +615,13 @@ class Tutor(ABC):
         Returns:
             string : the first choice of response of the model
         """
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo-16k",
-            messages=[{"role": "system", "content": system_message}] + conversation,
+        return llm.complete(
+            [{"role": "system", "content": system_message}] + conversation,
+            models=["gpt-3.5-turbo-16k"],
             temperature=1,
             frequency_penalty=0.0,
             presence_penalty=0.0,
-            stream=True,
         )
-        return response.choices[0].message.content
 
     def stream_response_generator(
         self,
@@ -448,17 +639,34 @@ class Tutor(ABC):
 
         def generate():
             # This function generates responses to the questions in real-time and yields the response
-            # along with the time taken to generate it.
-            chunks = ""
+            # along with the time taken to generate it, coalescing the deltas into fewer frames.
             start_time = time.time()
-            resp = self.ask_question(conversation, from_doc, selectedModel, pipeline=pipeline)
-            for chunk in resp:
-                chunk_content = ""
-                if "content" in chunk:
-                    chunk_content = chunk["content"]
-                chunks += chunk_content
-                chunk_time = time.time() - start_time
-                # print(f"data: {json.dumps({'time': chunk_time, 'message': chunk})}\n\n")
-                yield f"data: {json.dumps({'time': chunk_time, 'message': chunk})}\n\n"
+            resp = self.cached_ask_question(
+                conversation, from_doc, selectedModel, pipeline=pipeline
+            )
+            yield from sse_encoder.encode(resp, start_time)
+
+        return generate
+
+    def astream_response_generator(
+        self,
+        conversation,
+        from_doc: list[str] | None,
+        selectedModel="gpt-3.5-turbo-16k",
+        pipeline="openai",
+    ):
+        """Async version of `stream_response_generator`, for the ASGI entry point (`asgi.py`).
+
+        Returns:
+            async generator function yielding the same SSE frames
+        """
+
+        async def generate():
+            start_time = time.time()
+            resp = self.acached_ask_question(
+                conversation, from_doc, selectedModel, pipeline=pipeline
+            )
+            async for frame in sse_encoder.aencode(resp, start_time):
+                yield frame
 
         return generate
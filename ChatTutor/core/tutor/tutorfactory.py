@@ -1,5 +1,8 @@
+import os
 from abc import ABC, ABCMeta, abstractmethod
+from collections import OrderedDict
 from enum import Enum
+from threading import Lock
 from core.tutor.variants.focusedcoursetutor import FocusedCourseTutor
 from core.tutor.variants.restrictedcoursetutor import RestrictedCourseTutor
 from core.tutor.tutor import Tutor
@@ -64,10 +67,40 @@ class TutorTypes:
 
 
 class TutorFactory:
-    """Generates tutors based on type, and collections"""
+    """Generates tutors based on type, and collections
+
+    Built tutors are kept and handed out again for the same (type, collections,
+    description): they hold configuration and shared clients only, every piece of
+    request state (the conversation, the section, the pipeline) is passed to
+    `ask_question`, so one instance serves concurrent requests. Callers must not
+    modify the tutors they get.
+
+    Attributes
+    ----------
+    max_tutors : int
+        number of built tutors kept (least recently used dropped first)
+    """
 
-    def __init__(self, embedding_db):
+    def __init__(self, embedding_db, max_tutors=int(os.getenv("TUTOR_CACHE_SIZE", 256))):
         self.db = embedding_db
+        self.max_tutors = max_tutors
+        self.tutors = OrderedDict()
+        self._lock = Lock()
+
+    def cached(self, key, build):
+        """Tutor built for `key`, building it with `build()` the first time"""
+        with self._lock:
+            tutor = self.tutors.get(key)
+            if tutor is not None:
+                self.tutors.move_to_end(key)
+                return tutor
+        tutor = build()
+        with self._lock:
+            tutor = self.tutors.setdefault(key, tutor)
+            self.tutors.move_to_end(key)
+            while len(self.tutors) > self.max_tutors:
+                self.tutors.popitem(last=False)
+        return tutor
 
     def build_course_tutor(
         self, tutor_subtype: CourseTutorType, focus_multiplier: None | int = None
@@ -101,6 +134,14 @@ class TutorFactory:
 
     def build_empty(
         self, tutor_subtype: CourseTutorType | NSFTutorType, focus_multiplier=1.5
+    ) -> Tutor:
+        return self.cached(
+            (tutor_subtype, None, None, focus_multiplier),
+            lambda: self.new_empty(tutor_subtype, focus_multiplier),
+        )
+
+    def new_empty(
+        self, tutor_subtype: CourseTutorType | NSFTutorType, focus_multiplier=1.5
     ) -> Tutor:
         chattutor: Tutor = None
         if isinstance(tutor_subtype, CourseTutorType):
@@ -116,7 +157,7 @@ class TutorFactory:
         multiple: None | bool,
         tutor_subtype: CourseTutorType | NSFTutorType,
     ) -> Tutor:
-        chattutor: Tutor = self.build_empty(tutor_subtype=tutor_subtype)
+        chattutor: Tutor = self.new_empty(tutor_subtype=tutor_subtype)
 
         if multiple == None or multiple == False:
             name = collection_desc if collection_desc else ""
@@ -138,6 +179,13 @@ class TutorFactory:
         collection_names,
         collection_desc: None | str = None,
     ) -> Tutor:
-        if isinstance(collection_names, (list, tuple)):
-            return self.build_(collection_names, collection_desc, True, tutor_subtype)
-        return self.build_(collection_names, collection_desc, False, tutor_subtype)
+        multiple = isinstance(collection_names, (list, tuple))
+        key = (
+            tutor_subtype,
+            tuple(collection_names) if multiple else collection_names,
+            collection_desc,
+            multiple,
+        )
+        return self.cached(
+            key, lambda: self.build_(collection_names, collection_desc, multiple, tutor_subtype)
+        )
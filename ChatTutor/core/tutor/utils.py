@@ -1,5 +1,11 @@
-import tiktoken
+import heapq
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 from copy import deepcopy
+from core.tokenbudget import count_tokens, truncate_tokens
+from core.tracing import in_context, span
 
 
 def yield_docs_and_first_sentence_if_tutor_id_not_apologizing(first_sentence: str, valid_docs=list):
@@ -24,17 +30,7 @@ def yield_docs(valid_docs=list):
 
 
 def truncate_to_x_number_of_tokens(string, num_of_tokens=None):
-    if num_of_tokens == None or num_of_tokens == 0:
-        return string
-    cut_string = ""
-    string = string.split(" ")
-    current_num_of_tokens = 0
-    while current_num_of_tokens < num_of_tokens:
-        if not string:
-            break
-        current_num_of_tokens = get_number_of_tokens(cut_string)
-        cut_string += " " + string.pop(0)
-    return cut_string
+    return truncate_tokens(string, num_of_tokens)
 
 
 def remove_score_and_doc_from_valid_docs(valid_docs):
@@ -51,7 +47,7 @@ def remove_score_and_doc_from_valid_docs(valid_docs):
 
 
 def get_number_of_tokens(string):
-    return len(tiktoken.get_encoding("cl100k_base").encode(str(string)))
+    return count_tokens(string)
 
 
 def is_tutor_apologizing_or_thanking(sentence: str):
@@ -77,3 +73,118 @@ def is_tutor_apologizing_or_thanking(sentence: str):
             return True
 
     return False
+
+
+# bounded pool shared by all requests for retrieval fan-out (one task per collection)
+retrieval_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RETRIEVAL_POOL_SIZE", 8)), thread_name_prefix="retrieval"
+)
+
+
+def traced_task(task, name, **attributes):
+    """`task` run in a span, under the span that submitted it"""
+
+    def run():
+        with span(name, **attributes):
+            return task()
+
+    return in_context(run)
+
+
+def fan_out(tasks, timeout=None, executor=retrieval_pool):
+    """Runs tasks concurrently and yields their results as they complete
+
+    Tasks that fail, or that are not done before the deadline, are logged and skipped,
+    so one slow collection cannot hold the whole request.
+
+    Args:
+        tasks (list[tuple[str, Callable]]): (name, callable without arguments) pairs
+        timeout (float, optional): deadline in seconds for all the tasks. Defaults to None.
+        executor (Executor, optional): Defaults to retrieval_pool.
+
+    Yields:
+        the result of each task that completed in time, in completion order
+    """
+    futures = {
+        executor.submit(traced_task(task, "fan_out.task", task=name)): name for name, task in tasks
+    }
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"fan_out: task {futures[future]} failed: {e}")
+    except TimeoutError:
+        for future, name in futures.items():
+            if not future.done():
+                future.cancel()
+                print(f"fan_out: task {name} missed the {timeout}s deadline")
+
+
+# separate pool for the LLM calls made before answering, so they never wait on retrieval
+llm_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_POOL_SIZE", 16)), thread_name_prefix="llm"
+)
+
+
+def run_concurrently(tasks, executor=llm_pool):
+    """Runs independent calls concurrently and waits for all of them
+
+    Each call has its own timeout (counted from when the calls are started) and a
+    default that is used instead of its result if it fails or times out, so the
+    total wait is the slowest call, capped by the largest timeout.
+
+    Args:
+        tasks (dict[str, tuple[Callable, float, Any]]): name -> (callable without
+        arguments, timeout in seconds or None, default)
+        executor (Executor, optional): Defaults to llm_pool.
+
+    Returns:
+        dict[str, Any]: name -> result (or default)
+    """
+    start = time.time()
+    futures = {
+        name: executor.submit(traced_task(task, f"concurrent.{name}"))
+        for name, (task, _, _) in tasks.items()
+    }
+    results = {}
+    for name, (_, timeout, default) in tasks.items():
+        remaining = None if timeout is None else max(0, start + timeout - time.time())
+        try:
+            results[name] = futures[name].result(timeout=remaining)
+        except TimeoutError:
+            futures[name].cancel()
+            print(f"run_concurrently: {name} missed the {timeout}s timeout, using {default!r}")
+            results[name] = default
+        except Exception as e:
+            print(f"run_concurrently: {name} failed ({e}), using {default!r}")
+            results[name] = default
+    return results
+
+
+class TopK:
+    """Keeps the k items with the smallest key, in a bounded heap
+
+    Items can be pushed as they arrive, without concatenating and sorting everything.
+    """
+
+    def __init__(self, k, key):
+        self.k = k
+        self.key = key
+        self._heap = []  # max-heap on key, through negation
+        self._counter = itertools.count()  # ties keep the earliest item, like a stable sort
+
+    def push(self, item):
+        entry = (-self.key(item), -next(self._counter), item)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def extend(self, items):
+        for item in items:
+            self.push(item)
+
+    def sorted(self):
+        """The kept items, by increasing key"""
+        return [item for _, _, item in sorted(self._heap, key=lambda e: (-e[0], -e[1]))]
@@ -19,25 +19,34 @@ class FocusedCourseTutor(CourseTutor):
         self.focus_multiplier = focus_multiplier
 
     def get_collection_valid_docs(
-        self, prompt, coll_name, coll_desc, from_doc=None, threshold=0.5, query_limit=3
+        self,
+        prompt,
+        coll_name,
+        coll_desc,
+        from_doc=None,
+        threshold=0.5,
+        query_limit=3,
+        query_embedding=None,
     ):
         arr = []
         pprint("\nQuerying embedding_db with prompt:", blue(prompt))
+        # general and restricted queries share the same prompt embedding
         (
-            documents,
-            metadatas,
-            distances,
-            documents_plain,
-        ) = time_it(
-            self.embedding_db.query
-        )(prompt, query_limit, from_doc=None, metadatas=True)
-
-        (
-            restricted_documents,
-            restricted_metadatas,
-            restricted_distances,
-            restricted_documents_plain,
-        ) = time_it(self.embedding_db.query)(prompt, query_limit, from_doc, metadatas=True)
+            (documents, metadatas, distances, documents_plain),
+            (
+                restricted_documents,
+                restricted_metadatas,
+                restricted_distances,
+                restricted_documents_plain,
+            ),
+        ) = time_it(self.embedding_db.query_many)(
+            prompt,
+            [
+                {"collection_name": coll_name, "n_results": query_limit, "from_doc": None},
+                {"collection_name": coll_name, "n_results": query_limit, "from_doc": from_doc},
+            ],
+            query_embedding=query_embedding,
+        )
 
         pprint(green(rf"got {len(documents)} general documents"))
 
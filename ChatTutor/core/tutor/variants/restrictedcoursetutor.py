@@ -8,7 +8,14 @@ from nice_functions import pprint, bold, green, blue, red, time_it
 
 class RestrictedCourseTutor(CourseTutor):
     def get_collection_valid_docs(
-        self, prompt, coll_name, coll_desc, from_doc=None, threshold=0.5, query_limit=3
+        self,
+        prompt,
+        coll_name,
+        coll_desc,
+        from_doc=None,
+        threshold=0.5,
+        query_limit=3,
+        query_embedding=None,
     ):
         arr = []
         pprint("\nQuerying embedding_db with prompt:", blue(prompt))
@@ -18,9 +25,14 @@ class RestrictedCourseTutor(CourseTutor):
             metadatas,
             distances,
             documents_plain,
-        ) = time_it(
-            self.embedding_db.query
-        )(prompt, query_limit, from_doc, metadatas=True)
+        ) = time_it(self.embedding_db.query)(
+            prompt,
+            query_limit,
+            from_doc,
+            metadatas=True,
+            collection_name=coll_name,
+            query_embedding=query_embedding,
+        )
         pprint(rf"got {len(documents)} documents")
         for doc, meta, dist in zip(documents, metadatas, distances):
             # if no fromdoc specified, and distance is lowe thhan thersh, add to array of possible related documents
@@ -296,8 +296,8 @@ class URLSpider:
         section at a time
         :type lock: Lock
         :param chroma_db: The parameter `chroma_db` is a database object that is used to interact with a
-        database for storing and retrieving text data. It is used in the `add_texts_chroma_lock` method
-        to add the parsed texts to the database
+        database for storing and retrieving text data. It is used in the `add_texts_chroma` method
+        to add the parsed texts to the database (ids are content based, so no lock is needed)
         :param collection_name: The `collection_name` parameter is a string that represents the name of
         the collection in the `chroma_db` where the texts will be added
         :param course_id: The `course_id` parameter is used to identify the course to which the parsed
@@ -328,7 +328,7 @@ class URLSpider:
         section_id = navn
         print("finish ..")
         print("@chroma: adding texts... ", len(texts), strv)
-        chroma_db.add_texts_chroma_lock(texts, lock=lock)
+        chroma_db.add_texts_chroma(texts, collection_name=collection_name)
         print("@chroma: added texts! ", strv)
         print("@database: adding to db... ", strv)
 
@@ -401,8 +401,8 @@ class URLSpider:
         :param urltoapp: The `urltoapp` parameter is the URL of the application or website that you want
         to crawl with the spider
         :param save_to_database: The `save_to_database` parameter is an object that is responsible for
-        saving data to a database. It has a method called `load_datasource` which is used to load data
-        from a specific collection in the database
+        saving data to a database. It has a method called `get_collection` which is used to open
+        (or create) a specific collection in the database
         :param collection_name: The `collection_name` parameter is a string that represents the name of
         the collection in the database where the spider data will be saved
         :param course_name: The name of the course
@@ -431,7 +431,7 @@ class URLSpider:
         )
 
         DataBase().insert_user_to_course(user_id=current_user.user_id, course_id=course_id)
-        save_to_database.load_datasource(collection_name)
+        save_to_database.get_collection(collection_name)
         print("inserted date")
 
         lock = Lock()
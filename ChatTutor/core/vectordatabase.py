@@ -1,16 +1,51 @@
+import copy
+import hashlib
+import logging
 import os
+import random
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
 from typing import List
 
 import chromadb
 import openai
 import google.generativeai as genai
-from chromadb.utils import embedding_functions
+import numpy as np
 from core.definitions import Text
+from core.docpartitions import DocPartitions
+from core.tokenbudget import count_tokens
+from core.lexicalindex import BM25Index, reciprocal_rank_fusion
+from core.localvectorindex import open_local_index
+from core.tracing import span
 
 # Setting up user
 username = "mit.quantum.ai"
 
+logger = logging.getLogger(__name__)
+
+# directory of the app (ChatTutor/), so the default paths do not depend on where it is started
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", os.path.join(APP_DIR, ".embedding_cache.sqlite3")
+)
+# folder of the saved BM25 indexes (those of local collections go to its "local"
+# subfolder, never next to the collection files)
+LEXICAL_INDEX_DIR = os.getenv("LEXICAL_INDEX_DIR", os.path.join(APP_DIR, ".lexical_index"))
+# look for chunks stored under the old sequential ids ("0", "1", ...) when a doc is
+# first written by this process; set to 0 once every collection was re-ingested
+LEGACY_ID_CLEANUP = os.getenv("LEGACY_ID_CLEANUP", "1") == "1"
+# collections whose BM25 index is loaded or built when the app starts
+LEXICAL_INDEX_COLLECTIONS = [
+    name
+    for name in os.getenv(
+        "LEXICAL_INDEX_COLLECTIONS", "cqn_openaicol_ttv,cqn_openaicol_ttv_titles"
+    ).split(",")
+    if name
+]
+
 
 def embedding_function(texts, model="text-embedding-ada-002"):
     """
@@ -70,17 +105,454 @@ else:
     os.environ["OPENAI_API_KEY"] = keys["OPENAI_API_KEY"]
 
 
+class EmbeddingCache:
+    """
+    Content-addressed on-disk store of embeddings.
+
+    Every chunk is normalized (whitespace collapsed) and hashed together with the
+    embedding model name. Vectors are stored as packed float32 blobs in a SQLite
+    file, and the least recently used rows are evicted once the store grows over
+    `max_entries`.
+
+    Attributes
+    ----------
+    path : str
+        path of the SQLite file holding the vectors
+    max_entries : int
+        maximum number of vectors kept on disk
+    """
+
+    def __init__(self, path, max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, model TEXT, vector BLOB, last_used REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def normalize(text):
+        """Collapse all whitespace (including newlines) to single spaces"""
+        return " ".join(str(text).split())
+
+    @staticmethod
+    def key(normalized_text, model):
+        """Content hash of an already normalized text for the given model"""
+        return hashlib.sha256(f"{model}\0{normalized_text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Args:
+            keys (Iterable[str]): content hashes to look up
+
+        Returns:
+            dict[str, list[float]]: the vectors that were found, by key
+        """
+        keys = list(set(keys))
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if rows:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})",
+                        [now] + chunk,
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items, model):
+        """
+        Store vectors and evict the least recently used ones above `max_entries`
+
+        Args:
+            items (list[tuple[str, list[float]]]): (key, vector) pairs
+            model (str): embedding model that produced the vectors
+        """
+        now = time.time()
+        rows = [
+            (key, model, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+
+class CachedEmbeddingFunction:
+    """
+    Chroma compatible embedding function that only sends cache misses to the
+    provider. Can be passed as `embedding_function` to a collection, or called
+    directly to get precomputed vectors for `add`/`upsert`.
+    """
+
+    def __init__(self, cache: EmbeddingCache, model="text-embedding-ada-002"):
+        self.cache = cache
+        self.model = model
+
+    def __call__(self, input):
+        texts = [input] if isinstance(input, str) else list(input)
+        normalized = [EmbeddingCache.normalize(text) for text in texts]
+        keys = [EmbeddingCache.key(text, self.model) for text in normalized]
+        found = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, normalized):
+            if key not in found:
+                missing[key] = text
+        if missing:
+            with span("embed", texts=len(missing), model=self.model):
+                vectors = embedding_function(list(missing.values()), model=self.model)
+            computed = list(zip(missing.keys(), vectors))
+            self.cache.put_many(computed, self.model)
+            found.update(computed)
+        logger.debug(
+            "embeddings: %d cached, %d computed", len(set(keys)) - len(missing), len(missing)
+        )
+        return [found[key] for key in keys]
+
+
+_embedding_cache = None
+_embedding_cache_lock = Lock()
+
+
+def get_embedding_cache():
+    """Process wide `EmbeddingCache`, opened on first use
+
+    The location and size can be set with the `EMBEDDING_CACHE_PATH` (by default
+    next to the app, not the working directory) and `EMBEDDING_CACHE_MAX_ENTRIES`
+    environment variables.
+    """
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(
+                EMBEDDING_CACHE_PATH,
+                max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 200000)),
+            )
+        return _embedding_cache
+
+
+class CollectionRegistry:
+    """
+    Thread-safe LRU of opened collection handles.
+
+    `VectorDatabase` is shared by every request thread, so instead of keeping a
+    "current" collection around, each call resolves the collection it needs by
+    name. Hot collections are opened once per process and then served from memory.
+
+    Attributes
+    ----------
+    open_collection : Callable[[str], Collection]
+        opens (or creates) a collection by name
+    max_size : int
+        maximum number of handles kept open
+    """
+
+    def __init__(self, open_collection, max_size=64):
+        self.open_collection = open_collection
+        self.max_size = max_size
+        self._handles = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, name):
+        """
+        Args:
+            name (str): name of the collection
+
+        Returns:
+            the collection handle, opened if it was not cached
+        """
+        with self._lock:
+            handle = self._handles.get(name)
+            if handle is not None:
+                self._handles.move_to_end(name)
+                return handle
+
+        # opening the collection is a round-trip, so it happens outside the lock
+        handle = self.open_collection(name)
+        with self._lock:
+            handle = self._handles.setdefault(name, handle)
+            self._handles.move_to_end(name)
+            while len(self._handles) > self.max_size:
+                self._handles.popitem(last=False)
+        return handle
+
+    def discard(self, name):
+        """Forget the handle of a collection (e.g. after it was deleted)"""
+        with self._lock:
+            self._handles.pop(name, None)
+
+
+class RetrievalCache:
+    """
+    TTL + LRU cache of query results, shared by every request thread.
+
+    Entries are keyed by (collection, mode, normalized prompt or embedding hash,
+    from_doc set, n_results, include). Writing to or deleting from a collection
+    drops its entries; a per-collection generation makes sure a query that was
+    running during the write does not store its (stale) result afterwards.
+
+    Attributes
+    ----------
+    ttl : float
+        seconds an entry stays valid
+    max_entries : int
+        maximum number of results kept
+    """
+
+    def __init__(
+        self,
+        ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", 600)),
+        max_entries=int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", 1024)),
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires at, result)
+        self._generations = {}  # collection -> number of invalidations
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(collection_name, mode, prompt, query_embedding, from_doc, n_results, include):
+        if prompt is not None:
+            query_key = EmbeddingCache.normalize(prompt)
+        else:
+            vector = np.asarray(query_embedding, dtype=np.float32).tobytes()
+            query_key = hashlib.sha256(vector).hexdigest()
+        if from_doc:
+            from_doc = frozenset([from_doc] if isinstance(from_doc, str) else from_doc)
+        else:
+            from_doc = None
+        return (collection_name, mode, query_key, from_doc, n_results, tuple(include))
+
+    def get_or_compute(self, key, compute):
+        """
+        Cached result for `key`, or the result of `compute()` (which is then cached)
+
+        Results are copied on the way in and out, callers can modify them freely.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            self.misses += 1
+            generation = self._generations.get(key[0], 0)
+
+        result = compute()
+        with self._lock:
+            if self._generations.get(key[0], 0) == generation:
+                self._entries[key] = (now + self.ttl, copy.deepcopy(result))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        # compute() may hand out objects it keeps (e.g. loaded metadata)
+        return copy.deepcopy(result)
+
+    def invalidate(self, collection_name):
+        """Drops the results of a collection (after it was written to or deleted from)"""
+        with self._lock:
+            self._generations[collection_name] = self._generations.get(collection_name, 0) + 1
+            for key in [key for key in self._entries if key[0] == collection_name]:
+                del self._entries[key]
+
+
+# errors worth retrying a batch on: rate limits and transient provider/server failures
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class IngestionPipeline:
+    """
+    Writes large lists of chunks to a collection in token-budgeted batches.
+
+    Chunks are grouped so that no batch exceeds `max_batch_tokens` (or
+    `max_batch_size` inputs), batches are embedded and written concurrently by at
+    most `max_workers` threads, and a batch that hits a rate limit is retried with
+    exponential backoff and jitter. Because chunk ids are content based, a batch
+    that still fails can simply be re-sent by running the ingest again.
+
+    Attributes
+    ----------
+    vector_db : VectorDatabase
+        database whose embedding function is used for the batches
+    max_batch_tokens : int
+        token budget of one embedding request
+    max_workers : int
+        number of batches in flight at once
+    on_progress : Callable[[int, int], None], optional
+        called with (chunks written, total chunks) after every batch
+    """
+
+    def __init__(
+        self,
+        vector_db,
+        max_batch_tokens=int(os.getenv("INGEST_BATCH_TOKENS", 20000)),
+        max_batch_size=2048,
+        max_workers=int(os.getenv("INGEST_WORKERS", 4)),
+        max_retries=6,
+        base_delay=1.0,
+        max_delay=60.0,
+        on_progress=None,
+    ):
+        self.vector_db = vector_db
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.on_progress = on_progress
+
+    def batches(self, items):
+        """
+        Splits (id, Text) pairs into consecutive batches within the token budget.
+        A chunk larger than the budget gets a batch of its own.
+        """
+        batch = []
+        batch_tokens = 0
+        for item in items:
+            # cl100k_base, the encoding of text-embedding-ada-002
+            tokens = count_tokens(item[1].text)
+            if batch and (
+                batch_tokens + tokens > self.max_batch_tokens or len(batch) >= self.max_batch_size
+            ):
+                yield batch, batch_tokens
+                batch = []
+                batch_tokens = 0
+            batch.append(item)
+            batch_tokens += tokens
+        if batch:
+            yield batch, batch_tokens
+
+    def write_batch(self, datasource, batch, metadatas=None):
+        """Embeds and upserts one batch, backing off and retrying on rate limits"""
+        ids = [id for id, _ in batch]
+        texts = [text for _, text in batch]
+        metadatas = metadatas or {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                datasource.upsert(
+                    ids=ids,
+                    embeddings=self.vector_db.embed_texts(texts),
+                    metadatas=[
+                        {**metadatas.get(id, {}), "doc": text.doc.docname} for id, text in batch
+                    ],
+                    documents=[text.text for text in texts],
+                )
+                self.vector_db.chunks_written(
+                    datasource.name,
+                    ids,
+                    [text.text for text in texts],
+                    [text.doc.docname for text in texts],
+                )
+                return len(batch)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2**attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                logger.warning(
+                    "%s: %s, retrying batch in %.1fs", datasource.name, type(e).__name__, delay
+                )
+                time.sleep(delay)
+
+    def run(self, datasource, items, metadatas=None):
+        """
+        Args:
+            datasource: collection to write to
+            items (list[tuple[str, Text]]): (id, text) pairs to upsert
+            metadatas (dict[str, dict], optional): metadata stored with some ids, besides "doc"
+        """
+        total = len(items)
+        if total == 0:
+            return
+        batches = list(self.batches(items))
+        tokens = sum(batch_tokens for _, batch_tokens in batches)
+        logger.info(
+            "%s: ingesting %d chunks, %d tokens, %d batches",
+            datasource.name,
+            total,
+            tokens,
+            len(batches),
+        )
+
+        start = time.time()
+        done = 0
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(self.write_batch, datasource, batch, metadatas)
+                for batch, _ in batches
+            ]
+            for future in as_completed(futures):
+                try:
+                    done += future.result()
+                except Exception as e:
+                    # keep the other batches going, what they wrote stays written
+                    logger.warning("%s: batch failed: %s", datasource.name, e)
+                    error = error or e
+                    continue
+                logger.info(
+                    "%s: %d/%d chunks in %.1fs", datasource.name, done, total, time.time() - start
+                )
+                if self.on_progress is not None:
+                    self.on_progress(done, total)
+        if error is not None:
+            raise error
+
+
+PROVIDERS = ("chroma", "local")
+
+
 class VectorDatabase:
     """
     Object that aids the loading, updating and adding of data to
-    a database using one of ~~two~~ providers: `chroma` ~~or `deeplake`~~.
+    a database using one of two providers: `chroma` or `local`
+    (the in-process index of `core.localvectorindex`).
+
+    All query and add methods take the name of the collection they work on
+    (`collection_name`). The `load_datasource*` methods and the `datasource`
+    attribute are only kept for single threaded scripts.
 
     Attributes
     ----------
     path : str
-        path of the folder containing the database
+        path of the folder containing the database (host:port for hosted chroma)
     db_provider : str
-        provider of the database: either \'chroma\' or ~~\'deeplake\'~~
+        provider of the database: either \'chroma\' or \'local\'
     """
 
     def __init__(self, path, db_provider, hosted=True, ef="openai"):  # TODO: ef = openai
@@ -88,19 +560,64 @@ class VectorDatabase:
         self.hosted = hosted
         self.db_provider = db_provider
         self.ef = "openai"
+        self.embedding_function = None
+        self.collections = None
+        self.lexical_indexes = {}
+        self.lexical_builds = {}  # collection -> Future of the BM25 index being built
+        self.lexical_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="lexical")
+        self.lexical_lock = Lock()
+        self.partitions = DocPartitions()
+        self.retrieval_cache = RetrievalCache()
+        self.write_listeners = []
+        self.legacy_checked = set()  # (collection, doc) already cleared of sequential ids
 
     def init_db(self):
         """
-        Initializing the database client if the provider is 'chroma'
+        Initializing the database client if the provider is 'chroma' or 'local'
         """
-        if self.db_provider != "chroma":
+        if self.db_provider not in PROVIDERS:
             return
-        if self.hosted:
+        if self.ef == "openai":
+            self.embedding_function = CachedEmbeddingFunction(get_embedding_cache())
+        if self.db_provider == "local":
+            self.client = open_local_index(self.path)
+        elif self.hosted:
             ip = self.path.split(":")[0]
             port = int(self.path.split(":")[1])
             self.client = chromadb.HttpClient(host=ip, port=port)
         else:
             self.client = chromadb.PersistentClient(path=self.path)
+        self.collections = CollectionRegistry(self.open_collection_chroma)
+
+    def open_collection_chroma(self, collection_name):
+        """Get or create a collection (one round-trip to the server for chroma)"""
+        return self.client.get_or_create_collection(
+            name=collection_name, embedding_function=self.embedding_function
+        )
+
+    def get_collection(self, collection_name, variant=None):
+        """
+        Handle of a collection, resolved once per process.
+
+        Args:
+            collection_name (str): name of the collection. If it does not exist
+                                   it will be created
+            variant (str, optional): papers variant ("titles", "authors", ...), which
+                                     lives in the `<collection_name>_<variant>` collection
+        """
+        if self.db_provider not in PROVIDERS:
+            raise Exception("db_provider must be one of 'chroma' or 'local'")
+        if variant is not None:
+            collection_name = f"{collection_name}_{variant}"
+        return self.collections.get(collection_name)
+
+    def resolve_collection(self, collection_name=None, variant=None):
+        """Collection to work on: the named one, or the legacy loaded `datasource`"""
+        if collection_name is not None:
+            return self.get_collection(collection_name, variant)
+        if variant is not None:
+            return self.extra_datasources[variant]
+        return self.datasource
 
     def load_datasource(self, name):
         """
@@ -110,45 +627,21 @@ class VectorDatabase:
             name (String) - name of the collection. If collection exists
                             it will be loaded, if not, it will be created
                             then loaded"""
-        if self.db_provider == "chroma":
+        if self.db_provider in PROVIDERS:
             self.load_datasource_chroma(name)
         else:
-            raise Exception("db_provider must be one of 'chroma' or 'deeplake'")
+            raise Exception("db_provider must be one of 'chroma' or 'local'")
 
     def load_datasource_papers(
         self, collection_name, extra=["titles", "summary", "authors", "citations"]
     ):
         """Load Chroma collection"""
-        openai_ef = None
-
-        if self.ef == "openai":
-            openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                model_name="text-embedding-ada-002"
-            )
-
-        self.datasource = self.client.get_or_create_collection(
-            name=collection_name, embedding_function=openai_ef
-        )
-
-        self.extra_datasources = {
-            x: self.client.get_or_create_collection(
-                name=collection_name + "_" + x, embedding_function=openai_ef
-            )
-            for x in extra
-        }
+        self.datasource = self.get_collection(collection_name)
+        self.extra_datasources = {x: self.get_collection(collection_name, x) for x in extra}
 
     def load_datasource_chroma(self, collection_name):
         """Load Chroma collection"""
-        openai_ef = None
-
-        if self.ef == "openai":
-            openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                model_name="text-embedding-ada-002"
-            )
-
-        self.datasource = self.client.get_or_create_collection(
-            name=collection_name, embedding_function=openai_ef
-        )
+        self.datasource = self.get_collection(collection_name)
 
     def delete_datasource_chroma(self, collection_name):
         """
@@ -161,247 +654,734 @@ class VectorDatabase:
         print(coll_names, collection_name)
         if collection_name in coll_names:
             self.client.delete_collection(name=collection_name)
+            self.collections.discard(collection_name)
+            with self.lexical_lock:
+                self.lexical_indexes.pop(collection_name, None)
+            if os.path.exists(self.lexical_index_path(collection_name)):
+                os.remove(self.lexical_index_path(collection_name))
+            self.partitions.drop_collection(collection_name)
+            self.collection_changed(collection_name)
             coll_names = [coll.name for coll in collections]
             print(coll_names, collection_name)
 
-    def add_texts(self, texts: List[Text]):
+    def delete_doc(self, collection_name, doc):
+        """
+        Deletes every chunk of a doc from a collection, and drops them from the
+        in-memory indexes and the caches.
+
+        Args:
+            collection_name (str): collection to delete from
+            doc (str): "doc" metadata of the chunks to delete
+        """
+        datasource = self.get_collection(collection_name)
+        ids = datasource.get(where={"doc": doc}, include=[])["ids"]
+        if ids:
+            datasource.delete(ids=ids)
+        with self.lexical_lock:
+            index = self.lexical_indexes.get(collection_name)
+        if index is not None:
+            index.remove(ids)
+        self.partitions.drop_doc(collection_name, doc)
+        self.collection_changed(collection_name)
+        if ids:
+            self.save_lexical_index(collection_name)
+        return ids
+
+    def embed_texts(self, texts: List[Text]):
+        """Embeds texts through the embedding cache, so only new chunks reach the provider
+
+        Args:
+            texts (List[Text]): Texts to embed
+
+        Returns:
+            list of embeddings, or None if chroma should embed the texts itself
+        """
+        if self.embedding_function is None:
+            return None
+        return self.embedding_function([text.text for text in texts])
+
+    def add_texts(self, texts: List[Text], collection_name=None, on_progress=None):
         """Equivalent to add_texts_chroma
 
         Args:
             texts (List[Text]) : Texts to add to database
+            collection_name (str) : collection to add the texts to
+            on_progress (Callable[[int, int], None], optional) : called with
+            (chunks written, total chunks) as the batches complete
         """
-        if self.db_provider == "chroma":
-            self.add_texts_chroma(texts)
+        if self.db_provider in PROVIDERS:
+            self.add_texts_chroma(texts, collection_name, on_progress)
         else:
-            raise Exception("db_provider must be one of 'chroma' or 'deeplake'")
+            raise Exception("db_provider must be one of 'chroma' or 'local'")
 
-    def add_texts_chroma(self, texts: List[Text]):
+    def add_texts_chroma(self, texts: List[Text], collection_name=None, on_progress=None):
         """
         Adding texts to Chroma data source with specified ids, metadatas, and documents
 
         Args:
             texts (List[Text]): Texts to add to database
+            collection_name (str): collection to add the texts to
+            on_progress (Callable[[int, int], None], optional): progress callback
         """
-        count = self.datasource.count()
-        ids = [str(i) for i in range(count, count + len(texts))]
-        self.datasource.add(
-            ids=ids,
-            metadatas=[{"doc": text.doc.docname} for text in texts],
-            documents=[text.text for text in texts],
-        )
+        datasource = self.resolve_collection(collection_name)
+        self.upsert_texts(datasource, texts, on_progress)
 
-    def add_texts_papers(self, texts: List[Text], variant=None):
+    def add_texts_papers(self, texts: List[Text], variant=None, collection_name=None):
         """
         Adding texts to Chroma data source with specified ids, metadatas, and documents
 
         Args:
             texts (List[Text]): Texts to add to database
+            variant (str, optional): papers variant ("titles", "authors", ...)
+            collection_name (str): main papers collection, e.g. "cqn_openaicol_ttv"
         """
-        count = self.datasource.count()
-        ids = [str(i) for i in range(count, count + len(texts))]
-        if variant == None:
-            self.datasource.add(
-                ids=ids,
-                metadatas=[{"doc": text.doc.docname} for text in texts],
-                documents=[text.text for text in texts],
-            )
-        else:
-            self.extra_datasources[variant].add(
-                ids=ids,
-                metadatas=[{"doc": text.doc.docname} for text in texts],
-                documents=[text.text for text in texts],
-            )
+        datasource = self.resolve_collection(collection_name, variant)
+        self.upsert_texts(datasource, texts)
 
-    def add_texts_chroma_lock(self, texts: List[Text], lock: Lock):
+    def add_texts_chroma_lock(self, texts: List[Text], lock: Lock = None, collection_name=None):
         """
         Adding texts to Chroma data source with specified ids, metadatas, and documents,
-        for parallel url spidering. This would lock the mutex lock first and then work like
-        add_texts_chroma before unlocking it.
+        for parallel url spidering. Ids are derived from the content and written with an
+        upsert, so workers don't need to coordinate; the lock is only kept for callers
+        that still pass one and is no longer taken.
         Args:
             texts (List[Text]): Texts to add to database
-            lock (Lock): the threading lock
-        """
-        lock.acquire()
-        count = self.datasource.count()
-        ids = [str(i) for i in range(count, count + len(texts))]
-        # print(ids, count)
-        self.datasource.add(
-            ids=ids,
-            metadatas=[{"doc": text.doc.docname} for text in texts],
-            documents=[text.text for text in texts],
+            lock (Lock, optional): unused
+            collection_name (str): collection to add the texts to
+        """
+        self.add_texts_chroma(texts, collection_name)
+
+    @staticmethod
+    def chunk_ids(collection_name, texts: List[Text]):
+        """
+        Deterministic ids for texts: sha256 of the collection, the document, the
+        position of the chunk inside its document (`Text.chunk`) and the chunk content.
+        Adding the same chunks again gives the same ids, however they are batched.
+
+        Texts without a position (e.g. the single text per paper of the papers
+        collections) are numbered by their occurrence of the same content in the doc,
+        so repeated chunks keep distinct ids.
+
+        Args:
+            collection_name (str): name of the collection the texts go to
+            texts (List[Text]): Texts to get ids for
+
+        Returns:
+            list of hex ids, in the order of `texts`
+        """
+        ids = []
+        occurrences = {}
+        for text in texts:
+            docname = text.doc.docname
+            content_hash = hashlib.sha256(text.text.encode("utf-8")).hexdigest()
+            if text.chunk is not None:
+                position = str(text.chunk)
+            else:
+                occurrence = occurrences.get((docname, content_hash), 0)
+                occurrences[(docname, content_hash)] = occurrence + 1
+                position = f"~{occurrence}"
+            key = f"{collection_name}\0{docname}\0{position}\0{content_hash}"
+            ids.append(hashlib.sha256(key.encode("utf-8")).hexdigest())
+        return ids
+
+    def delete_legacy_chunks(self, datasource, docs):
+        """
+        Deletes the chunks of these docs still stored under the sequential ids
+        ("0", "1", ...) given before the ids were content based, so re-ingesting a doc
+        replaces them instead of storing every chunk twice.
+
+        Each doc is only looked up the first time this process writes it, and not at
+        all when LEGACY_ID_CLEANUP is off.
+
+        Args:
+            datasource: collection handle
+            docs (Iterable[str]): "doc" metadata of the chunks
+
+        Returns:
+            the deleted ids
+        """
+        if not LEGACY_ID_CLEANUP:
+            return []
+        with self.lexical_lock:
+            docs = sorted(
+                doc for doc in set(docs) if (datasource.name, doc) not in self.legacy_checked
+            )
+        if not docs:
+            return []
+        where = {"doc": docs[0]} if len(docs) == 1 else {"doc": {"$in": docs}}
+        ids = [id for id in datasource.get(where=where, include=[])["ids"] if id.isdigit()]
+        if ids:
+            datasource.delete(ids=ids)
+        with self.lexical_lock:
+            self.legacy_checked.update((datasource.name, doc) for doc in docs)
+        if not ids:
+            return []
+        with self.lexical_lock:
+            index = self.lexical_indexes.get(datasource.name)
+        if index is not None:
+            index.remove(ids)
+        for doc in docs:
+            self.partitions.drop_doc(datasource.name, doc)
+        self.collection_changed(datasource.name)
+        logger.info("%s: deleted %d chunks stored under sequential ids", datasource.name, len(ids))
+        return ids
+
+    def upsert_texts(self, datasource, texts: List[Text], on_progress=None, metadatas=None):
+        """
+        Idempotently writes texts to a collection. Chunks whose id is already stored
+        are skipped (nothing is embedded for them), the others are upserted so
+        concurrent writers of the same chunk don't fail. Large lists are written
+        in batches by an `IngestionPipeline`. Chunks of the same docs stored under
+        sequential ids are deleted first.
+
+        Args:
+            datasource: Chroma collection to write to
+            texts (List[Text]): Texts to add to database
+            on_progress (Callable[[int, int], None], optional): progress callback,
+            see `IngestionPipeline`
+            metadatas (list[dict], optional): metadata stored with each text, besides
+            its "doc"
+        """
+        ids = self.chunk_ids(datasource.name, texts)
+        # one entry per id, chroma rejects batches with repeated ids
+        by_id = dict(zip(ids, texts))
+        if metadatas is not None:
+            metadatas = dict(zip(ids, metadatas))
+        if len(by_id) == 0:
+            return
+        deleted = self.delete_legacy_chunks(datasource, [text.doc.docname for text in texts])
+        existing = set(datasource.get(ids=list(by_id.keys()), include=[])["ids"])
+        new = {id: text for id, text in by_id.items() if id not in existing}
+        logger.info(
+            "%s: %d chunks already stored, %d new", datasource.name, len(existing), len(new)
         )
-        lock.release()
+        if len(new) > 0:
+            IngestionPipeline(self, on_progress=on_progress).run(
+                datasource, list(new.items()), metadatas
+            )
+        if deleted or new:
+            self.save_lexical_index(datasource.name)
+
+    def embed_query(self, prompt):
+        """Embeds a query text once, so it can be reused for several queries
 
-    def query(self, prompt, n_results, from_doc, metadatas=False, distances=False):
+        Args:
+            prompt (str): the query text
+
+        Returns:
+            the embedding of the prompt, or None if chroma should embed the query itself
+        """
+        if self.embedding_function is None:
+            return None
+        return self.embedding_function([prompt])[0]
+
+    def embed_queries(self, prompts):
+        """Embeds several query texts with a single provider call
+
+        Args:
+            prompts (list[str]): the query texts
+
+        Returns:
+            list of embeddings, or a list of None if chroma should embed the queries itself
+        """
+        if self.embedding_function is None:
+            return [None for _ in prompts]
+        return self.embedding_function(list(prompts))
+
+    def lexical_index_path(self, collection_name):
+        """File the BM25 index of a collection is saved to"""
+        folder = (
+            os.path.join(LEXICAL_INDEX_DIR, "local")
+            if self.db_provider == "local"
+            else LEXICAL_INDEX_DIR
+        )
+        return os.path.join(folder, f"{collection_name}.bm25.json")
+
+    def lexical_index(self, datasource, wait=True):
+        """
+        BM25 index of a collection, kept up to date by the writes of this process.
+
+        The index saved with the collection is used when it still holds as many chunks
+        as the collection, otherwise the index is built from the stored chunks (a scan
+        of the whole collection) and saved, in the background. `warm_lexical_indexes`
+        starts this when the app starts, so requests find the index ready.
+
+        Args:
+            datasource: collection handle
+            wait (bool): wait for the index if it is not ready, instead of returning None
+
+        Returns:
+            BM25Index | None
+        """
+        name = datasource.name
+        with self.lexical_lock:
+            index = self.lexical_indexes.get(name)
+            if index is not None:
+                return index
+            future = self.lexical_builds.get(name)
+            if future is None:
+                future = self.lexical_executor.submit(self.build_lexical_index, datasource)
+                self.lexical_builds[name] = future
+        if not wait:
+            return None
+        return future.result()
+
+    def build_lexical_index(self, datasource):
+        """Loads the saved BM25 index of a collection, or builds and saves it"""
+        name = datasource.name
+        try:
+            start = time.time()
+            path = self.lexical_index_path(name)
+            index = BM25Index.load(path)
+            if index is not None and len(index) == datasource.count():
+                logger.info("%s: lexical index of %d chunks loaded", name, len(index))
+            else:
+                index = BM25Index()
+                page_size = 5000
+                offset = 0
+                while True:
+                    page = datasource.get(
+                        include=["documents", "metadatas"], limit=page_size, offset=offset
+                    )
+                    metadatas = page["metadatas"] or [None] * len(page["ids"])
+                    index.add(
+                        page["ids"],
+                        page["documents"],
+                        [(metadata or {}).get("doc") for metadata in metadatas],
+                    )
+                    if len(page["ids"]) < page_size:
+                        break
+                    offset += page_size
+                index.save(path)
+                logger.info(
+                    "%s: lexical index of %d chunks built in %.2fs",
+                    name,
+                    len(index),
+                    time.time() - start,
+                )
+            with self.lexical_lock:
+                index = self.lexical_indexes.setdefault(name, index)
+            # hybrid results computed without the index
+            self.retrieval_cache.invalidate(name)
+            return index
+        except Exception as e:
+            logger.warning("%s: lexical index failed: %s", name, e)
+            raise
+        finally:
+            with self.lexical_lock:
+                self.lexical_builds.pop(name, None)
+
+    def warm_lexical_indexes(self, collection_names=LEXICAL_INDEX_COLLECTIONS):
+        """Loads or builds the BM25 indexes of these collections in the background"""
+        for collection_name in collection_names:
+            self.lexical_index(self.get_collection(collection_name), wait=False)
+
+    def save_lexical_index(self, collection_name):
+        """Saves the BM25 index of a collection after it was written to, if it is loaded"""
+        with self.lexical_lock:
+            index = self.lexical_indexes.get(collection_name)
+        if index is not None:
+            index.save(self.lexical_index_path(collection_name))
+
+    def on_write(self, listener):
+        """
+        Registers `listener(collection_name)`, called after chunks of a collection were
+        written or deleted (e.g. to drop caches built from that collection)
+        """
+        if listener not in self.write_listeners:
+            self.write_listeners.append(listener)
+
+    def collection_changed(self, collection_name):
+        self.retrieval_cache.invalidate(collection_name)
+        for listener in self.write_listeners:
+            listener(collection_name)
+
+    def chunks_written(self, collection_name, ids, documents, docs):
+        """
+        Keeps the in-memory indexes of a collection current after chunks were written:
+        the BM25 index (if it was built), the doc partitions, the retrieval cache and
+        the write listeners.
+        """
+        with self.lexical_lock:
+            index = self.lexical_indexes.get(collection_name)
+        if index is not None:
+            index.add(ids, documents, docs)
+        self.partitions.written(collection_name, ids, docs)
+        self.collection_changed(collection_name)
+
+    def query_hybrid(
+        self, prompt, n_results, from_doc, collection_name=None, query_embedding=None, rrf_k=60
+    ):
+        """
+        Vector and BM25 retrieval merged by reciprocal rank fusion.
+
+        The results are ordered by fused rank, and the result has two more lists:
+        "scores", the fused scores, and "lexical", whether BM25 found the chunk. The
+        distances reported are still the embedding distances (chunks only found
+        lexically get theirs computed from their stored embedding), so callers
+        ranking results from several queries should sort by score, and keep
+        distance thresholds to the chunks not found lexically.
+
+        Args:
+            prompt (str): the query text
+            n_results (int): number of results
+            from_doc (string | list[string]): only return chunks of these docs
+            collection_name (string): collection to query
+            query_embedding (list[float], optional): embedding of the prompt, if already known
+            rrf_k (int): reciprocal rank fusion constant
+
+        Returns:
+            query result in the chroma format (lists of lists, one per query)
+        """
+        datasource = self.resolve_collection(collection_name)
+        key = RetrievalCache.key(
+            datasource.name, "hybrid", prompt, query_embedding, from_doc, n_results, ()
+        )
+        with span("retrieval.hybrid", collection=datasource.name):
+            return self.retrieval_cache.get_or_compute(
+                key,
+                lambda: self.compute_hybrid(
+                    datasource, prompt, n_results, from_doc, query_embedding, rrf_k
+                ),
+            )
+
+    def compute_hybrid(self, datasource, prompt, n_results, from_doc, query_embedding, rrf_k):
+        """Uncached `query_hybrid`"""
+        if query_embedding is None:
+            query_embedding = self.embed_query(prompt)
+        vector = self.query_datasource(
+            datasource,
+            prompt,
+            n_results,
+            from_doc,
+            ["documents", "metadatas", "distances"],
+            query_embedding,
+        )
+        with span("lexical.search", collection=datasource.name):
+            index = self.lexical_index(datasource, wait=False)
+            # until the index is ready, the vector results are used alone
+            lexical = index.search(prompt, n_results, from_doc) if index is not None else []
+
+        found = {
+            id: (document, metadata, distance)
+            for id, document, metadata, distance in zip(
+                vector["ids"][0],
+                vector["documents"][0],
+                vector["metadatas"][0],
+                vector["distances"][0],
+            )
+        }
+        fused = reciprocal_rank_fusion([vector["ids"][0], [id for id, _ in lexical]], k=rrf_k)
+        fused = fused[:n_results]
+        missing = [id for id, _ in fused if id not in found]
+        if missing:
+            include = ["documents", "metadatas"]
+            if query_embedding is not None:
+                include.append("embeddings")
+            extra = datasource.get(ids=missing, include=include)
+            for i, id in enumerate(extra["ids"]):
+                distance = float("inf")
+                if query_embedding is not None:
+                    difference = np.asarray(extra["embeddings"][i]) - np.asarray(query_embedding)
+                    distance = float(np.dot(difference, difference))  # chroma's squared l2
+                found[id] = (extra["documents"][i], extra["metadatas"][i], distance)
+        print(
+            f"hybrid: {len(vector['ids'][0])} vector, {len(lexical)} lexical, {len(missing)} lexical only"
+        )
+
+        scores = {id: score for id, score in fused if id in found}
+        lexical_ids = {id for id, _ in lexical}
+        return {
+            "ids": [list(scores)],
+            "documents": [[found[id][0] for id in scores]],
+            "metadatas": [[found[id][1] for id in scores]],
+            "distances": [[found[id][2] for id in scores]],
+            "scores": [list(scores.values())],
+            "lexical": [[id in lexical_ids for id in scores]],
+        }
+
+    def match_documents(
+        self, prompt, collection_name, min_coverage=0.8, min_terms=3, n_candidates=10
+    ):
+        """
+        Chunks that are (almost) contained in the prompt, e.g. paper titles quoted by
+        the user. Only needs the lexical index, no embedding or LLM call (and finds
+        nothing while the index is not ready).
+
+        Args:
+            prompt (str): the query text
+            collection_name (str): collection to look into, typically a titles collection
+            min_coverage (float): share of the distinct terms of a chunk that must be in the prompt
+            min_terms (int): chunks with fewer distinct terms are ignored (too ambiguous)
+            n_candidates (int): number of BM25 results to check
+
+        Returns:
+            list of the metadatas of the matching chunks
+        """
+        datasource = self.resolve_collection(collection_name)
+        index = self.lexical_index(datasource, wait=False)
+        if index is None:
+            return []
+        matches = [
+            id
+            for id, _ in index.search(prompt, n_candidates)
+            if len(index.terms.get(id, ())) >= min_terms
+            and index.coverage(id, prompt) >= min_coverage
+        ]
+        if not matches:
+            return []
+        return datasource.get(ids=matches, include=["metadatas"])["metadatas"]
+
+    def query(
+        self,
+        prompt,
+        n_results,
+        from_doc,
+        metadatas=False,
+        distances=False,
+        collection_name=None,
+        query_embedding=None,
+        hybrid=False,
+        ranks=False,
+    ):
         """Equivalent of query_chroma
         Args:
             from_doc (string | list[string]) -  should be either a string  a list of strings
             include (list[string]) - any cmbination of embeddings, documents, metadatas. Defaults to ["documents"]
             prompt - the query text
+            collection_name (string) - collection to query
+            query_embedding (list[float]) - embedding of the prompt (see `embed_query`). If
+            provided, the prompt is not embedded again
+            hybrid (bool) - merge vector and lexical (BM25) results, see `query_hybrid`
+            ranks (bool) - with `metadatas`, also return a list of {"score", "lexical"}
+            per result: the fused score and whether BM25 found it (for plain vector
+            queries, the reciprocal rank and False)
         """
-        if self.db_provider == "chroma":
+        if self.db_provider in PROVIDERS:
             print(from_doc)
-            data = self.query_chroma(
-                prompt,
-                n_results=n_results,
-                from_doc=from_doc,
-                include=["documents", "metadatas", "distances"],
-            )
+            if hybrid:
+                data = self.query_hybrid(
+                    prompt, n_results, from_doc, collection_name, query_embedding
+                )
+            else:
+                data = self.query_chroma(
+                    prompt,
+                    n_results=n_results,
+                    from_doc=from_doc,
+                    include=["documents", "metadatas", "distances"],
+                    collection_name=collection_name,
+                    query_embedding=query_embedding,
+                )
             if metadatas:
-                return (
+                result = (
                     data["documents"][0],
                     data["metadatas"][0],
                     data["distances"][0],
                     " ".join(data["documents"][0]),
                 )
+                if ranks:
+                    count = len(data["ids"][0])
+                    scores = data.get("scores", [[1.0 / (i + 1) for i in range(count)]])[0]
+                    lexical = data.get("lexical", [[False] * count])[0]
+                    result += (
+                        [
+                            {"score": score, "lexical": found}
+                            for score, found in zip(scores, lexical)
+                        ],
+                    )
+                return result
             return " ".join(data["documents"][0])
         else:
-            raise Exception("db_provider must be one of 'chroma' or 'deeplake'")
+            raise Exception("db_provider must be one of 'chroma' or 'local'")
+
+    def query_many(self, prompt, targets, query_embedding=None):
+        """Embeds the prompt once and queries it against several collections / filters
+
+        Args:
+            prompt (str): the query text
+            targets (list[dict]): one dict per query, with the keys
+            `collection_name`, `n_results` and (optionally) `from_doc`
+            query_embedding (list[float], optional): embedding of the prompt, if already known
+
+        Returns:
+            list of (documents, metadatas, distances, documents_plain), one per target
+        """
+        if query_embedding is None:
+            query_embedding = self.embed_query(prompt)
+        return [
+            self.query(
+                prompt,
+                target["n_results"],
+                target.get("from_doc"),
+                metadatas=True,
+                collection_name=target["collection_name"],
+                query_embedding=query_embedding,
+            )
+            for target in targets
+        ]
 
     def query_papers_m(
-        self, prompt, n_results, from_doc, metadatas=False, distances=False, variant=None
+        self,
+        prompt,
+        n_results,
+        from_doc,
+        metadatas=False,
+        distances=False,
+        variant=None,
+        collection_name=None,
+        query_embedding=None,
     ):
         """Equivalent of query_chroma
         Args:
             from_doc (string | list[string]) -  should be either a string  a list of strings
             include (list[string]) - any cmbination of embeddings, documents, metadatas. Defaults to ["documents"]
             prompt - the query text
+            variant - papers variant ("titles", "authors", ...), None for the main collection
+            collection_name - main papers collection, e.g. "cqn_openaicol_ttv"
+            query_embedding - embedding of the prompt, if already known
         """
-        if variant is None:
-            if self.db_provider == "chroma":
-                print(from_doc)
-                data = self.query_chroma(
-                    prompt,
-                    n_results=n_results,
-                    from_doc=from_doc,
-                    include=["documents", "metadatas", "distances"],
+        if self.db_provider in PROVIDERS:
+            print(from_doc)
+            data = self.query_papers(
+                prompt,
+                n_results=n_results,
+                from_doc=from_doc,
+                include=["documents", "metadatas", "distances"],
+                variant=variant,
+                collection_name=collection_name,
+                query_embedding=query_embedding,
+            )
+            if metadatas:
+                return (
+                    data["documents"][0],
+                    data["metadatas"][0],
+                    data["distances"][0],
+                    " ".join(data["documents"][0]),
+                    data,
                 )
-                if metadatas:
-                    return (
-                        data["documents"][0],
-                        data["metadatas"][0],
-                        data["distances"][0],
-                        " ".join(data["documents"][0]),
-                        data,
-                    )
-                return " ".join(data["documents"][0]), data
-            else:
-                raise Exception("db_provider must be one of 'chroma' or 'deeplake'")
+            return " ".join(data["documents"][0]), data
         else:
-            if self.db_provider == "chroma":
-                print(from_doc)
-                data = self.query_papers(
-                    prompt,
-                    n_results=n_results,
-                    from_doc=from_doc,
-                    include=["documents", "metadatas", "distances"],
-                    variant=variant,
-                )
-                if metadatas:
-                    return (
-                        data["documents"][0],
-                        data["metadatas"][0],
-                        data["distances"][0],
-                        " ".join(data["documents"][0]),
-                        data,
-                    )
-                return " ".join(data["documents"][0]), data
+            raise Exception("db_provider must be one of 'chroma' or 'local'")
 
-            else:
-                raise Exception("db_provider must be one of 'chroma' or 'deeplake'")
+    @staticmethod
+    def where_from_doc(from_doc):
+        """Chroma `where` filter for the given doc(s), None if no doc is given"""
+        if not from_doc:
+            return None
+        if hasattr(from_doc, "__len__") and (not isinstance(from_doc, str)):
+            return {"doc": {"$in": from_doc}}
+        return {"doc": from_doc}
 
-    def query_chroma(self, prompt, n_results, from_doc, include=["documents"]):
+    def query_datasource(
+        self, datasource, prompt, n_results, from_doc, include, query_embedding=None
+    ):
+        """Queries a collection handle, by the precomputed embedding if one is given
+
+        Results are cached (see `RetrievalCache`) until the collection is written to.
+        Queries restricted to a few docs are answered from the doc partitions (see
+        `DocPartitions`) when their chunks are few enough to be searched locally.
+        """
+        key = RetrievalCache.key(
+            datasource.name, "vector", prompt, query_embedding, from_doc, n_results, include
+        )
+        with span("retrieval.vector", collection=datasource.name):
+            return self.retrieval_cache.get_or_compute(
+                key,
+                lambda: self.compute_query(
+                    datasource, prompt, n_results, from_doc, include, query_embedding
+                ),
+            )
+
+    def compute_query(self, datasource, prompt, n_results, from_doc, include, query_embedding):
+        """Uncached `query_datasource`"""
+        if from_doc:
+            docs = [from_doc] if isinstance(from_doc, str) else list(from_doc)
+            if query_embedding is None:
+                query_embedding = self.embed_query(prompt)
+            if query_embedding is not None:
+                with span("partitions.search", collection=datasource.name, docs=len(docs)):
+                    result = self.partitions.search(
+                        datasource, docs, query_embedding, n_results, include
+                    )
+                if result is not None:
+                    return result
+        query = {"n_results": n_results, "include": include}
+        if query_embedding is not None:
+            query["query_embeddings"] = [query_embedding]
+        else:
+            query["query_texts"] = prompt
+        where = self.where_from_doc(from_doc)
+        if where:
+            query["where"] = where
+        with span("vector.query", collection=datasource.name, provider=self.db_provider):
+            return datasource.query(**query)
+
+    def query_chroma(
+        self,
+        prompt,
+        n_results,
+        from_doc,
+        include=["documents"],
+        collection_name=None,
+        query_embedding=None,
+    ):
         """Querying Chroma data source with specified query text,
         getting best match from the chroma embeddings
         Args:
             from_doc (string | list[string]) -  should be either a string  a list of strings
             include (list[string]) - any cmbination of embeddings, documents, metadatas. Defaults to ["documents"]
             prompt - the query text
+            collection_name (string) - collection to query
+            query_embedding (list[float]) - embedding of the prompt, if already known
         """
-        if from_doc:
-            if hasattr(from_doc, "__len__") and (not isinstance(from_doc, str)):
-                return self.datasource.query(
-                    query_texts=prompt,
-                    n_results=n_results,
-                    where={"doc": {"$in": from_doc}},
-                    include=include,
-                )
-            else:
-                return self.datasource.query(
-                    query_texts=prompt,
-                    n_results=n_results,
-                    where={"doc": from_doc},
-                    include=include,
-                )
-        else:
-            return self.datasource.query(query_texts=prompt, n_results=n_results, include=include)
+        datasource = self.resolve_collection(collection_name)
+        return self.query_datasource(
+            datasource, prompt, n_results, from_doc, include, query_embedding
+        )
 
-    def query_papers(self, prompt, n_results, from_doc, include=["documents"], variant=None):
+    def query_papers(
+        self,
+        prompt,
+        n_results,
+        from_doc,
+        include=["documents"],
+        variant=None,
+        collection_name=None,
+        query_embedding=None,
+    ):
         """Querying Chroma data source with specified query text,
         getting best match from the chroma embeddings
         Args:
             from_doc (string | list[string]) -  should be either a string  a list of strings
             include (list[string]) - any cmbination of embeddings, documents, metadatas. Defaults to ["documents"]
             prompt - the query text
-            variant - the query text
-        """
-        if variant is None:
-            if from_doc:
-                if hasattr(from_doc, "__len__") and (not isinstance(from_doc, str)):
-                    return self.datasource.query(
-                        query_texts=prompt,
-                        n_results=n_results,
-                        where={"doc": {"$in": from_doc}},
-                        include=include,
-                    )
-                else:
-                    return self.datasource.query(
-                        query_texts=prompt,
-                        n_results=n_results,
-                        where={"doc": from_doc},
-                        include=include,
-                    )
-            else:
-                return self.datasource.query(
-                    query_texts=prompt, n_results=n_results, include=include
-                )
-        else:
-            if from_doc:
-                if hasattr(from_doc, "__len__") and (not isinstance(from_doc, str)):
-                    return self.extra_datasources[variant].query(
-                        query_texts=prompt,
-                        n_results=n_results,
-                        where={"doc": {"$in": from_doc}},
-                        include=include,
-                    )
-                else:
-                    return self.extra_datasources[variant].query(
-                        query_texts=prompt,
-                        n_results=n_results,
-                        where={"doc": from_doc},
-                        include=include,
-                    )
-            else:
-                return self.extra_datasources[variant].query(
-                    query_texts=prompt, n_results=n_results, include=include
-                )
+            variant - papers variant ("titles", "authors", ...), None for the main collection
+            collection_name - main papers collection, e.g. "cqn_openaicol_ttv"
+            query_embedding - embedding of the prompt, if already known
+        """
+        datasource = self.resolve_collection(collection_name, variant)
+        return self.query_datasource(
+            datasource, prompt, n_results, from_doc, include, query_embedding
+        )
 
-    def get_chroma(self, n_results, from_doc, include=["documents"]):
+    def get_chroma(self, n_results, from_doc, include=["documents"], collection_name=None):
         """
         Get document from ChromaDB that matches from_doc exactly.
         Args:
             from_doc (string | list[string]) -  should be either a string  a list of strings
             include (list[string]) - any cmbination of embeddings, documents, metadatas. Defaults to ["documents"]
+            collection_name (string) - collection to get the documents from
         """
+        datasource = self.resolve_collection(collection_name)
         if from_doc and (type(from_doc) in (list,)):
-            return self.datasource.get(
+            return datasource.get(
                 where={"doc": {"$in": from_doc}},
                 include=include,
             )
         elif from_doc:
-            return self.datasource.get(
+            return datasource.get(
                 where={"doc": from_doc},
                 include=include,
             )
         else:
-            return self.datasource.get(include=include)
+            return datasource.get(include=include)
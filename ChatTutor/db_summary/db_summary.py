@@ -10,12 +10,13 @@ from nice_functions import *
 from os.path import join
 import os
 from nice_functions import *
-import tiktoken
 import utils.config as config
 
+from core.definitions import Doc, Text
 from core.extensions import db
+from core.tokenbudget import count_tokens
 from core.openai_tools import load_api_keys
-import openai
+from core.llmclient import llm
 
 
 def print_summary_medium():
@@ -35,25 +36,16 @@ def print_summary_basic():
 
 
 def simple_gpt(system_message, user_message):
-    models_to_try = ["gpt-3.5-turbo-16k", "gpt-3.5-turbo"]
-    for model_to_try in models_to_try:
-        try:
-            response = openai.ChatCompletion.create(
-                model=model_to_try,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message},
-                ],
-                temperature=1,
-                frequency_penalty=0.0,
-                presence_penalty=0.0,
-                # stream=True,
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            print(red(model_to_try), "FAILED!")
-            if model_to_try == models_to_try[-1]:
-                raise (e)
+    return llm.complete(
+        [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message},
+        ],
+        models=["gpt-3.5-turbo-16k", "gpt-3.5-turbo"],
+        temperature=1,
+        frequency_penalty=0.0,
+        presence_penalty=0.0,
+    )
 
 
 def reduce_synopsis(synopsis, to_number_of_tokens):
@@ -202,7 +194,11 @@ def create_embeddings_with_levels_of_information():
             print()
             print(f"Generating {level} level resumen")
             db.load_datasource(rf"test_embedding_{level}")
-            current_uids = db.datasource.get(include=[])["ids"]
+            current = db.datasource.get(include=["metadatas"])
+            # summaries are stored under the uid as their doc (formerly as their id)
+            current_uids = set(current["ids"]) | {
+                (metadata or {}).get("doc") for metadata in current["metadatas"]
+            }
 
             for uid, _doc_summarized in docs_summarized.items():
                 doc_summarized = deepcopy(_doc_summarized)
@@ -214,9 +210,7 @@ def create_embeddings_with_levels_of_information():
 
                 if level == "medium":
                     synopsis = doc_summarized.get("Paper Summary", "")
-                    synopsis_tokens = len(
-                        tiktoken.get_encoding("cl100k_base").encode(synopsis)
-                    )
+                    synopsis_tokens = count_tokens(synopsis)
                     if synopsis_tokens > 300:
                         print("Summary too loog... reducing...")
                         synopsis = reduce_synopsis(synopsis, to_number_of_tokens=300)
@@ -226,10 +220,12 @@ def create_embeddings_with_levels_of_information():
 
                 summarized_docs_string = stringify_doc_summary(doc_summarized)
                 doc_metadata = docs_metadatas[uid]
-                db.datasource.add(
-                    ids=uid,
-                    metadatas=doc_metadata,
-                    documents=summarized_docs_string,
+                # through upsert_texts, so the in-memory indexes and caches see the write
+                summary_doc = Doc(docname=uid, citation="", dockey=uid)
+                db.upsert_texts(
+                    db.datasource,
+                    [Text(text=summarized_docs_string, doc=summary_doc)],
+                    metadatas=[doc_metadata],
                 )
                 print(
                     f"{green(uid)}: {doc_summarized['Paper Title'][0:50]}\n -> {green('added')}"
@@ -122,6 +122,8 @@ def_origins = db_origins_parsed + default_origins
 app.secret_key = "fhslcigiuchsvjksvjksgkgs"
 db.init_db()
 user_db.init_db()
+# BM25 indexes of the CQN collections, loaded or built in the background
+db.warm_lexical_indexes()
 
 
 
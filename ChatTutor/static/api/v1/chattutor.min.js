@@ -997,6 +997,7 @@ function queryGPT(
   //if (READ_FROM_DOC != null) args.from_doc = READ_FROM_DOC
 
   args.selectedModel = selectedModel;
+  args.chat_k = getChatId();
   if (RESPONSE_TYPE != undefined)
     args.response_type = RESPONSE_TYPE
 
@@ -0,0 +1,33 @@
+import pytest
+
+from core import tokenbudget
+
+
+class WordEncoding:
+    """Stand-in for a tiktoken encoding: one token per whitespace separated word"""
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.words = {}
+
+    def encode(self, text, disallowed_special=()):
+        tokens = []
+        for word in text.split():
+            token = self.vocabulary.setdefault(word, len(self.vocabulary))
+            self.words[token] = word
+            tokens.append(token)
+        return tokens
+
+    def decode(self, tokens):
+        return " ".join(self.words[token] for token in tokens)
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    """Counts tokens as words, so tests don't need to download the tiktoken files"""
+    encoding = WordEncoding()
+    monkeypatch.setattr(
+        tokenbudget, "get_encoding", lambda encoding_name=None: encoding
+    )
+    monkeypatch.setattr(tokenbudget, "token_memo", tokenbudget.TokenMemo())
+    return encoding
@@ -0,0 +1,121 @@
+import numpy as np
+
+from core.tutor import answercache
+from core.tutor.answercache import AnswerCache, key_terms
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def near(vector, similarity):
+    """Unit vector whose cosine similarity with `vector` (2d) is `similarity`"""
+    angle = np.arccos(similarity)
+    base = np.arctan2(vector[1], vector[0])
+    return np.array([np.cos(base + angle), np.sin(base + angle)], dtype=np.float32)
+
+
+class Listened:
+    def __init__(self):
+        self.listeners = []
+
+    def on_write(self, listener):
+        self.listeners.append(listener)
+
+    def write(self, name):
+        for listener in self.listeners:
+            listener(name)
+
+
+def filled_cache(prompt="What is a qubit?", **kwargs):
+    cache = AnswerCache(enabled=True, threshold=0.96, **kwargs)
+    scope = cache.scope("CQNTutor", {"cqn": ""}, None, "gpt", "openai")
+    cache.put(scope, unit(1, 0), cache.generation(scope), prompt, "an answer", [])
+    return cache, scope
+
+
+def test_disabled_by_default():
+    assert answercache.ANSWER_CACHE_ENABLED is False
+
+
+def test_key_terms():
+    assert key_terms("What is a qubit?") == frozenset()
+    assert key_terms("When is homework 3 due?") == {"3"}
+    assert key_terms("Which papers were written by Lukin?") == {"lukin"}
+    assert key_terms("Explain QFT. Then explain BB84") == {"qft", "bb84"}
+    assert key_terms("Can I use the Bloch sphere?") == {"bloch"}
+
+
+def test_hit_above_threshold_only():
+    cache, scope = filled_cache()
+    vector = unit(1, 0)
+    assert cache.get(scope, near(vector, 0.97), "What's a qubit?").answer == "an answer"
+    assert cache.get(scope, near(vector, 0.95), "What's a qubit?") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_numbers_and_names_must_match():
+    cache, scope = filled_cache("When is homework 3 due?")
+    assert cache.get(scope, unit(1, 0), "When is homework 4 due?") is None
+    assert cache.get(scope, unit(1, 0), "When is homework 3 due?") is not None
+
+    cache, scope = filled_cache("Which papers were written by Lukin?")
+    assert cache.get(scope, unit(1, 0), "Which papers were written by Lukas?") is None
+
+
+def test_scopes_are_separate():
+    cache, scope = filled_cache()
+    other = cache.scope("CQNTutor", {"cqn": ""}, "some doc", "gpt", "openai")
+    assert cache.get(other, unit(1, 0), "What is a qubit?") is None
+
+
+def test_expired_answers_are_ignored():
+    cache, scope = filled_cache(ttl=-1)
+    assert cache.get(scope, unit(1, 0), "What is a qubit?") is None
+
+
+def test_collection_writes_invalidate():
+    cache, scope = filled_cache()
+    vector_db = Listened()
+    cache.attach(vector_db)
+    cache.attach(vector_db)
+    assert len(vector_db.listeners) == 1
+    vector_db.write("other")
+    assert cache.get(scope, unit(1, 0), "What is a qubit?") is not None
+    vector_db.write("cqn")
+    assert cache.get(scope, unit(1, 0), "What is a qubit?") is None
+
+
+def test_table_writes_invalidate():
+    cache = AnswerCache(enabled=True)
+    scope = cache.scope("SQLQueryTutor", {"cqn": ""}, None, "gpt", "openai", ["paper"])
+    cache.put(scope, unit(1, 0), cache.generation(scope), "Papers?", "answer", [])
+    database = Listened()
+    cache.attach_database(database)
+    database.write("cqn_other")
+    assert cache.get(scope, unit(1, 0), "Papers?") is not None
+    database.write("paper")
+    assert cache.get(scope, unit(1, 0), "Papers?") is None
+
+
+def test_answers_generated_during_a_write_are_not_stored():
+    cache = AnswerCache(enabled=True)
+    scope = cache.scope("CQNTutor", {"cqn": ""}, None, "gpt", "openai")
+    generation = cache.generation(scope)
+    cache.invalidate("cqn")
+    cache.put(scope, unit(1, 0), generation, "What is a qubit?", "stale", [])
+    assert cache.get(scope, unit(1, 0), "What is a qubit?") is None
+
+
+def test_recorder():
+    recorder = answercache.AnswerRecorder()
+    for message in [
+        {"content": "", "valid_docs": [1]},
+        {"content": "a"},
+        {"content": "b"},
+    ]:
+        recorder.feed(message)
+    assert recorder.answer == "ab" and recorder.valid_docs == [1] and recorder.complete
+    recorder.feed({"error": "x"})
+    assert not recorder.complete
@@ -0,0 +1,31 @@
+from core.tutor import contextpacker
+
+
+def test_relevance_from_distance():
+    assert contextpacker.relevance({"distance": 0}) == 1
+    assert contextpacker.relevance({"distance": 1}) == 0.5
+    assert contextpacker.relevance({"distance": 4}) == 1e-3
+    assert contextpacker.relevance({}) == 1.0
+
+
+def test_pack_keeps_relevance_per_token_within_budget(word_tokens):
+    docs = [{"distance": 0.2}, {"distance": 0.4}, {"distance": 0.1}]
+    texts = ["a " * 8, "b b", "c " * 5]
+    kept, kept_texts, dropped = contextpacker.pack_context(docs, texts, budget=8)
+    # the short snippet and the closest one fit, the long one would not
+    assert kept == [docs[1], docs[2]]
+    assert kept_texts == [texts[1], texts[2]]
+    assert dropped == [docs[0]]
+
+
+def test_pack_never_cuts_documents(word_tokens):
+    docs = [{"distance": 0.1}]
+    kept, kept_texts, dropped = contextpacker.pack_context(docs, ["a b c"], budget=2)
+    assert kept == [] and kept_texts == []
+    assert dropped == docs
+
+
+def test_pack_keeps_original_order(word_tokens):
+    docs = [{"distance": 1.0}, {"distance": 0.0}]
+    kept, _, dropped = contextpacker.pack_context(docs, ["x", "y"], budget=10)
+    assert kept == docs and dropped == []
@@ -0,0 +1,78 @@
+from core.docpartitions import DocPartitions
+from core.localvectorindex import LocalCollection
+
+
+def write(collection, ids, doc, vector=(1.0, 0.0)):
+    collection.upsert(
+        ids=ids,
+        embeddings=[list(vector)] * len(ids),
+        metadatas=[{"doc": doc}] * len(ids),
+        documents=[f"chunk {id}" for id in ids],
+    )
+
+
+def test_search_returns_nearest_chunks_of_the_docs(tmp_path):
+    collection = LocalCollection("col", str(tmp_path))
+    write(collection, ["a1", "a2"], "a", (1.0, 0.0))
+    write(collection, ["b1"], "b", (0.0, 1.0))
+    partitions = DocPartitions()
+    result = partitions.search(
+        collection, ["b"], [1.0, 0.0], 5, ["documents", "distances"]
+    )
+    assert result["ids"] == [["b1"]]
+    assert result["documents"] == [["chunk b1"]]
+
+
+def test_doc_without_chunks_is_not_remembered(tmp_path):
+    collection = LocalCollection("col", str(tmp_path))
+    write(collection, ["a1"], "a")
+    partitions = DocPartitions(check_interval=3600)
+    assert partitions.chunk_ids(collection, ["b"]) == {"b": []}
+    # ingested later, by another writer
+    write(collection, ["b1"], "b")
+    assert partitions.chunk_ids(collection, ["b"]) == {"b": ["b1"]}
+
+
+def test_writes_of_other_processes_are_noticed_by_the_count_check(tmp_path):
+    collection = LocalCollection("col", str(tmp_path))
+    write(collection, ["a1"], "a")
+    partitions = DocPartitions(check_interval=0)
+    assert partitions.search(collection, ["a"], [1.0, 0.0], 5, [])["ids"] == [["a1"]]
+    write(collection, ["a2"], "a")
+    assert sorted(
+        partitions.search(collection, ["a"], [1.0, 0.0], 5, [])["ids"][0]
+    ) == [
+        "a1",
+        "a2",
+    ]
+
+
+def test_partitions_expire_after_the_ttl(tmp_path):
+    collection = LocalCollection("col", str(tmp_path))
+    write(collection, ["a1"], "a")
+    partitions = DocPartitions(ttl=0, check_interval=3600)
+    partitions.chunk_ids(collection, ["a"])
+    # same count (an overwrite elsewhere), only the ttl catches it
+    collection.delete(ids=["a1"])
+    write(collection, ["a3"], "a")
+    assert partitions.chunk_ids(collection, ["a"]) == {"a": ["a3"]}
+
+
+def test_own_writes_update_the_partitions(tmp_path):
+    collection = LocalCollection("col", str(tmp_path))
+    write(collection, ["a1"], "a")
+    partitions = DocPartitions(check_interval=0)
+    partitions.chunk_ids(collection, ["a"])
+    write(collection, ["a2"], "a")
+    partitions.written("col", ["a2"], ["a"])
+    assert partitions.chunk_ids(collection, ["a"]) == {"a": ["a1", "a2"]}
+
+
+def test_search_results_do_not_alias_the_loaded_blocks(tmp_path):
+    collection = LocalCollection("col", str(tmp_path))
+    write(collection, ["a1"], "a")
+    partitions = DocPartitions(check_interval=3600)
+    result = partitions.search(collection, ["a"], [1.0, 0.0], 5, ["metadatas"])
+    result["metadatas"][0][0]["doc"] = "changed"
+    again = partitions.search(collection, ["a"], [1.0, 0.0], 5, ["metadatas"])
+    assert again["metadatas"] == [[{"doc": "a"}]]
@@ -0,0 +1,78 @@
+import pytest
+
+from core.tutor.intent import (
+    FOLLOW_UP,
+    FOLLOW_UP_EXAMPLES,
+    STANDALONE,
+    UNSURE,
+    IntentClassifier,
+    previous_context,
+)
+
+
+def conversation(*messages):
+    roles = ["user", "assistant"]
+    return [{"role": roles[i % 2], "content": m} for i, m in enumerate(messages)]
+
+
+def test_first_message_is_standalone():
+    classifier = IntentClassifier()
+    assert classifier.classify(conversation("What does it mean?")) == (STANDALONE, -1.0)
+
+
+def test_references_to_the_previous_answer_are_follow_ups():
+    classifier = IntentClassifier()
+    for prompt in ["What does it mean?", "And why is that?", "Tell me more about them"]:
+        label, score = classifier.classify(
+            conversation("What is a qubit?", "A qubit is ...", prompt)
+        )
+        assert label == FOLLOW_UP, prompt
+        assert score >= classifier.follow_up_threshold
+
+
+def test_questions_naming_their_subject_are_standalone():
+    classifier = IntentClassifier()
+    label, _ = classifier.classify(
+        conversation(
+            "What is a qubit?",
+            "A qubit is ...",
+            "Explain how the Schrodinger equation describes a particle in a box",
+        )
+    )
+    assert label == STANDALONE
+
+
+def test_lexical_score_is_bounded():
+    for prompt in ["it it it this that and", "", "A" * 500]:
+        assert -1.0 <= IntentClassifier.lexical_score(prompt) <= 1.0
+
+
+def fake_embed(texts):
+    """Follow-up examples point one way, everything else the other way"""
+    return [[1.0, 0.0] if text in FOLLOW_UP_EXAMPLES else [0.0, 1.0] for text in texts]
+
+
+def test_centroid_score_follows_the_nearest_centroid():
+    classifier = IntentClassifier()
+    assert classifier.centroid_score([1.0, 0.05], fake_embed) == 1.0
+    assert classifier.centroid_score([0.05, 1.0], fake_embed) == -1.0
+    assert classifier.centroid_score(None, fake_embed) == 0.0
+
+
+def test_embedding_and_wording_are_averaged():
+    classifier = IntentClassifier()
+    messages = conversation("What is a qubit?", "A qubit is ...", "Why does it work?")
+    # the wording says follow-up, the embedding says standalone
+    label, score = classifier.classify(messages, fake_embed)
+    assert label == UNSURE
+    assert score == pytest.approx(
+        0.5 * IntentClassifier.lexical_score("Why does it work?") - 0.5
+    )
+
+
+def test_previous_context_names_the_previous_question_and_answer():
+    note = previous_context(
+        conversation("What is a qubit?", "A qubit is\na two level system", "why?"),
+        max_chars=12,
+    )
+    assert note == "referring to: What is a qubit? - A qubit is a"
@@ -0,0 +1,76 @@
+import pytest
+
+from core.lexicalindex import BM25Index, reciprocal_rank_fusion, tokenize
+
+
+def test_tokenize_drops_stopwords_and_case():
+    assert tokenize("What is the Rydberg blockade?") == ["rydberg", "blockade"]
+
+
+def test_rrf_rewards_ids_ranked_by_both_retrievers():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "d"]], k=60)
+    ids = [id for id, _ in fused]
+    assert ids[0] == "c"
+    assert set(ids) == {"a", "b", "c", "d"}
+    assert dict(fused)["c"] == pytest.approx(1 / 63 + 1 / 61)
+
+
+def test_rrf_keeps_a_single_ranking_in_order():
+    assert [id for id, _ in reciprocal_rank_fusion([["x", "y", "z"]])] == [
+        "x",
+        "y",
+        "z",
+    ]
+
+
+def test_rrf_lexical_only_hit_can_beat_lower_vector_hits():
+    vector = ["v1", "v2", "v3", "v4"]
+    lexical = ["l1"]
+    ids = [id for id, _ in reciprocal_rank_fusion([vector, lexical])]
+    assert ids.index("l1") < ids.index("v2")
+
+
+def make_index():
+    index = BM25Index()
+    index.add(
+        ["1", "2", "3"],
+        [
+            "rydberg atoms in optical tweezers",
+            "superconducting qubits and microwave photons",
+            "rydberg blockade gates with rydberg atoms",
+        ],
+        ["paper-a", "paper-b", "paper-c"],
+    )
+    return index
+
+
+def test_search_ranks_by_term_frequency_and_filters_docs():
+    index = make_index()
+    assert [id for id, _ in index.search("rydberg", 10)] == ["3", "1"]
+    assert [id for id, _ in index.search("rydberg", 10, from_doc="paper-a")] == ["1"]
+    assert index.search("graphene", 10) == []
+
+
+def test_remove_and_reindex():
+    index = make_index()
+    index.remove(["3"])
+    assert [id for id, _ in index.search("rydberg", 10)] == ["1"]
+    index.add(["1"], ["microwave photons"], ["paper-a"])
+    assert index.search("rydberg", 10) == []
+    assert len(index) == 2
+
+
+def test_save_and_load_give_the_same_scores(tmp_path):
+    index = make_index()
+    path = str(tmp_path / "col.bm25.json")
+    index.save(path)
+    loaded = BM25Index.load(path)
+    assert len(loaded) == len(index)
+    assert loaded.search("rydberg atoms", 10) == index.search("rydberg atoms", 10)
+    assert loaded.search("rydberg", 10, from_doc=["paper-c"]) == [
+        index.search("rydberg", 1)[0]
+    ]
+
+
+def test_load_of_a_missing_file_is_none(tmp_path):
+    assert BM25Index.load(str(tmp_path / "missing.json")) is None
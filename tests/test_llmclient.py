@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("google.generativeai")
+
+from core.llmclient import CircuitBreaker, LatencyTracker, LLMClient, LLMUnavailable
+
+
+class FakeProvider:
+    def __init__(self, name, answer=None, error=None, delay=0.0):
+        self.name = name
+        self.answer = answer
+        self.error = error
+        self.delay = delay
+        self.calls = []
+        self.closed = threading.Event()
+
+    def complete(self, model, messages, temperature, timeout, parts=None, **params):
+        self.calls.append(model)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+    def stream(self, model, messages, temperature, timeout, parts=None, **params):
+        self.calls.append(model)
+        try:
+            yield {"role": "assistant", "content": ""}
+            time.sleep(self.delay)
+            yield {"content": self.answer}
+            yield {}
+        finally:
+            self.closed.set()
+
+
+def client(openai, gemini, **kwargs):
+    llm = LLMClient(
+        fallback_models=["gemini-pro"], max_retries=0, max_workers=4, **kwargs
+    )
+    llm.providers = {"openai": openai, "gemini": gemini}
+    return llm
+
+
+def test_fallback_is_opt_in():
+    llm = client(FakeProvider("openai"), FakeProvider("gemini"))
+    assert llm.candidates(["gpt-4"]) == ["gpt-4"]
+    assert llm.candidates(["gpt-4"], fallback=True) == ["gpt-4", "gemini-pro"]
+    assert llm.candidates(["gemini-pro"], fallback=True) == ["gemini-pro"]
+
+
+def test_pinned_model_is_not_replaced():
+    openai = FakeProvider("openai", error=TimeoutError("slow"))
+    gemini = FakeProvider("gemini", answer="gemini answer")
+    llm = client(openai, gemini)
+    with pytest.raises(LLMUnavailable):
+        llm.complete([{"role": "user", "content": "hi"}], models=["gpt-4"])
+    assert gemini.calls == []
+
+
+def test_fallback_answers_when_asked():
+    openai = FakeProvider("openai", error=TimeoutError("slow"))
+    gemini = FakeProvider("gemini", answer="gemini answer")
+    llm = client(openai, gemini)
+    answer = llm.complete(
+        [{"role": "user", "content": "hi"}], models=["gpt-4"], fallback=True
+    )
+    assert answer == "gemini answer"
+    assert llm.breakers["openai"].failed == 1
+
+
+def test_no_hedge_without_samples():
+    tracker = LatencyTracker(min_samples=3, min_delay=0.1)
+    assert tracker.hedge_delay("gpt-4") is None
+    for seconds in (1.0, 2.0, 3.0):
+        tracker.record("gpt-4", seconds)
+    assert tracker.hedge_delay("gpt-4", percentile=50) == 2.0
+    tracker.record("fast", 0.01)
+    assert tracker.hedge_delay("fast") is None
+
+
+def test_hedged_stream_closes_the_loser():
+    openai = FakeProvider("openai", answer="slow", delay=0.5)
+    gemini = FakeProvider("gemini", answer="fast")
+    llm = client(openai, gemini)
+    llm.latencies = LatencyTracker(min_samples=1, min_delay=0.05)
+    llm.latencies.record(("gpt-4", "stream"), 0.05)
+    deltas = llm.stream(
+        [{"role": "user", "content": "hi"}], models=["gpt-4"], fallback=True
+    )
+    assert [delta.get("content") for delta in deltas] == ["", "fast", None]
+    assert openai.closed.wait(2)
+    assert llm.breakers["openai"].state == "closed"
+
+
+def test_breaker_opens_and_probes():
+    breaker = CircuitBreaker(failures=2, reset_after=0.05)
+    breaker.failure()
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    # only one probe at a time
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_breaker_release_lets_another_probe_through():
+    breaker = CircuitBreaker(failures=1, reset_after=0)
+    breaker.failure()
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.allow()
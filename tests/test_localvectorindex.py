@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from core.localvectorindex import LocalCollection, LocalVectorIndex
+
+
+def open_collection(path):
+    return LocalCollection("col", str(path))
+
+
+def test_query_returns_nearest_rows_first(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(
+        ids=["a", "b", "c"],
+        embeddings=[[1, 0], [0, 1], [1, 1]],
+        metadatas=[{"doc": "x"}, {"doc": "y"}, {"doc": "x"}],
+        documents=["A", "B", "C"],
+    )
+    result = collection.query(query_embeddings=[[1, 0.1]], n_results=2)
+    assert result["ids"] == [["a", "c"]]
+    assert np.isclose(result["distances"][0][0], 2 - 2 * 1 / np.hypot(1, 0.1))
+
+
+def test_where_filters(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(
+        ids=["a", "b", "c", "d"],
+        embeddings=[[1, 0]] * 4,
+        metadatas=[{"doc": "x"}, {"doc": "y"}, {"doc": "z"}, None],
+        documents=["A", "B", "C", "D"],
+    )
+
+    def ids(where):
+        return collection.get(where=where, include=[])["ids"]
+
+    assert ids({"doc": "x"}) == ["a"]
+    assert ids({"doc": {"$eq": "y"}}) == ["b"]
+    assert ids({"doc": {"$ne": "x"}}) == ["b", "c", "d"]
+    assert ids({"doc": {"$in": ["x", "z", "unknown"]}}) == ["a", "c"]
+    assert ids({"doc": {"$nin": ["x", "z"]}}) == ["b", "d"]
+    assert ids({"doc": "unknown"}) == []
+    assert collection.query(query_embeddings=[[1, 0]], where={"doc": "z"})["ids"] == [
+        ["c"]
+    ]
+
+
+def test_filter_sees_later_writes(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(ids=["a"], embeddings=[[1, 0]], metadatas=[{"doc": "x"}])
+    assert collection.get(where={"doc": "y"}, include=[])["ids"] == []
+    collection.upsert(
+        ids=["a", "b"], embeddings=[[1, 0]] * 2, metadatas=[{"doc": "y"}] * 2
+    )
+    assert collection.get(where={"doc": "y"}, include=[])["ids"] == ["a", "b"]
+
+
+def test_repeated_id_in_a_batch_keeps_the_last_entry(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(
+        ids=["a", "a"], embeddings=[[1, 0], [0, 1]], documents=["old", "new"]
+    )
+    assert collection.count() == 1
+    result = collection.get(ids=["a"], include=["documents", "embeddings"])
+    assert result["documents"] == ["new"]
+    assert np.allclose(result["embeddings"], [[0, 1]])
+
+
+def test_writes_survive_a_reload(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(ids=["a", "b"], embeddings=[[1, 0], [0, 1]], documents=["A", "B"])
+    collection.upsert(ids=["c"], embeddings=[[1, 1]], documents=["C"])
+    collection.upsert(ids=["a"], embeddings=[[0, 1]], documents=["A2"])
+    # only the first write rewrites the snapshot, later ones append to the log
+    assert (tmp_path / "col.log").exists()
+
+    reloaded = open_collection(tmp_path)
+    result = reloaded.get(include=["documents", "embeddings"])
+    assert result["ids"] == ["a", "b", "c"]
+    assert result["documents"] == ["A2", "B", "C"]
+    assert np.allclose(result["embeddings"][0], [0, 1])
+
+
+def test_delete_compacts_the_files(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(
+        ids=["a", "b"], embeddings=[[1, 0], [0, 1]], metadatas=[{"doc": "x"}] * 2
+    )
+    collection.upsert(ids=["c"], embeddings=[[1, 1]], metadatas=[{"doc": "y"}])
+    collection.delete(where={"doc": "x"})
+    assert not (tmp_path / "col.log").exists()
+    assert open_collection(tmp_path).get(include=[])["ids"] == ["c"]
+
+
+def test_results_do_not_alias_the_stored_metadata(tmp_path):
+    collection = open_collection(tmp_path)
+    collection.upsert(
+        ids=["a"], embeddings=[[1.0, 0.0]], metadatas=[{"doc": "d"}], documents=["x"]
+    )
+    got = collection.get(ids=["a"], include=["metadatas"])
+    got["metadatas"][0]["doc"] = "changed"
+    queried = collection.query(
+        query_embeddings=[[1.0, 0.0]], n_results=1, include=["metadatas"]
+    )
+    queried["metadatas"][0][0]["title"] = "changed"
+    again = collection.get(ids=["a"], include=["metadatas"])
+    assert again["metadatas"] == [{"doc": "d"}]
+
+
+def test_other_json_files_are_not_collections(tmp_path):
+    open_collection(tmp_path).upsert(ids=["a"], embeddings=[[1, 0]], documents=["x"])
+    (tmp_path / "col.bm25.json").write_text('{"k1": 1.5, "b": 0.75, "chunks": []}')
+    index = LocalVectorIndex(str(tmp_path))
+    assert [collection.name for collection in index.list_collections()] == ["col"]
+    with pytest.raises(ValueError):
+        index.get_collection("col.bm25")
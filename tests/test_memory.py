@@ -0,0 +1,124 @@
+import pytest
+
+pytest.importorskip("pymysql")
+pytest.importorskip("openai")
+
+from core.tutor import memory
+from core.tutor.memory import SUMMARY_PREFIX, ConversationMemory, prefix_hash
+
+
+class FakeDataBase:
+    rows = {}
+
+    def get_chat_summary(self, owner_id, chat_id):
+        return self.rows.get((owner_id, chat_id)), None
+
+    def upsert_chat_summary(self, owner_id, chat_id, summary, covered, prefix_hash):
+        self.rows[(owner_id, chat_id)] = {
+            "summary": summary,
+            "covered": covered,
+            "prefix_hash": prefix_hash,
+        }
+        return self.rows[(owner_id, chat_id)], None
+
+
+class InlineExecutor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, function, *args):
+        self.submitted.append(args)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    monkeypatch.setattr(FakeDataBase, "rows", {})
+    monkeypatch.setattr(memory, "DataBase", FakeDataBase)
+    return FakeDataBase()
+
+
+def chat(*contents):
+    roles = ["user", "assistant"]
+    return [
+        {"role": roles[i % 2], "content": content} for i, content in enumerate(contents)
+    ]
+
+
+def test_prefix_hash():
+    conversation = chat("a b", "c", "d")
+    assert prefix_hash(conversation, 2) == prefix_hash(chat("a b", "c", "other"), 2)
+    assert prefix_hash(conversation, 2) != prefix_hash(chat("a b", "x", "d"), 2)
+    assert prefix_hash(conversation, 2) != prefix_hash(chat("a", "b c", "d"), 2)
+    swapped = [{"role": "assistant", "content": "a b"}, conversation[1]]
+    assert prefix_hash(conversation, 2) != prefix_hash(swapped, 2)
+
+
+def test_split_keeps_the_recent_tokens(word_tokens):
+    conversation = chat("one two", "three", "four five", "six", "seven eight")
+    # the last message is always kept, then as many as fit in 4 tokens
+    assert ConversationMemory(recent_tokens=4).split(conversation, 0) == 3
+    assert ConversationMemory(recent_tokens=5).split(conversation, 0) == 2
+    # never before what is already summarized
+    assert ConversationMemory(recent_tokens=100).split(conversation, 1) == 1
+    # the question alone is over the budget, everything before it is folded
+    assert ConversationMemory(recent_tokens=1).split(conversation, 0) == 4
+
+
+def test_stored_checks_the_prefix(database):
+    conversation = chat("a", "b", "c", "d", "e")
+    database.upsert_chat_summary(
+        "alice", "chat", "summary", 2, prefix_hash(conversation, 2)
+    )
+    store = ConversationMemory()
+    assert store.stored("alice", "chat", conversation) == ("summary", 2)
+    # cleared or edited chat
+    assert store.stored("alice", "chat", chat("x", "b", "c")) == ("", 0)
+    # the summary covers the question too
+    assert store.stored("alice", "chat", conversation[:2]) == ("", 0)
+    assert store.stored("alice", "other", conversation) == ("", 0)
+    # another user's chat with the same id
+    assert store.stored("mallory", "chat", conversation) == ("", 0)
+
+
+def test_compact_uses_the_summary(database, word_tokens):
+    conversation = chat("a", "b", "c", "d", "e")
+    database.upsert_chat_summary(
+        "alice", "chat", "summary", 2, prefix_hash(conversation, 2)
+    )
+    store = ConversationMemory(enabled=True, fold_tokens=100, executor=InlineExecutor())
+    compacted = store.compact("chat", conversation, "alice")
+    assert (
+        compacted
+        == [{"role": "system", "content": SUMMARY_PREFIX + "summary"}]
+        + conversation[2:]
+    )
+    assert store.compact("chat", conversation, None) == conversation
+    assert store.executor.submitted == []
+
+
+def test_compact_schedules_one_fold(database, word_tokens):
+    conversation = chat("a b c", "d e f", "g")
+    executor = InlineExecutor()
+    store = ConversationMemory(
+        enabled=True, fold_tokens=5, token_limit=4, executor=executor
+    )
+    # 7 tokens > 5: a fold is scheduled, meanwhile the messages are truncated to 4 tokens
+    assert store.compact("chat", conversation, "alice") == conversation[1:]
+    store.compact("chat", conversation, "alice")
+    assert [args[:2] for args in executor.submitted] == [("alice", "chat")]
+
+
+def test_fold_stores_under_the_owner(database, word_tokens, monkeypatch):
+    monkeypatch.setattr(memory.llm, "complete", lambda *args, **kwargs: "new summary")
+    conversation = chat("a b c", "d e f", "g")
+    store = ConversationMemory(recent_tokens=1)
+    store.folding.add(("alice", "chat"))
+    store.fold("alice", "chat", conversation, "", 0)
+    assert database.rows == {
+        ("alice", "chat"): {
+            "summary": "new summary",
+            "covered": 2,
+            "prefix_hash": prefix_hash(conversation, 2),
+        }
+    }
+    assert store.folding == set()
@@ -0,0 +1,101 @@
+import pytest
+
+from core.tutor.sqlintents import SQLIntentRouter, author_surname
+
+router = SQLIntentRouter(enabled=True)
+
+ROUTED = [
+    ("papers by Lukin", "papers_by_author", {"author": "lukin"}),
+    ("Papers by M. D. Lukin?", "papers_by_author", {"author": "lukin"}),
+    (
+        "Give me all the papers written by Lukin",
+        "papers_by_author",
+        {"author": "lukin"},
+    ),
+    (
+        "Can you list publications authored by Englund",
+        "papers_by_author",
+        {"author": "englund"},
+    ),
+    ("What has Lukin published?", "papers_by_author", {"author": "lukin"}),
+    ("what papers did Lončar write", "papers_by_author", {"author": "lončar"}),
+    (
+        "Who wrote Quantum network nodes?",
+        "authors_of_paper",
+        {"title": "quantum network nodes"},
+    ),
+    (
+        "authors of the paper 'Quantum network nodes'",
+        "authors_of_paper",
+        {"title": "quantum network nodes"},
+    ),
+    ("How many papers are there?", "count_papers", {}),
+    ("how many papers are in the database", "count_papers", {}),
+    ("How many publications in the CQN database?", "count_papers", {}),
+    ("how many papers from the db", "count_papers", {}),
+    (
+        "How many papers about entanglement?",
+        "count_papers_about",
+        {"topic": "entanglement"},
+    ),
+    (
+        "how many papers are in the database about photonic crystals",
+        "count_papers_about",
+        {"topic": "photonic crystals"},
+    ),
+    ("papers about quantum repeaters", "papers_about", {"topic": "quantum repeaters"}),
+    ("show me articles on spin qubits", "papers_about", {"topic": "spin qubits"}),
+]
+
+NOT_ROUTED = [
+    # "of" does not introduce an author
+    "papers of quantum computing",
+    "papers of Lukin",
+    # refers to the previous messages
+    "who wrote the paper on it",
+    "who wrote that paper",
+    "who wrote it",
+    "authors of this",
+    "papers by him",
+    "papers by them",
+    # no title
+    "who wrote the paper",
+    "who wrote the paper about entanglement",
+    # two conditions, left to the LLM
+    "papers by Lukin about entanglement",
+    "papers about entanglement since 2020",
+    "how many papers by Lukin",
+    # not a database question
+    "what is a qubit",
+    "explain the paper about quantum memories",
+    "",
+]
+
+
+@pytest.mark.parametrize("question,name,params", ROUTED)
+def test_routed(question, name, params):
+    intent = router.route(question)
+    assert intent is not None, question
+    assert (intent.name, intent.params) == (name, params)
+
+
+@pytest.mark.parametrize("question", NOT_ROUTED)
+def test_not_routed(question):
+    assert router.route(question) is None
+
+
+def test_disabled():
+    assert SQLIntentRouter(enabled=False).route("papers by Lukin") is None
+
+
+@pytest.mark.parametrize(
+    "name,surname",
+    [
+        ("M. D. Lukin", "lukin"),
+        ("lukin et al.", "lukin"),
+        ("Lukin and", "lukin"),
+        ("et al", ""),
+    ],
+)
+def test_author_surname(name, surname):
+    assert author_surname(name.lower()) == surname
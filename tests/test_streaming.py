@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+from core.tutor import streaming
+
+
+def parse(frame):
+    assert frame.startswith("data: ") and frame.endswith("\n\n")
+    return json.loads(frame[len("data: ") : -2])
+
+
+def test_frames_keep_the_client_shape():
+    frame = streaming.encode_event(1.23456, {"sources": [], "valid_docs": []})
+    assert parse(frame) == {"time": 1.235, "message": {"sources": [], "valid_docs": []}}
+    frame = streaming.encode_content(0.5, 'a "quoted"\nline')
+    assert parse(frame) == {"time": 0.5, "message": {"content": 'a "quoted"\nline'}}
+
+
+def test_deltas_are_merged_until_max_chars():
+    encoder = streaming.SSEEncoder(max_chars=5, max_delay=60)
+    messages = [
+        {"content": "ab"},
+        {"content": "cd"},
+        {"content": "ef"},
+        {"content": "g"},
+    ]
+    frames = [parse(frame) for frame in encoder.encode(messages, start_time=0)]
+    assert [frame["message"] for frame in frames] == [
+        {"content": "abcdef"},
+        {"content": "g"},
+    ]
+
+
+def test_other_messages_flush_and_keep_order():
+    encoder = streaming.SSEEncoder(max_chars=100, max_delay=60)
+    messages = [
+        {"content": "Hello"},
+        {"content": ""},
+        {"content": " world"},
+        {"sources": ["s"]},
+        {"content": "!"},
+        {"content": "", "valid_docs": []},
+    ]
+    frames = [parse(frame)["message"] for frame in encoder.encode(messages)]
+    assert frames == [
+        {"content": "Hello world"},
+        {"sources": ["s"]},
+        {"content": "!"},
+        {"content": "", "valid_docs": []},
+    ]
+
+
+def test_deltas_are_flushed_after_max_delay():
+    encoder = streaming.SSEEncoder(max_chars=100, max_delay=0)
+    messages = [{"content": "a"}, {"content": "b"}]
+    frames = [parse(frame)["message"] for frame in encoder.encode(messages)]
+    assert frames == [{"content": "a"}, {"content": "b"}]
+
+
+def test_aencode_matches_encode():
+    encoder = streaming.SSEEncoder(max_chars=3, max_delay=60)
+    messages = [{"content": "ab"}, {"content": "cd"}, {"sources": []}]
+
+    async def produce():
+        for message in messages:
+            yield message
+
+    async def collect():
+        return [frame async for frame in encoder.aencode(produce(), start_time=0)]
+
+    frames = [parse(frame)["message"] for frame in asyncio.run(collect())]
+    assert frames == [{"content": "abcd"}, {"sources": []}]
@@ -0,0 +1,73 @@
+import hashlib
+
+import pytest
+
+from core import tokenbudget
+
+
+def test_count_and_truncate(word_tokens):
+    assert tokenbudget.count_tokens("one two three") == 3
+    assert tokenbudget.truncate_tokens("one two three", 2) == "one two"
+    assert tokenbudget.truncate_tokens("one two", 5) == "one two"
+    assert tokenbudget.truncate_tokens("one two three", None) == "one two three"
+    assert tokenbudget.truncate_tokens("one two three", 0) == "one two three"
+
+
+def test_truncate_rows_keeps_whole_rows(word_tokens):
+    rows = ["one two", "three four", "five six"]
+    # two words and a separator per row
+    assert tokenbudget.truncate_rows(rows, 7) == ["one two", "three four"]
+    assert tokenbudget.truncate_rows(rows, 2) == []
+    assert tokenbudget.truncate_rows(rows, None) == rows
+
+
+def test_memo_counts_each_content_once(word_tokens, monkeypatch):
+    calls = []
+    count_tokens = tokenbudget.count_tokens
+
+    def counting(text, encoding_name=tokenbudget.DEFAULT_ENCODING):
+        calls.append(text)
+        return count_tokens(text, encoding_name)
+
+    monkeypatch.setattr(tokenbudget, "count_tokens", counting)
+    for _ in range(3):
+        assert tokenbudget.count_message_tokens("a b c") == 3
+    assert calls == ["a b c"]
+
+
+def test_memo_evicts_the_least_recently_used(word_tokens):
+    memo = tokenbudget.TokenMemo(max_entries=2)
+    memo.count("a")
+    memo.count("b b")
+    memo.count("a")
+    memo.count("c c c")
+
+    def cached(text):
+        key = (
+            tokenbudget.DEFAULT_ENCODING,
+            hashlib.sha1(text.encode("utf-8")).digest(),
+        )
+        return key in memo._counts
+
+    assert cached("a") and cached("c c c")
+    assert not cached("b b")
+
+
+def message(text):
+    return {"role": "user", "content": text}
+
+
+def test_truncate_conversation_keeps_the_latest_messages(word_tokens):
+    conversation = [message("one two three"), message("four five"), message("six")]
+    assert tokenbudget.truncate_conversation(conversation, 3) == (conversation[1:], 3)
+    assert tokenbudget.truncate_conversation(conversation, 6) == (conversation, 6)
+    assert tokenbudget.truncate_conversation(conversation, 0) == ([], 0)
+
+
+def test_real_encoding_counts_tokens():
+    try:
+        tokenbudget.get_encoding()
+    except Exception:
+        pytest.skip("the cl100k_base files are not available")
+    assert tokenbudget.count_tokens("hello world") == 2
+    assert tokenbudget.truncate_tokens("hello world", 1) == "hello"
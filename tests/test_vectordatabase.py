@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip("chromadb")
+pytest.importorskip("openai")
+
+from core import vectordatabase
+from core.vectordatabase import RetrievalCache, VectorDatabase
+
+
+@pytest.fixture
+def local_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(vectordatabase, "LEXICAL_INDEX_DIR", str(tmp_path / "lexical"))
+    monkeypatch.setattr(vectordatabase, "get_embedding_cache", lambda: None)
+    db = VectorDatabase(str(tmp_path / "index"), "local", hosted=False)
+    db.init_db()
+    db.embedding_function = lambda texts: [[float(len(text)), 1.0] for text in texts]
+    return db
+
+
+def test_lexical_index_stays_out_of_the_local_collections(local_db):
+    collection = local_db.get_collection("col")
+    collection.upsert(
+        ids=["a", "b"],
+        embeddings=[[1.0, 0.0], [0.0, 1.0]],
+        metadatas=[{"doc": "x"}, {"doc": "y"}],
+        documents=["alpha beta", "gamma"],
+    )
+    assert len(local_db.lexical_index(collection)) == 2
+    local_db.save_lexical_index("col")
+
+    assert [c.name for c in local_db.client.list_collections()] == ["col"]
+    with pytest.raises(ValueError):
+        local_db.client.get_collection("col.bm25")
+
+    local_db.delete_datasource_chroma("col")
+    assert local_db.client.list_collections() == []
+
+
+def test_retrieval_cache_results_are_copies_on_a_miss_too():
+    cache = RetrievalCache()
+    computed = {"ids": [["a"]]}
+    result = cache.get_or_compute(("col", "q"), lambda: computed)
+    result["ids"][0].append("b")
+    assert computed == {"ids": [["a"]]}
+    assert cache.get_or_compute(("col", "q"), lambda: None) == {"ids": [["a"]]}